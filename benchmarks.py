@@ -0,0 +1,865 @@
+import argparse
+import subprocess
+import sys
+import time
+
+import rich
+import torch
+
+
+print = rich.print
+
+
+##############################
+#         Benchmarks         #
+##############################
+
+# Small, self-contained performance checks for the code in main.py. Run all of them with `python benchmarks.py`,
+# or a selection with `python benchmarks.py import_time ...`. Benchmarks with a budget exit with an error if they exceed it.
+
+# Importing main.py on top of torch (which we can't do anything about) has to stay below this.
+IMPORT_TIME_BUDGET_MS = 150.
+
+
+def bench_import_time(num_repeats: int = 5, budget_ms: float = IMPORT_TIME_BUDGET_MS) -> bool:
+    # Measured in fresh interpreters, so that nothing is cached. Torch is imported first and subtracted, we only care about our own overhead.
+    script = (
+        "import time; t0 = time.perf_counter(); import torch; t1 = time.perf_counter(); import main; t2 = time.perf_counter(); "
+        "assert not {'data', 'position_bias_base', 'causal_mask', 'batch_index_offsets'} & set(main.ctx.__dict__), 'import created buffers'; "
+        "print((t1 - t0) * 1e3, (t2 - t1) * 1e3)"
+    )
+    overheads = []
+    for _ in range(num_repeats):
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        torch_ms, main_ms = map(float, result.stdout.split()[-2:])
+        overheads.append(main_ms)
+
+    best_ms = min(overheads)
+    passed  = best_ms <= budget_ms
+    print(f"| import_time: `import main` costs {best_ms:.1f} ms on top of torch ({torch_ms:.0f} ms) | budget {budget_ms:.0f} ms | {'ok' if passed else 'OVER BUDGET'}")
+    return passed
+
+
+def _make_mask_uncached(block, seq_len: int, first_acting_token_idx: int | None, last_acting_token_idx: int | None):
+    # The previous `LatentAttentionBlock.make_mask`, which rebuilt the whole mask in every block call. Kept here as the reference.
+    import torch.nn.functional as F
+    from main import ctx
+
+    attn_mask = torch.where(
+        ctx.causal_mask[:seq_len, :seq_len],
+        F.softplus(block.position_bias_mult) * ctx.position_bias_base[:seq_len, :seq_len],
+        ctx.negative_infinity_matrix_base[:seq_len, :seq_len]
+    )
+    if first_acting_token_idx is not None:
+        first_acting_token_idx = None if first_acting_token_idx >= seq_len else first_acting_token_idx
+        last_acting_token_idx = None if last_acting_token_idx >= seq_len else last_acting_token_idx
+        attn_mask[first_acting_token_idx:, last_acting_token_idx:] = (
+            F.softplus(block.position_bias_mult)
+            * ctx.position_bias_base[first_acting_token_idx:seq_len, last_acting_token_idx:seq_len]
+        )
+    return attn_mask
+
+
+def bench_attention_mask(seq_lens: tuple[int, ...] = (32, 64, 128, 256, 512, 1024), num_blocks: int = 8, num_repeats: int = 20) -> bool:
+    # Mask construction for one (plan-act) forward pass through `num_blocks` blocks, rebuilt per block vs. cached structure + per-block scale
+    import main
+
+    blocks = [main.LatentAttentionBlock(64, linear_value=False, num_heads=1).to(main.hyp['misc']['device'], main.hyp['misc']['dtype']) for _ in range(num_blocks)]
+    x      = torch.empty(1, max(seq_lens), 64, device=main.hyp['misc']['device'])
+
+    def timed(fn) -> float:
+        fn() # warmup (and cache fill)
+        main.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            fn()
+        main.synchronize()
+        return (time.perf_counter() - start) / num_repeats
+
+    identical = True
+    for seq_len in seq_lens:
+        first_acting_token_idx, last_acting_token_idx = main.get_first_and_last_acting_token_idx(seq_len, planning_rate=.25, acting_rate=.1)
+        for name, first, last in (('causal', None, None), ('plan-act', first_acting_token_idx, last_acting_token_idx)):
+            for block in blocks:
+                identical &= torch.equal(block.make_mask(x[:, :seq_len], first, last), _make_mask_uncached(block, seq_len, first, last))
+
+            uncached_s = timed(lambda: [_make_mask_uncached(block, seq_len, first, last) for block in blocks])
+            cached_s   = timed(lambda: [block.make_mask(x[:, :seq_len], first, last) for block in blocks])
+            print(f"| attention_mask: {name:>8} | seq_len {seq_len:>4} | rebuilt {1e3*uncached_s:8.3f} ms | cached {1e3*cached_s:8.3f} ms | {uncached_s/cached_s:5.2f}x")
+
+    print(f"| attention_mask: cached masks {'are identical to' if identical else 'DIFFER FROM'} the rebuilt ones")
+    return identical
+
+
+def bench_plan_act_schedule(
+        depth: int = 4, width: int = 256, seq_lens: tuple[int, ...] = (64, 256), tokens_per_microbatch: int = 2048, num_microbatches: int = 8,
+) -> None:
+    # Training throughput (forward + backward) of the sequential vs. the pipelined plan-act schedule, on random tokens
+    import main
+
+    net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1))
+    settings = dict(
+        planner_masking_rate=.25, actor_masking_rate=.1, randomize_masking_rate=False,
+        planning_divider=2., acting_divider=2., top_k=5,
+    )
+
+    for seq_len in seq_lens:
+        batchsize = max(1, tokens_per_microbatch // seq_len)
+        sequences = torch.randint(0, main.hyp['misc']['num_tokens'], (num_microbatches + 1, batchsize, seq_len), device=main.hyp['misc']['device'])
+        first_acting_token_idx, last_acting_token_idx = main.sample_acting_span(settings, seq_len)
+
+        results = {}
+        for schedule in ('sequential', 'pipelined'):
+            carry = None
+            for i, sequence in enumerate(sequences):
+                if i == 1: # first microbatch is warmup (and fills the pipeline)
+                    main.synchronize()
+                    start = time.perf_counter()
+                if schedule == 'pipelined':
+                    loss, _, _, carry = main.plan_act_pipelined(net, sequence, first_acting_token_idx, last_acting_token_idx, settings, carry)
+                else:
+                    loss, _, _ = main.plan_act_sequential(net, sequence, first_acting_token_idx, last_acting_token_idx, settings)
+                loss.backward()
+                net.zero_grad(set_to_none=True)
+            main.synchronize()
+            results[schedule] = num_microbatches * batchsize * seq_len / (time.perf_counter() - start)
+
+        print(
+            f"| plan_act_schedule: seq_len {seq_len:>4}, batchsize {batchsize:>4} "
+            f"| sequential {results['sequential']:10,.0f} tokens/s | pipelined {results['pipelined']:10,.0f} tokens/s "
+            f"| {results['pipelined']/results['sequential']:5.2f}x"
+        )
+
+
+def bench_generation(depth: int = 4, width: int = 256, batchsize: int = 4, prompt_length: int = 32, new_tokens: tuple[int, ...] = (64, 256)) -> bool:
+    # Greedy generation with the KV cache vs. re-running the full sequence for every new token (the only option before). Same tokens, O(N*L) vs O(N*L^2)
+    # The same for plan-act decoding (`generate_plan_act`) vs. the full planning & acting forwards of training, once per round.
+    import main
+
+    net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1)).eval()
+    prompts = torch.randint(0, main.hyp['misc']['num_tokens'], (batchsize, prompt_length)).tolist()
+
+    def generate_uncached(max_new_tokens: int) -> torch.Tensor:
+        sequence = torch.tensor([[main.hyp['misc']['causal_token']] + prompt for prompt in prompts], device=main.hyp['misc']['device'])
+        with torch.no_grad():
+            for _ in range(max_new_tokens):
+                next_token = main.sample_from_logits(net.logits(net.hidden(sequence)[:, -1]), temperature=0.)
+                sequence = torch.cat([sequence, next_token.unsqueeze(1)], dim=1)
+        return sequence[:, 1+prompt_length:]
+
+    identical = True
+    for max_new_tokens in new_tokens:
+        timings = {}
+        for name, fn in (('uncached', generate_uncached), ('kv_cache', lambda n: main.generate_causal(net, prompts, n, temperature=0.))):
+            main.synchronize()
+            start = time.perf_counter()
+            timings[name] = fn(max_new_tokens), time.perf_counter() - start
+        identical &= torch.equal(timings['uncached'][0], timings['kv_cache'][0])
+
+        uncached_s, cached_s = timings['uncached'][1], timings['kv_cache'][1]
+        print(
+            f"| generation: {max_new_tokens:>4} new tokens, batchsize {batchsize} | uncached {batchsize*max_new_tokens/uncached_s:8,.0f} tokens/s "
+            f"| kv cache {batchsize*max_new_tokens/cached_s:8,.0f} tokens/s | {uncached_s/cached_s:5.2f}x"
+        )
+
+    # Plan-act decoding: every round is a planning & an acting forward over the whole sequence, built the way training builds them
+    def generate_plan_act_uncached(max_new_tokens: int) -> torch.Tensor:
+        sequence = torch.tensor(prompts, device=main.hyp['misc']['device'])
+        with torch.no_grad():
+            while sequence.shape[1] - prompt_length < max_new_tokens:
+                first_acting_token_idx = sequence.shape[1] + 1 # the inputs are shifted by the start token
+                last_acting_token_idx  = first_acting_token_idx + acting_length
+                padded = torch.cat([sequence, torch.zeros_like(sequence[:, :planning_length + 1])], dim=1) # the spans' tokens are never seen
+                planning_inputs, _ = main.get_planning_data(padded, first_acting_token_idx)
+                planning_hidden    = net.hidden(planning_inputs)
+                acting_inputs, _   = main.get_acting_data(net, padded, planning_hidden, first_acting_token_idx, last_acting_token_idx, top_k=planning_top_k)
+                acting_hidden      = net.hidden(acting_inputs, first_acting_token_idx=first_acting_token_idx, last_acting_token_idx=last_acting_token_idx)
+                # The causal prediction of the next token, and the acting span's
+                next_tokens = main.sample_from_logits(net.logits(acting_hidden[:, first_acting_token_idx-1:last_acting_token_idx]), temperature=0.)
+                sequence = torch.cat([sequence, next_tokens], dim=1)
+        return sequence[:, prompt_length:prompt_length+max_new_tokens]
+
+    planning_length, acting_length, planning_top_k = 8, 3, 5
+    for max_new_tokens in new_tokens:
+        timings = {}
+        for name, fn in (
+                ('uncached', generate_plan_act_uncached),
+                ('kv_cache', lambda n: main.generate_plan_act(net, prompts, n, planning_length, acting_length, planning_top_k, temperature=0.)),
+        ):
+            main.synchronize()
+            start = time.perf_counter()
+            timings[name] = fn(max_new_tokens), time.perf_counter() - start
+        identical &= torch.equal(timings['uncached'][0], timings['kv_cache'][0])
+
+        uncached_s, cached_s = timings['uncached'][1], timings['kv_cache'][1]
+        print(
+            f"| generation (plan-act): {max_new_tokens:>4} new tokens, batchsize {batchsize} | uncached {batchsize*max_new_tokens/uncached_s:8,.0f} tokens/s "
+            f"| kv cache {batchsize*max_new_tokens/cached_s:8,.0f} tokens/s | {uncached_s/cached_s:5.2f}x"
+        )
+
+    print(f"| generation: kv-cached tokens (causal & plan-act) {'are identical to' if identical else 'DIFFER FROM'} the uncached ones")
+    return identical
+
+
+def bench_inference_engine(depth: int = 2, width: int = 128, num_requests: int = 32, max_prompt_length: int = 48, max_new_tokens: int = 32) -> bool:
+    # Mixed causal & plan-act requests (two decoder settings), greedy & sampled (seeded), some with stop tokens, through serve.py's
+    # `InferenceEngine` in two waves, so that batches get prefilled, joined & shrunk while others run. Checks that every request gets the same
+    # tokens as `main.generate` on its own prompt, with a generator seeded the same, cut at its first stop token. In float32.
+    import random
+    import main
+    import serve
+
+    dtype, main.hyp['misc']['dtype'] = main.hyp['misc']['dtype'], torch.float32
+    main.ctx.reset()
+    torch.manual_seed(0)
+    net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1)).eval()
+    rng = random.Random(0)
+    sampling_settings = ({'temperature': 0.}, {'temperature': 1., 'top_k': 50}, {'temperature': 1., 'top_p': .9})
+    decoder_settings  = ({'mode': 'causal'}, {'mode': 'plan_act', 'planning_length': 8, 'acting_length': 3, 'planning_top_k': 5},
+                         {'mode': 'plan_act', 'planning_length': 6, 'acting_length': 2, 'planning_top_k': 3})
+    payloads = [
+        {
+            'id': i, 'seed': i, 'tokens': [rng.randrange(main.hyp['misc']['num_tokens']) for _ in range(rng.randint(4, max_prompt_length))],
+            'max_new_tokens': rng.randint(max_new_tokens // 4, max_new_tokens), **decoder_settings[i % 3], **sampling_settings[i // 3 % 3],
+        }
+        for i in range(num_requests)
+    ]
+
+    # The references, one request at a time. Every other request stops at a (random) token of its reference.
+    main.synchronize()
+    start, expected = time.perf_counter(), {}
+    for payload in payloads:
+        settings = {**serve.DEFAULT_SETTINGS, **payload}
+        if settings['mode'] == 'plan_act':
+            decoder = main.PlanActDecoder(net, [payload['tokens']], settings['planning_length'], settings['acting_length'], settings['planning_top_k'])
+        else:
+            decoder = main.CausalDecoder(net, [payload['tokens']])
+        tokens = main.generate(
+            decoder, settings['max_new_tokens'], temperature=settings['temperature'], top_k=settings['top_k'], top_p=settings['top_p'],
+            generator=torch.Generator(main.hyp['misc']['device']).manual_seed(payload['seed']),
+        )[0].tolist()
+        if payload['id'] % 2 == 1:
+            payload['stop_tokens'] = [tokens[rng.randrange(len(tokens))]]
+            tokens = tokens[:tokens.index(payload['stop_tokens'][0])]
+        expected[payload['id']] = tokens
+    main.synchronize()
+    reference_s = time.perf_counter() - start
+
+    engine  = serve.InferenceEngine(net, max_batch_size=8, length_bucket=16)
+    start   = time.perf_counter()
+    futures = [engine.submit(serve.GenerationRequest(payload)) for payload in payloads[:num_requests // 2]]
+    time.sleep(.1) # the second wave arrives while the first one is decoding
+    futures += [engine.submit(serve.GenerationRequest(payload)) for payload in payloads[num_requests // 2:]]
+    responses = [future.result() for future in futures]
+    engine_s  = time.perf_counter() - start
+
+    main.hyp['misc']['dtype'] = dtype
+    main.ctx.reset()
+
+    num_matching = sum(response['tokens'] == expected[response['id']] for response in responses)
+    num_tokens   = sum(len(response['tokens']) for response in responses)
+    print(
+        f"| inference_engine: {num_requests} requests, {num_tokens} tokens | one at a time {num_tokens/reference_s:7,.0f} tokens/s "
+        f"| engine {num_tokens/engine_s:7,.0f} tokens/s, mean batchsize {engine.stats.summary()['mean_batchsize']:.1f} "
+        f"| {num_matching}/{num_requests} match generate {'ok' if num_matching == num_requests else 'MISMATCH'}"
+    )
+    return num_matching == num_requests
+
+
+def bench_param_count(model_scales: tuple[float, ...] = (.5, 1., 4., 16.)) -> bool:
+    # `change_model_scale` used to build the whole net (on the device) just to count its parameters, now it's closed-form
+    import main
+
+    exact, net_hyp = True, dict(main.hyp['net'])
+    for scale in model_scales:
+        width, depth = main.to_nearest_64(384 * main.math.log2(1.+scale)), round(8 * main.math.log2(1.+scale))
+        main.hyp['net']['residual_depth'], main.hyp['net']['num_blocks'] = width, depth
+
+        start = time.perf_counter()
+        net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1))
+        num_params = sum(p.numel() for p in net.parameters() if p.requires_grad)
+        num_non_embedding_params = sum(p.numel() for m in (net.net_dict['attn_layers'] + [net.net_dict['norm']]) for p in m.parameters())
+        static_bytes = 4 * sum(p.numel() * p.element_size() for p in net.parameters()) + net.net_dict['outputs'].weight.numel() * 4
+        del net
+        built_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cost = main.estimate_model_cost(depth, width)
+        analytic_s = time.perf_counter() - start
+
+        exact &= (num_params, num_non_embedding_params, static_bytes) == (cost['num_params'], cost['num_non_embedding_params'], cost['static_bytes'])
+        print(
+            f"| param_count: model_scale {scale:>5} ({main.format_num_params(num_params)} params) "
+            f"| built {1e3*built_s:9.2f} ms | analytic {1e3*analytic_s:6.3f} ms | {built_s/analytic_s:8.0f}x"
+        )
+
+    main.hyp['net'].update(net_hyp)
+    print(f"| param_count: analytic counts & static bytes {'are identical to' if exact else 'DIFFER FROM'} the instantiated ones")
+    return exact
+
+
+def bench_batch_sampler(
+        depth: int = 2, width: int = 128, batchsize: int = 16, length: int = 128, num_tokens: int = 20_000_000, num_steps: int = 10,
+) -> bool:
+    # Step time (batch + forward/backward) with the synchronous `get_batch` vs. the prefetching `BatchSampler`, on random token shards.
+    # Also checks that prefetching doesn't change the batches (incl. across a sequence length change), and that a permutation epoch visits every window once.
+    import tempfile
+    import numpy as np
+    import main
+    import token_shards
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = token_shards.ShardWriter(directory, 'train', shard_size=num_tokens // 4)
+        writer.write(np.random.default_rng(0).integers(0, main.hyp['misc']['num_tokens'], num_tokens, dtype=np.uint16))
+        writer.close()
+        data = token_shards.load_token_shards(directory)
+
+        net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1))
+        settings = dict(plan_act=False)
+
+        def timed(next_batch) -> tuple[float, float]:
+            # (time per step, of which waiting for the batch), so that the loading cost is visible even when the step itself dominates
+            main.forward_backward(net, next_batch(), settings) # warmup
+            main.synchronize()
+            start, waiting = time.perf_counter(), 0.
+            for _ in range(num_steps):
+                batch_start = time.perf_counter()
+                sequence = next_batch()
+                main.synchronize()
+                waiting += time.perf_counter() - batch_start
+                main.forward_backward(net, sequence, settings)
+                net.zero_grad(set_to_none=True)
+            main.synchronize()
+            return (time.perf_counter() - start) / num_steps, waiting / num_steps
+
+        sampler = main.BatchSampler(data['train'], seed=0)
+        sync_s, sync_wait_s         = timed(lambda: main.get_batch(data, key='train', batchsize=batchsize, length=length))
+        prefetch_s, prefetch_wait_s = timed(lambda: sampler.next(batchsize, length)[0])
+        sampler.close()
+        print(
+            f"| batch_sampler: batchsize {batchsize}, length {length} | get_batch {1e3*sync_s:8.2f} ms/step ({1e3*sync_wait_s:6.3f} ms waiting for the batch) "
+            f"| prefetched {1e3*prefetch_s:8.2f} ms/step ({1e3*prefetch_wait_s:6.3f} ms waiting) | {sync_s/prefetch_s:5.2f}x"
+        )
+
+        identical = True
+        for mode in ('random', 'permutation'):
+            batches = {}
+            for num_prefetch in (0, 3):
+                sampler = main.BatchSampler(data['train'], seed=0, mode=mode, num_prefetch=num_prefetch)
+                batches[num_prefetch] = [sampler.next(batchsize, length if i < 5 else 2*length)[0] for i in range(10)]
+                sampler.close()
+            identical &= all(torch.equal(a, b) for a, b in zip(batches[0], batches[3]))
+
+        sampler = main.BatchSampler(torch.arange(1000), seed=0, mode='permutation', num_prefetch=0)
+        first   = sampler.next(1, 10)[0][:, 0]
+        epoch   = torch.cat([first, sampler.next(len(sampler.permutation) - 1, 10)[0][:, 0]]) # the tokens are their own indexes
+        covered = len(epoch.unique()) == len(sampler.permutation) == (1000 - sampler.offset - 1) // 10 and bool(((epoch - sampler.offset) % 10 == 0).all())
+        sampler.close()
+
+    print(f"| batch_sampler: prefetched batches {'are identical to' if identical else 'DIFFER FROM'} the unprefetched ones, permutation epochs {'cover' if covered else 'DO NOT COVER'} every window once")
+    return identical and covered
+
+
+def bench_document_packing(
+        num_documents: int = 30_000, mean_document_length: int = 3_600, lengths: tuple[int, ...] = (256, 1024), depth: int = 2, width: int = 128,
+) -> bool:
+    # Packing time & how much of the packed windows is padding, for WikiText-103-like document lengths (~110M tokens).
+    # Also checks that a packed epoch holds every token exactly once, and that packed documents don't see each other:
+    # the hidden states of every piece of a packed batch have to match the ones of that piece on its own.
+    import main
+
+    generator = torch.Generator().manual_seed(0)
+    document_lengths = 1 + torch.empty(num_documents).exponential_(1. / mean_document_length, generator=generator).long()
+    document_starts  = torch.cumsum(document_lengths, 0) - document_lengths
+    num_tokens       = int(document_lengths.sum())
+
+    for length in lengths:
+        start = time.perf_counter()
+        piece_starts, piece_lengths, window_offsets = main.pack_documents(document_starts, num_tokens, length, seed=0)
+        pack_s = time.perf_counter() - start
+        num_windows = len(window_offsets) - 1
+        print(
+            f"| document_packing: {num_documents:,} documents, {num_tokens:,} tokens, length {length:5d} | packed in {pack_s:6.2f} s "
+            f"| {num_windows:,} windows, {100 * (1 - num_tokens / (num_windows * length)):5.2f}% padding"
+        )
+
+    # Small exact checks, on tokens that are their own indexes. The documents are shortened to ~1/2 window, so that most windows hold several.
+    document_starts = torch.unique(document_starts[:200] // (2 * mean_document_length // 64))
+    tokens = torch.arange(int(document_starts[-1]) + 50)
+    sampler = main.BatchSampler(tokens, seed=0, mode='packed', num_prefetch=2, document_starts=document_starts)
+    first, first_segments = sampler.next(1, 64)
+    batch, segment_ids    = sampler.next(len(sampler.permutation) - 1, 64)
+    sampler.close()
+    epoch   = torch.cat([first[first_segments >= 0], batch[segment_ids >= 0]])
+    covered = len(epoch) == len(tokens) and len(epoch.unique()) == len(tokens)
+
+    # In float32, so that the comparison isn't swamped by bf16 rounding (the masks are built in `hyp`'s dtype)
+    dtype, main.hyp['misc']['dtype'] = main.hyp['misc']['dtype'], torch.float32
+    main.ctx.reset()
+    net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1)).eval()
+    with torch.no_grad():
+        batch, segment_ids = batch[:8].to(main.hyp['misc']['device']), segment_ids[:8].to(main.hyp['misc']['device'])
+        inputs, _ = main.get_causal_data(batch, segment_ids)
+        packed    = net.hidden(inputs.to(torch.long), segment_ids=segment_ids)
+        max_error = 0.
+        for row in range(len(batch)):
+            for segment in segment_ids[row].unique().tolist():
+                selected = segment_ids[row] == segment
+                if segment < 0:
+                    continue
+                alone, _  = main.get_causal_data(batch[row:row+1, selected])
+                max_error = max(max_error, (net.hidden(alone)[0] - packed[row, selected]).abs().max().item())
+    isolated = max_error < 1e-4
+    main.hyp['misc']['dtype'] = dtype
+    main.ctx.reset()
+
+    print(
+        f"| document_packing: a packed epoch {'holds' if covered else 'DOES NOT HOLD'} every token once "
+        f"| packed documents {'are' if isolated else 'ARE NOT'} isolated (max hidden state difference {max_error:.2e})"
+    )
+    return covered and isolated
+
+
+def _eval_plan_act_reference(net, eval_batches: list[torch.Tensor], first_acting_token_idx: int, last_acting_token_idx: int, top_k: int) -> list[float]:
+    # The previous plan-act eval, which ran both passes for every single setting. Kept here as the reference. Returns the (loss, acc) pairs.
+    import main
+
+    results = torch.zeros(10, dtype=torch.float, device=main.hyp['misc']['device'])
+    for sequence in eval_batches:
+        inputs, targets = main.get_planning_data(sequence, first_acting_token_idx)
+        hidden = net.hidden(inputs)
+        losses, predictions = net.token_losses(hidden, targets)
+        planning = [losses.mean(), (predictions == targets).float().mean()]
+
+        inputs, targets = main.get_acting_data(net, sequence, hidden, first_acting_token_idx, last_acting_token_idx, top_k=top_k)
+        losses, predictions = net.token_losses(net.hidden(inputs, first_acting_token_idx, last_acting_token_idx), targets)
+        correct = (predictions == targets).float()
+        acting = [
+            metric[:, region].mean()
+            for region in (slice(None), slice(None, first_acting_token_idx), slice(first_acting_token_idx, last_acting_token_idx), slice(last_acting_token_idx, None))
+            for metric in (losses, correct)
+        ]
+        results += torch.stack(planning + acting) / len(eval_batches)
+    return results.tolist()
+
+
+@torch.no_grad()
+def bench_full_evaluation(
+        depth: int = 2, width: int = 128, seq_len: int = 128, batchsize: int = 4, num_batches: int = 2,
+        acting_mask_widths: tuple[int, ...] = (1, 10), top_ks: tuple[int, ...] = (1, 2, 3, 4, 5),
+) -> bool:
+    # Time for a (reduced) `full_evaluation` grid, one setting at a time vs. with the shared prefixes, planning passes & batched top-k variants
+    # of `_eval_plan_act_grid`, on random tokens. Also checks that both give the same results. In float32, so that the comparison is tight.
+    import itertools
+    import main
+
+    dtype, main.hyp['misc']['dtype'] = main.hyp['misc']['dtype'], torch.float32
+    main.ctx.reset()
+    net = main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1)).eval()
+    generator    = torch.Generator().manual_seed(0)
+    eval_batches = list(torch.randint(0, main.hyp['misc']['num_tokens'], (num_batches, batchsize, seq_len), generator=generator).to(main.hyp['misc']['device']))
+    settings     = [(last - width, last, top_k) for width, last, top_k in itertools.product(acting_mask_widths, range(13, seq_len, 10), top_ks)]
+    acting_spans = list(dict.fromkeys((first, last) for first, last, _ in settings))
+
+    main.synchronize()
+    start = time.perf_counter()
+    reference = {(first, last, top_k): _eval_plan_act_reference(net, eval_batches, first, last, top_k) for first, last, top_k in settings}
+    main.synchronize()
+    reference_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metrics = main.MetricsAccumulator({setting: main.plan_act_metric_names for setting in settings})
+    main._eval_plan_act_grid(net, eval_batches, acting_spans, list(top_ks), metrics)
+    grid = {setting: list(values.values()) for setting, values in metrics.compute().items()}
+    main.synchronize()
+    grid_s = time.perf_counter() - start
+
+    main.hyp['misc']['dtype'] = dtype
+    main.ctx.reset()
+
+    max_error = max(abs(a - b) for setting in settings for a, b in zip(reference[setting], grid[setting]))
+    matches   = max_error < 1e-4
+    print(
+        f"| full_evaluation: {len(settings)} settings, {num_batches} x {batchsize} x {seq_len} tokens | per setting {reference_s:7.2f} s "
+        f"| shared grid {grid_s:7.2f} s | {reference_s/grid_s:5.2f}x | max difference {max_error:.1e} {'ok' if matches else 'MISMATCH'}"
+    )
+    return matches
+
+
+def _distributed_full_evaluation_worker(rank: int, world_size: int, directory: str, depth: int, width: int, length: int, batchsize: int, num_batches: int) -> None:
+    # One rank of `bench_distributed_full_evaluation`: a `full_evaluation` of the same (seeded) net on the token shards in `directory`,
+    # with the main process saving the results there
+    import torch.distributed as dist
+    import main
+
+    main.hyp['misc'].update(data_location=directory, dtype=torch.float32)
+    main.hyp['misc']['sequence_length']['max'] = main.max_sequence_length = length
+    main.hyp['opt']['num_eval_tokens'] = num_batches * batchsize * length
+    main.tokens_per_batch_capacity = 16 * batchsize * length # `eval_batchsize` is 1/16th of the capacity
+    main.ctx.reset(keep_data=False)
+    dist.init_process_group('gloo', init_method=f"file://{directory}/init_{world_size}", rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(0)
+        results = main.full_evaluation(main.make_net(dict(depth=depth, width=width, linear_value=False, num_heads=1)))
+        if main.is_main_process():
+            torch.save(results, f"{directory}/results_{world_size}.pt")
+    finally:
+        dist.destroy_process_group()
+
+
+def bench_distributed_full_evaluation(depth: int = 2, width: int = 64, length: int = 64, batchsize: int = 2, num_batches: int = 5, world_size: int = 2) -> bool:
+    # `full_evaluation` over `world_size` gloo processes vs. a single one, on random token shards. Every rank evaluates its share of the
+    # fixed eval set, and the all-reduced grid has to match the single-process one (up to float rounding). An odd number of batches, so the ranks' shares differ.
+    import tempfile
+    import numpy as np
+    import torch.multiprocessing as mp
+    import main
+    import token_shards
+
+    with tempfile.TemporaryDirectory() as directory:
+        for split in ('train', 'eval'):
+            writer = token_shards.ShardWriter(directory, split)
+            writer.write(np.random.default_rng(0).integers(0, main.hyp['misc']['num_tokens'], 200_000, dtype=np.uint16))
+            writer.close()
+
+        times = {}
+        for num_processes in (1, world_size):
+            start = time.perf_counter()
+            mp.spawn(_distributed_full_evaluation_worker, args=(num_processes, directory, depth, width, length, batchsize, num_batches), nprocs=num_processes)
+            times[num_processes] = time.perf_counter() - start
+        single, distributed = (torch.load(f"{directory}/results_{num_processes}.pt") for num_processes in (1, world_size))
+
+    values    = lambda results: [value for name, column in results.items() if name != 'setting' for value in column if value is not None]
+    # Relative, as the perplexities of a random net are in the 10^4s
+    max_error = max(abs(a - b) / max(abs(a), 1.) for a, b in zip(values(single), values(distributed)))
+    matches   = single['setting'] == distributed['setting'] and len(values(single)) == len(values(distributed)) and max_error < 1e-5
+    print(
+        f"| distributed_full_evaluation: {len(single['setting'])} settings, {num_batches} x {batchsize} x {length} tokens "
+        f"| 1 process {times[1]:6.2f} s | {world_size} processes {times[world_size]:6.2f} s | max difference {max_error:.1e} {'ok' if matches else 'MISMATCH'}"
+    )
+    return matches
+
+
+def _count_syncs(profile, device: torch.device) -> tuple[int, int]:
+    # (metric readbacks, other host reads) in a profile. On cuda, the host reads are the blocking runtime calls, and the readbacks are the
+    # `MetricsAccumulator.readback` ranges. Elsewhere there's no such thing as a sync, so we count reads of scalars instead: every `.item()`,
+    # `float()`, etc. (which would have been a sync on cuda), of host-side values too (e.g. the dithering draw of the microbatch scheduler).
+    # Except for the ones of the (unfused, off cuda) AdamW, which reads its host-side step counters.
+    def in_optimizer_step(event) -> bool:
+        while event.cpu_parent is not None:
+            event = event.cpu_parent
+            if event.name.startswith('Optimizer.step'):
+                return True
+        return False
+
+    names    = [event.name for event in profile.events() if not in_optimizer_step(event)]
+    blocking = ('cudaStreamSynchronize', 'cudaDeviceSynchronize', 'cudaEventSynchronize', 'cudaMemcpy') if device.type == 'cuda' else ('aten::_local_scalar_dense',)
+    return names.count('MetricsAccumulator.readback'), sum(names.count(name) for name in blocking)
+
+
+def bench_metrics_sync(depth: int = 2, width: int = 64, length: int = 64, num_steps: int = 20, trace_path: str | None = 'metrics_sync_trace.json') -> bool:
+    # Host reads of metrics per training step & per eval, over a short training run (evals every 10 steps) on random token shards, with the
+    # torch profiler. Writes a chrome trace of the run (open it in chrome://tracing or https://ui.perfetto.dev) to `trace_path`.
+    # Checks that an eval reads back its metrics exactly once, and that the training steps only do the one (asynchronous) readback per optimizer step.
+    import tempfile
+    import numpy as np
+    import main
+    import token_shards
+
+    with tempfile.TemporaryDirectory() as directory:
+        for split in ('train', 'eval'):
+            writer = token_shards.ShardWriter(directory, split)
+            writer.write(np.random.default_rng(0).integers(0, main.hyp['misc']['num_tokens'], 200_000, dtype=np.uint16))
+            writer.close()
+
+        # A small run on the temporary shards: (dict or module, name, value) to set, and put back afterwards
+        patches = [
+            (main.hyp['misc'], 'data_location', directory), (main.hyp['misc'], 'dtype', torch.float32), (main.hyp['opt'], 'num_eval_tokens', 8 * length),
+            (main.hyp['misc']['sequence_length'], 'initial', length // 4), (main.hyp['misc']['sequence_length'], 'max', length),
+            (main.hyp['misc']['sequence_length'], 'growth_steps', 4), (main, 'max_sequence_length', length), (main, 'tokens_per_batch_capacity', 8 * length),
+        ]
+        get = lambda target, name: getattr(target, name) if target is main else target[name]
+        put = lambda target, name, value: setattr(target, name, value) if target is main else target.__setitem__(name, value)
+        originals = [(target, name, get(target, name)) for target, name, _ in patches]
+        for target, name, value in patches:
+            put(target, name, value)
+        main.ctx.reset(keep_data=False)
+
+        settings = dict(
+            depth=depth, width=width, num_heads=1, linear_value=False, max_epochs=1, max_steps=num_steps, max_tokens=10**12, max_time_seconds=10**9,
+            log_wandb=False, plan_act=True, planning_divider=2., acting_divider=2., randomize_masking_rate=False, top_k=5,
+            planner_masking_rate=.25, actor_masking_rate=.1, plan_act_schedule='sequential',
+        )
+        try:
+            torch.manual_seed(0)
+            with torch.profiler.profile() as train_profile:
+                net, *_ = main.train(None, **settings)
+            with torch.profiler.profile() as eval_profile:
+                main.quick_evaluation(net)
+        finally:
+            for target, name, value in originals:
+                put(target, name, value)
+            main.ctx.reset(keep_data=False)
+
+    if trace_path:
+        train_profile.export_chrome_trace(trace_path)
+
+    device = torch.device(main.hyp['misc']['device'])
+    num_evals = len(range(0, num_steps + 1, 10))
+    eval_readbacks, eval_reads = _count_syncs(eval_profile, device)
+    train_readbacks, train_reads = _count_syncs(train_profile, device)
+    # Every eval also reads back the training metrics once, and every optimizer step the loss & grad norm for the schedulers
+    step_readbacks = (train_readbacks - num_evals * (eval_readbacks + 1)) / (num_steps + 1)
+    step_reads     = (train_reads - num_evals * eval_reads) / (num_steps + 1)
+    print(
+        f"| metrics_sync: {num_steps + 1} steps, {num_evals} evals{f', trace in {trace_path}' if trace_path else ''} "
+        f"| per eval: {eval_readbacks} metric readback(s), {eval_reads} other host read(s) "
+        f"| per step: {step_readbacks:.2f} metric readback(s), {step_reads:.2f} other host read(s)"
+    )
+    return eval_readbacks == 1 and eval_reads == 0 and step_readbacks == 1.
+
+
+def _fake_runs(num_runs: int, num_evals: int, num_settings: int, ragged: bool = False) -> list[dict]:
+    # Runs as `log_results` gets them, with random (increasing) curves. `ragged`: runs of different lengths, as with stopped runs.
+    import numpy as np
+    import main
+
+    rng = np.random.default_rng(0)
+    runs = []
+    for run_num in range(num_runs):
+        length = num_evals - (int(rng.integers(0, num_evals // 10)) if ragged else 0)
+        runs.append({
+            "last_val_loss": 3., "run_name": f"run_{run_num}", "depth": 2 + run_num % num_settings, "run_num": run_num, "full_evaluation_file": None,
+            **{name: np.cumsum(rng.random(length)).tolist() for name in main.history_names},
+        })
+    return runs
+
+
+def _write_fake_runs(logfile: str, runs: list[dict]) -> None:
+    import argparse
+    import main
+    from run_store import RunStore
+
+    args = argparse.Namespace(logfile=logfile)
+    for run in runs:
+        if not logfile.endswith('.csv'):
+            # What `train` & `run_job` write over the course of a run: the curves in parts, then the run's metadata
+            store, num_evals = RunStore(logfile), len(run["train_loss"])
+            for first in range(0, num_evals, num_evals // 4):
+                store.append_metrics(run["run_name"], first, {name: run[name][first:first + num_evals // 4] for name in main.history_names})
+        main.log_results(args, {name: [value] for name, value in run.items()})
+
+
+def bench_run_store(num_runs: int = 200, num_evals: int = 1_000, num_settings: int = 4) -> bool:
+    # Writing & loading the curves of many (long) runs: the old csv log with stringified lists vs. the run store, as `plot_results` loads them.
+    # Also checks that both give the same curves.
+    import os
+    import tempfile
+    import numpy as np
+    import plot_results
+
+    runs = _fake_runs(num_runs, num_evals, num_settings)
+
+    with tempfile.TemporaryDirectory() as directory:
+        timings = {}
+        for logfile in (os.path.join(directory, 'results.csv'), os.path.join(directory, 'run_store')):
+            start = time.perf_counter()
+            _write_fake_runs(logfile, runs)
+            write_s = time.perf_counter() - start
+
+            start  = time.perf_counter()
+            curves = [plot_results.load_xs_ys_avg_y(logfile, depth=2 + setting, to_plot="val_loss_causal", plot_over="token") for setting in range(num_settings)]
+            timings[logfile.endswith('.csv')] = write_s, time.perf_counter() - start, curves
+
+    (csv_write_s, csv_load_s, csv_curves), (store_write_s, store_load_s, store_curves) = timings[True], timings[False]
+    matches = all(np.allclose(a, b) for csv_setting, store_setting in zip(csv_curves, store_curves) for a, b in zip(csv_setting, store_setting))
+    print(
+        f"| run_store: {num_runs} runs x {num_evals} evals, {num_settings} settings | csv: write {csv_write_s:6.2f} s, load {csv_load_s:6.2f} s "
+        f"| run store: write {store_write_s:6.2f} s, load {store_load_s:6.2f} s | load {csv_load_s/store_load_s:5.1f}x "
+        f"| curves {'match' if matches else 'DO NOT MATCH'}"
+    )
+    return matches
+
+
+def bench_plot_aggregation(num_runs: int = 200, num_evals: int = 1_000, num_settings: int = 8) -> bool:
+    # Aggregating the curves of all settings, the way `plot_metric_curves` used to (one filtered load & a per-run interpolation loop
+    # per setting) vs. `plot_results.Results` (one read, one vectorised pass): from scratch, for another metric, and once more (cached).
+    # Also checks that both give the same curves, over steps & over tokens, in csv files & run stores.
+    import os
+    import tempfile
+    import numpy as np
+    import plot_results
+
+    runs, matches, lines = _fake_runs(num_runs, num_evals, num_settings, ragged=True), True, []
+    with tempfile.TemporaryDirectory() as directory:
+        for logfile in (os.path.join(directory, 'results.csv'), os.path.join(directory, 'run_store')):
+            _write_fake_runs(logfile, runs)
+            for plot_over in ("step", "token"):
+                start = time.perf_counter()
+                for metric in ("val_loss_causal", "train_loss"):
+                    expected = [
+                        plot_results.load_xs_ys_avg_y(logfile, depth=2 + setting, to_plot=metric, plot_over=plot_over)
+                        for setting in range(num_settings)
+                    ]
+                old_s = time.perf_counter() - start
+
+                plot_results._results.clear()
+                timings = []
+                for metric in ("val_loss_causal", "train_loss", "train_loss"):
+                    start  = time.perf_counter()
+                    curves = plot_results.load_results(logfile, use_cache=False).aggregate(metric, plot_over)
+                    timings.append(time.perf_counter() - start)
+
+                matches &= [curve["setting"]["depth"] for curve in curves] == [2 + setting for setting in range(num_settings)]
+                matches &= all(
+                    np.array_equal(curve["xs"], xs) and np.allclose(curve["ys"], ys) and np.allclose(curve["avg_ys"], avg_ys)
+                    for curve, (xs, ys, avg_ys) in zip(curves, expected)
+                )
+                lines.append(
+                    f"| {'csv' if logfile.endswith('.csv') else 'run store'} over {plot_over}: per setting {old_s / 2:6.2f} s/metric "
+                    f"| one pass {timings[0]:6.3f} s, another metric {timings[1]:6.3f} s, cached {timings[2] * 1e3:6.3f} ms"
+                )
+
+    print(f"| plot_aggregation: {num_runs} runs x ~{num_evals} evals, {num_settings} settings | curves {'match' if matches else 'DO NOT MATCH'}")
+    for line in lines:
+        print(line)
+    return matches
+
+
+def bench_results_cache(num_runs: int = 200, num_evals: int = 1_000, num_settings: int = 8, num_appended: int = 8) -> bool:
+    # Loading the results for plotting in a fresh process: without the on-disk cache, building it, hitting it, and updating it after
+    # `num_appended` more runs were logged (as during a sweep). Also checks that the cached results always equal freshly parsed ones,
+    # including after changes that aren't appends (an overwritten csv file, a run store with truncated metrics).
+    import argparse
+    import os
+    import tempfile
+    import numpy as np
+    import main
+    import plot_results
+    from run_store import RunStore
+
+    def load(logfile: str, use_cache: bool = True) -> tuple[float, "plot_results.Results"]:
+        plot_results._results.clear()
+        start   = time.perf_counter()
+        results = plot_results.load_results(logfile, use_cache=use_cache)
+        return time.perf_counter() - start, results
+
+    def same(logfile: str) -> bool:
+        cached, fresh = load(logfile)[1], load(logfile, use_cache=False)[1]
+        return cached.settings() == fresh.settings() and all(
+            np.array_equal(a["xs"], b["xs"]) and np.array_equal(a["ys"], b["ys"], equal_nan=True)
+            for a, b in zip(cached.aggregate("val_loss_causal", "token"), fresh.aggregate("val_loss_causal", "token"))
+        )
+
+    runs, matches, lines = _fake_runs(num_runs + num_appended, num_evals, num_settings, ragged=True), True, []
+    with tempfile.TemporaryDirectory() as directory:
+        for logfile in (os.path.join(directory, 'results.csv'), os.path.join(directory, 'run_store')):
+            _write_fake_runs(logfile, runs[:num_runs])
+            uncached_s = load(logfile, use_cache=False)[0]
+            build_s    = load(logfile)[0]
+            hit_s      = load(logfile)[0]
+            _write_fake_runs(logfile, runs[num_runs:])
+            update_s   = load(logfile)[0]
+            matches   &= same(logfile)
+            lines.append(
+                f"| {'csv' if logfile.endswith('.csv') else 'run store'}: uncached {uncached_s:6.3f} s | build cache {build_s:6.3f} s "
+                f"| cache hit {hit_s:6.3f} s | +{num_appended} runs {update_s:6.3f} s"
+            )
+
+            # Not appends: the cache has to notice, and drop what it has from before
+            if logfile.endswith('.csv'):
+                main.log_results(argparse.Namespace(logfile=logfile), {name: [value] for name, value in runs[0].items()}, overwrite=True)
+            else:
+                RunStore(logfile).truncate_metrics(runs[1]["run_name"], num_evals // 2)
+            matches &= same(logfile)
+
+        # A csv file whose (non-curve) string column is all empty at first, like 'full_evaluation_file' for causal runs,
+        # and gets values in an appended row: neither may be taken for a curve
+        logfile = os.path.join(directory, 'empty_column.csv')
+        for run in runs[:3]:
+            main.log_results(argparse.Namespace(logfile=logfile), {name: [value] for name, value in run.items()})
+        matches &= same(logfile) and len(load(logfile)[1].runs) == 3
+        main.log_results(argparse.Namespace(logfile=logfile), {name: [value] for name, value in {**runs[3], "full_evaluation_file": "eval.csv"}.items()})
+        matches &= same(logfile) and len(load(logfile)[1].runs) == 4
+
+        # A run store right after a sweep started: a run's metadata, but no eval points yet. Then its first ones.
+        logfile = os.path.join(directory, 'live_run_store')
+        RunStore(logfile).write_run(runs[0]["run_name"], {"last_val_loss": None, "depth": runs[0]["depth"], "run_num": 0, "finished": False})
+        matches &= same(logfile) and load(logfile)[1].settings() == []
+        RunStore(logfile).append_metrics(runs[0]["run_name"], 0, {name: runs[0][name][:2] for name in main.history_names})
+        matches &= same(logfile) and len(load(logfile)[1].runs) == 1
+
+    print(f"| results_cache: {num_runs} runs x ~{num_evals} evals | cached results {'match' if matches else 'DO NOT MATCH'}")
+    for line in lines:
+        print(line)
+    return matches
+
+
+def bench_plot_grid(num_runs: int = 64, num_evals: int = 500, num_settings: int = 4) -> bool:
+    # Rendering every metric x x-axis figure: one `plot_metric_curves` call per figure vs. `plot_grid`, on one & on all cpus.
+    # Also checks that `plot_grid` wrote every figure.
+    import matplotlib
+    import os
+    import tempfile
+    import plot_results
+
+    matplotlib.use("Agg")
+    metrics, plot_overs = ("train_loss", "val_loss_causal", "train_acc", "val_acc_causal"), ("step", "epoch", "token", "time_sec")
+    with tempfile.TemporaryDirectory() as directory:
+        logfile = os.path.join(directory, 'run_store')
+        _write_fake_runs(logfile, _fake_runs(num_runs, num_evals, num_settings, ragged=True))
+        plot_results.load_results(logfile) # builds the cache, which all of them use
+
+        cwd, start = os.getcwd(), time.perf_counter()
+        os.chdir(directory)
+        try:
+            for to_plot in metrics:
+                for plot_over in plot_overs:
+                    plot_results.plot_metric_curves(logfile, depth=None, width=None, linear_value=None, to_plot=to_plot, plot_over=plot_over, show=False)
+        finally:
+            os.chdir(cwd)
+        serial_s = time.perf_counter() - start
+
+        timings, num_workers = [], os.cpu_count() or 1
+        for workers in (1, num_workers):
+            out_dir = os.path.join(directory, f'plots_{workers}')
+            start   = time.perf_counter()
+            paths   = plot_results.plot_grid(logfile, out_dir, metrics, plot_overs, num_workers=workers)
+            timings.append(time.perf_counter() - start)
+        complete = sorted(os.listdir(out_dir)) == sorted(os.path.basename(path) for path in paths) and len(paths) == len(metrics) * len(plot_overs)
+
+    print(
+        f"| plot_grid: {len(metrics) * len(plot_overs)} figures | one call each {serial_s:6.2f} s | plot_grid: "
+        f"1 worker {timings[0]:6.2f} s, {num_workers} workers {timings[1]:6.2f} s | {'all written' if complete else 'FIGURES MISSING'}"
+    )
+    return complete
+
+
+BENCHMARKS = {
+    'import_time': bench_import_time,
+    'attention_mask': bench_attention_mask,
+    'plan_act_schedule': bench_plan_act_schedule,
+    'generation': bench_generation,
+    'inference_engine': bench_inference_engine,
+    'param_count': bench_param_count,
+    'batch_sampler': bench_batch_sampler,
+    'document_packing': bench_document_packing,
+    'full_evaluation': bench_full_evaluation,
+    'distributed_full_evaluation': bench_distributed_full_evaluation,
+    'metrics_sync': bench_metrics_sync,
+    'run_store': bench_run_store,
+    'plot_aggregation': bench_plot_aggregation,
+    'results_cache': bench_results_cache,
+    'plot_grid': bench_plot_grid,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmarks.")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run, out of {list(BENCHMARKS)}. DEFAULT: all")
+    args = parser.parse_args()
+    if unknown := set(args.names) - set(BENCHMARKS):
+        parser.error(f"unknown benchmark(s): {sorted(unknown)}")
+
+    results = [BENCHMARKS[name]() for name in (args.names or BENCHMARKS)]
+    sys.exit(0 if all(result is not False for result in results) else 1)
@@ -13,26 +13,33 @@ except NameError:
 """
 
 import itertools
+import bisect
+import collections
 import argparse
-from typing import Any, Literal
+import concurrent.futures
+from typing import Any, Callable, Literal
+import functools
 from functools import partial
-import subprocess
 import random
 
-import zipfile
 import math
+import multiprocessing
 import os
+import queue
+import threading
+import time
+import traceback
 
 import einops
 import rich
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from torch import nn
-import polars as pl
-import wandb
 
-# This seems like one of the best choices right now for a fast/lightweight/simple tokenizer.
-import tiktoken
+import token_shards
+
+# wandb (seconds) and polars (~.2 s) are imported where they're used, to keep `import main` cheap. See `bench_import_time` in benchmarks.py.
 
 
 print = rich.print
@@ -96,6 +103,7 @@ hyp = {
         'eval_every': 50,          # how many train iterations per eval round (we don't include eval time in our performance stats). Good to set to 10-20 for larger (~800M+ networks)
         'save_every_n_evals': 2,   # Good to set this low for larger networks
         'num_eval_tokens': 153600, # Total # tokens total to eval over, divided into max_sequence_length-long sequences
+        'eval_seed': 0,            # The eval sequences are sampled once with this seed, and then reused by every eval (see `RuntimeContext.eval_batches`)
         'warmup_steps': 100,       # For training stability in the main body of the network. (#TODO: Investigate the warmup imact a bit more)
     },
     'net': {
@@ -111,14 +119,17 @@ hyp = {
         'planning_token': 50305,
         'acting_token': 50306,
         'mask_token': 50307,
+        'vocab_chunk_size': 8192, # Vocab chunk size for computing output-layer results without materializing the full logits
+        'loss_chunk_size': 2048,  # Token chunk size for the fused output layer + cross-entropy, ~400 MB of float32 logits per chunk
         'sequence_length': {
             'max': max_sequence_length,
             'initial': 32,      # Very short initial sequence length seems to help a lot
             'growth_steps': 80, # We double the sequence length during training every n steps up to the maximum
         },
-        'device': 'cuda',
-        'dtype': torch.bfloat16,
-        'data_location': 'data.pt',
+        'device': 'cuda' if torch.cuda.is_available() else 'cpu', # Everything also runs on cpu (slowly), e.g. for smoke tests and CI. Set with --device
+        'dtype': torch.bfloat16, # Set with --dtype; float32 is a lot faster than bfloat16 on most cpus
+        'data_location': 'data_shards',      # Directory of memory-mapped uint16 token shards (see token_shards.py)
+        'legacy_data_location': 'data.pt',  # Old monolithic format, automatically converted to shards if found
     }
 }
 
@@ -128,6 +139,29 @@ def change_gpu_token_capacity(factor: float):
     gpu_token_capacity = int(factor * 114688)
 
 
+def estimate_model_cost(depth: int, width: int) -> dict[str, int]:
+    # Closed-form sizes of what `make_net` builds, so that nothing has to be instantiated to plan a run. All of them are exact
+    # (neither num_heads nor linear_value change any shapes):
+    #   - num_params & num_non_embedding_params
+    #   - static_bytes: weights, grads and the two AdamW moments, all in hyp['misc']['dtype'], plus the float32 output layer
+    #     gradient that `ChunkedLinearCrossEntropy` keeps from the forward to the backward pass. What `tune_batchsizes` budgets
+    #     for besides the activations, which it measures (estimating them analytically undercounts by far too much to size batches).
+    vocab_size = hyp['misc']['num_tokens'] + hyp['misc']['num_special_tokens']
+    qk_dim     = width // hyp['net']['qk_dim_div']
+    expand_dim = width * hyp['net']['expand_factor']
+    itemsize   = hyp['misc']['dtype'].itemsize
+
+    block_params             = width + (2*qk_dim + 2*expand_dim) * width + width * expand_dim + 1 # norm, expand, project, position_bias_mult
+    num_non_embedding_params = depth * block_params + width                                       # + the final norm
+    num_params               = num_non_embedding_params + 2 * vocab_size * width                  # + embedding & output layer
+
+    return {
+        'num_params': num_params,
+        'num_non_embedding_params': num_non_embedding_params,
+        'static_bytes': 4 * num_params * itemsize + vocab_size * width * 4,
+    }
+
+
 def change_model_scale(
         scale: float, depth: int | None = None, 
         width: int | None = None, 
@@ -145,12 +179,9 @@ def change_model_scale(
     hyp['net']['residual_depth'] = width
     hyp['net']['num_blocks'] = depth
 
-
-    # Measure number of parameters
-    net = make_net(dict(depth=depth, width=width, linear_value=False, num_heads=num_heads))
-    num_params = sum(p.numel() for p in net.parameters() if p.requires_grad)
-    num_non_embedding_params = sum(p.numel() for m in (net.net_dict['attn_layers'] + [net.net_dict['norm']]) for p in m.parameters())
-    del net
+    # Count the parameters (analytically, building the net just for that used to allocate gigabytes at large scales)
+    cost = estimate_model_cost(depth, width)
+    num_params, num_non_embedding_params = cost['num_params'], cost['num_non_embedding_params']
 
     # Set actual model scale
     default_params = 46_009_736
@@ -164,67 +195,148 @@ def change_model_scale(
 
 
 #############################################
-#                Dataloader                 #
+#        Dataloader & Constant Buffers      #
 #############################################
 
-if not os.path.exists(hyp['misc']['data_location']):
-    print("downloading data and tokenizing (1-2 min)")
-
-    raw_data_source = 'https://wikitext.smerity.com/wikitext-103-raw-v1.zip'
-    raw_data_cache = './data_raw/' # where to cache the data after downloading
-
-    if not os.path.isfile(raw_data_cache):
-        os.makedirs(raw_data_cache, exist_ok=True)
-
-        # Needed due to the website 403-blocking python agents for download, it seems? Many thanks to Smerity for re-hosting these after the main files went down. <3 :')
-        subprocess.run(["wget", raw_data_source, "-O", raw_data_cache+"data.zip"], stdout=subprocess.PIPE)
-
-    with zipfile.ZipFile('data_raw/data.zip', 'r') as zip_ref:
-        zip_ref.extractall('data_raw/')
-
-    with open('data_raw/wikitext-103-raw/wiki.train.raw') as data_file:
-        raw_train_data = data_file.read()
-
-    with open('data_raw/wikitext-103-raw/wiki.valid.raw') as data_file:
-        raw_eval_data = data_file.read()
-
-
-    tokenizer = tiktoken.get_encoding("gpt2")
-    raw_tokenized_train = tokenizer.encode_ordinary(raw_train_data)
-    raw_tokenized_eval  = tokenizer.encode_ordinary(raw_eval_data)
-
-    train_tokenized = torch.tensor(raw_tokenized_train, device=hyp['misc']['device'], dtype=torch.int) # int64 is likely overkill for the amount of tokens we have...
-    eval_tokenized  = torch.tensor(raw_tokenized_eval,  device=hyp['misc']['device'], dtype=torch.int)
-
-    data = {
-        'train': train_tokenized,
-        'eval': eval_tokenized
-        }
-
-    torch.save(data, hyp['misc']['data_location'])
-    print("completed the tokenization process!")
-
-else:
-    ## This is effectively instantaneous, and takes us practically straight to where the dataloader-loaded dataset would be. :)
-    ## So as long as you run the above loading process once, and keep the file on the disc it's specified by default in the above
-    ## hyp dictionary, then we should be good. :)
-    data = torch.load(hyp['misc']['data_location'])
+# Nothing in here happens at import time: the dataset and the constant buffers are created on first use, and then cached.
+# That way, tooling (plot_results.py, notebooks, sweeps, ...) can import this file in milliseconds to get at `make_net`,
+# `format_num_params` & co., without touching the disk or allocating anything on the GPU.
+class RuntimeContext:
+    """ Lazily created dataset and constant buffers, shared by the whole file via the module-level `ctx`."""
+    @functools.cached_property
+    def data(self) -> dict[str, token_shards.TokenShards]:
+        import prepare_data # pulls in tiktoken & multiprocessing machinery, which are only needed here
+
+        if not prepare_data.is_prepared(hyp['misc']['data_location']):
+            if os.path.exists(hyp['misc']['legacy_data_location']):
+                # One-time migration of the old monolithic int32 `data.pt` to the memory-mapped uint16 shard format (same token stream)
+                print(f"converting {hyp['misc']['legacy_data_location']} to token shards in {hyp['misc']['data_location']}")
+                token_shards.convert_tensors_to_shards(torch.load(hyp['misc']['legacy_data_location'], map_location='cpu'), hyp['misc']['data_location'])
+            else:
+                # Streaming, multi-process tokenization; can also be run (and resumed) on its own via `python prepare_data.py`
+                prepare_data.prepare_wikitext(hyp['misc']['data_location'])
+
+        ## This is effectively instantaneous: the shards are only memory-mapped, tokens are read from disk as `get_batch` samples them.
+        ## So as long as you run the above loading process once, and keep the shards on the disc where they're specified by default in the above
+        ## hyp dictionary, then we should be good. :)
+        return token_shards.load_token_shards(hyp['misc']['data_location'])
+
+    # Generator for sampling the batches in `get_batch` (training has its own `BatchSampler`, the evals use `eval_batches`). None uses the global RNG.
+    data_generator: torch.Generator | None = None
+
+    # The eval set: (batchsize, world size, rank, sequence length) -> batches. Only the latest one is kept, it only changes between runs.
+    eval_batch_cache: tuple[tuple[int, ...], list[torch.Tensor]] | None = None
+
+    @torch.no_grad()
+    def eval_batches(self, batchsize: int) -> list[torch.Tensor]:
+        # The fixed eval set: `num_eval_tokens` worth of max-length windows of the eval split, sampled once from `eval_seed`, and then kept
+        # on the device for all the evals of a run (and the ones of later runs in this process). Every eval sees the same tokens, so the
+        # curves only move with the net, and per-batch results can be reused across eval settings.
+        # The windows don't depend on the batchsize, that only decides how they're grouped. In distributed runs, every rank gets its share of
+        # the batches, so that all ranks together evaluate exactly the batches of a single device (and all-reduced means match its means).
+        length = hyp['misc']['sequence_length']['max']
+        key    = (batchsize, get_world_size(), get_rank(), length)
+        if self.eval_batch_cache is None or self.eval_batch_cache[0] != key:
+            self.eval_batch_cache = None # free the old ones first
+            generator = torch.Generator().manual_seed(hyp['opt']['eval_seed'])
+            starts    = torch.randint(len(self.data['eval'])-length-1, (hyp['opt']['num_eval_tokens']//length,), generator=generator)
+            batchsize = max(1, min(batchsize, len(starts)))
+            starts    = starts[:len(starts) // batchsize * batchsize].view(-1, batchsize)[get_rank()::get_world_size()]
+
+            sequences = self.data['eval'].take(starts.unsqueeze(-1) + torch.arange(length)).long().to(hyp['misc']['device'])
+            self.eval_batch_cache = key, list(sequences.unbind(0))
+        return self.eval_batch_cache[1]
 
+    # Create the base arrays for the learnable linear positional bias. This helps save some memory consumption & processing time
+    @functools.cached_property
+    @torch.no_grad()
+    def position_bias_base(self) -> torch.Tensor:
+        bias_range = torch.arange(-hyp['misc']['sequence_length']['max']+1, 1).to(hyp['misc']['device'], hyp['misc']['dtype'])
+        return bias_range.unsqueeze(0) - bias_range.unsqueeze(1)
+
+    @functools.cached_property
+    @torch.no_grad()
+    def negative_infinity_matrix_base(self) -> torch.Tensor:
+        return torch.empty_like(self.position_bias_base).fill_(-float("inf"))
+
+    @functools.cached_property
+    @torch.no_grad()
+    def causal_mask(self) -> torch.Tensor:
+        return torch.tril(torch.ones((hyp['misc']['sequence_length']['max'], hyp['misc']['sequence_length']['max']), device=hyp['misc']['device'], dtype=torch.bool))
+
+    # Used in the dataloader to select indexes in a sequence. Preallocated for slight efficiency.
+    @functools.cached_property
+    def batch_index_offsets(self) -> torch.Tensor:
+        return torch.arange(0, hyp['misc']['sequence_length']['max']+1, dtype=torch.long, device=hyp['misc']['device'])
+
+    # The structural (parameter-free) part of the attention masks, per (seq_len, first_acting_token_idx, last_acting_token_idx).
+    # Built once and shared by all blocks & steps, so that a block only has to apply its own learnable scale (see `LatentAttentionBlock.make_mask`).
+    # Bounded, as randomized masking rates produce lots of distinct acting spans.
+    @functools.cached_property
+    def attention_bias_cache(self) -> collections.OrderedDict:
+        return collections.OrderedDict()
+
+    attention_bias_cache_size = 64
+
+    @torch.no_grad()
+    def attention_bias(
+            self,
+            seq_len: int,
+            first_acting_token_idx: int | None = None,
+            last_acting_token_idx: int | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        # Returns (position_bias, additive_mask): the linear position bias where attention is allowed (0 elsewhere), and 0/-inf for allowed/masked.
+        # The final mask is then just `additive_mask + softplus(position_bias_mult) * position_bias`, which has the same values as
+        # `torch.where(allowed, softplus(position_bias_mult) * position_bias_base, -inf)`, but with finite gradients for the multiplier.
+        key = (seq_len, first_acting_token_idx, last_acting_token_idx)
+        if key in self.attention_bias_cache:
+            self.attention_bias_cache.move_to_end(key)
+            return self.attention_bias_cache[key]
+
+        allowed = self.causal_mask[:seq_len, :seq_len].clone()
+        if first_acting_token_idx is not None:
+            assert last_acting_token_idx is not None
+            assert last_acting_token_idx > first_acting_token_idx
+            first_acting_token_idx = None if first_acting_token_idx >= seq_len else first_acting_token_idx
+            last_acting_token_idx = None if last_acting_token_idx >= seq_len else last_acting_token_idx
+            # Acting tokens can see the (recombined) planning outputs
+            allowed[first_acting_token_idx:, last_acting_token_idx:] = True
+
+        position_bias = torch.where(allowed, self.position_bias_base[:seq_len, :seq_len], 0.)
+        additive_mask = torch.where(allowed, 0., self.negative_infinity_matrix_base[:seq_len, :seq_len])
+
+        self.attention_bias_cache[key] = position_bias, additive_mask
+        if len(self.attention_bias_cache) > self.attention_bias_cache_size:
+            self.attention_bias_cache.popitem(last=False)
+        return position_bias, additive_mask
+
+    @torch.no_grad()
+    def attention_bias_rows(
+            self,
+            start: int,
+            end: int,
+            first_acting_token_idx: int | None = None,
+            last_acting_token_idx: int | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        # Rows `start:end` of the (end x end) attention bias above: the new positions of an incremental (KV-cached) forward,
+        # attending to all positions up to `end`. Not cached, as every decoding step has a different (and tiny) shape.
+        allowed = self.causal_mask[start:end, :end].clone()
+        if first_acting_token_idx is not None:
+            assert last_acting_token_idx is not None
+            assert last_acting_token_idx > first_acting_token_idx
+            allowed[max(first_acting_token_idx-start, 0):, last_acting_token_idx:] = True
 
-########################################
-#              Constants               #
-########################################
+        position_bias = torch.where(allowed, self.position_bias_base[start:end, :end], 0.)
+        additive_mask = torch.where(allowed, 0., self.negative_infinity_matrix_base[start:end, :end])
+        return position_bias, additive_mask
 
-with torch.no_grad():
-    # Create the base arrays for the learnable linear positional bias. This helps save some memory consumption & processing time
-    bias_range                    = torch.arange(-hyp['misc']['sequence_length']['max']+1, 1).to(hyp['misc']['device'], torch.bfloat16)
-    position_bias_base            = bias_range.unsqueeze(0) - bias_range.unsqueeze(1)
-    negative_infinity_matrix_base = torch.empty_like(position_bias_base).fill_(-float("inf"))
-    causal_mask = torch.tril(torch.ones((hyp['misc']['sequence_length']['max'], hyp['misc']['sequence_length']['max']), device=hyp['misc']['device'], dtype=torch.bool))
+    def reset(self, keep_data: bool = True) -> None:
+        # Drop the cached buffers, e.g. after changing the device or the max sequence length in `hyp`. They're rebuilt on next use.
+        for name in ('position_bias_base', 'negative_infinity_matrix_base', 'causal_mask', 'batch_index_offsets', 'attention_bias_cache', 'eval_batch_cache') + (() if keep_data else ('data',)):
+            self.__dict__.pop(name, None)
 
 
-# Used in the dataloader to select indexes in a sequence. Preallocated for slight efficiency.
-batch_index_offsets = torch.arange(0, hyp['misc']['sequence_length']['max']+1, dtype=torch.long, device=hyp['misc']['device'])
+ctx = RuntimeContext()
 
 
 #############################################
@@ -250,29 +362,23 @@ class LatentAttentionBlock(nn.Module):
 
         # Learnable linear positional encodings. Similar to but different than https://arxiv.org/abs/2108.12409
         # Has a high lr mult applied to it so that each layer can learn its own attention scale.
-        self.position_bias_mult = nn.Parameter(torch.tensor(1., device='cuda'))
+        self.position_bias_mult = nn.Parameter(torch.tensor(1.))
 
     def make_mask(
             self, 
             x: torch.Tensor, 
             first_acting_token_idx: int | None = None,
             last_acting_token_idx: int | None = None,
+            segment_mask: torch.Tensor | None = None,
     ):
-        seq_len = x.shape[1]
-        attn_mask = torch.where(
-            causal_mask[:seq_len, :seq_len], 
-            F.softplus(self.position_bias_mult) * position_bias_base[:seq_len, :seq_len], 
-            negative_infinity_matrix_base[:seq_len, :seq_len]
-        )
-        if first_acting_token_idx is not None:
-            assert last_acting_token_idx is not None
-            assert last_acting_token_idx > first_acting_token_idx
-            first_acting_token_idx = None if first_acting_token_idx >= seq_len else first_acting_token_idx
-            last_acting_token_idx = None if last_acting_token_idx >= seq_len else last_acting_token_idx
-            attn_mask[first_acting_token_idx:, last_acting_token_idx:] = (
-                F.softplus(self.position_bias_mult) 
-                * position_bias_base[first_acting_token_idx:seq_len, last_acting_token_idx:seq_len]
-            )
+        # The structure of the mask is cached per sequence length & acting span (see `RuntimeContext.attention_bias`), so this is a single fused op per block
+        position_bias, additive_mask = ctx.attention_bias(x.shape[1], first_acting_token_idx, last_acting_token_idx)
+        attn_mask = torch.addcmul(additive_mask, position_bias, F.softplus(self.position_bias_mult))
+        if segment_mask is not None:
+            # Packed sequences: the per-sequence block-diagonal mask of their documents (see `SpeedyLangNet.hidden`)
+            attn_mask = attn_mask + segment_mask
+            if self.num_heads > 1:
+                attn_mask = attn_mask.unsqueeze(1)
         return attn_mask
 
     def forward(
@@ -280,10 +386,53 @@ class LatentAttentionBlock(nn.Module):
             x: torch.Tensor, 
             first_acting_token_idx: int | None = None,
             last_acting_token_idx: int | None = None,
+            num_planning_sequences: int = 0,
+            segment_mask: torch.Tensor | None = None,
     ):
-        residual = x
+        # `num_planning_sequences`: the first n sequences of the batch are planning sequences, which get the plain causal mask,
+        # the acting span only applies to the rest. This lets planning and acting passes share one forward (see `plan_act_pipelined`).
+        query, key, geglu_local, geglu_attention_value = self.expand_inputs(x)
+
+        # Compute attention. Something to note is that there are no attention heads here. This seemed to work a bit better, maybe due to not needing memory `.contiguous()` calls or similar
+        if num_planning_sequences > 0:
+            # Only the attention itself is split by mask, all the (much more expensive) linear layers run on the full batch
+            n = num_planning_sequences
+            planning_segments, acting_segments = (None, None) if segment_mask is None else (segment_mask[:n], segment_mask[n:])
+            attention = torch.cat([
+                F.scaled_dot_product_attention(query[:n], key[:n], geglu_attention_value[:n], attn_mask=self.make_mask(x, segment_mask=planning_segments)),
+                F.scaled_dot_product_attention(
+                    query[n:], key[n:], geglu_attention_value[n:],
+                    attn_mask=self.make_mask(x, first_acting_token_idx, last_acting_token_idx, acting_segments),
+                ),
+            ])
+        else:
+            attn_mask = self.make_mask(x, first_acting_token_idx, last_acting_token_idx, segment_mask)
+            attention = F.scaled_dot_product_attention(query, key, geglu_attention_value, attn_mask=attn_mask)
+
+        return self.project_outputs(x, geglu_local, attention)
 
-        attn_mask = self.make_mask(x, first_acting_token_idx, last_acting_token_idx)
+    def decode(
+            self,
+            x: torch.Tensor,
+            kv_cache: 'KVCache',
+            block_idx: int,
+            start: int,
+            position_bias: torch.Tensor,
+            additive_mask: torch.Tensor,
+    ):
+        # Incremental forward of the new positions `start:start+x.shape[1]`: their keys & values are written into the cache, and they attend
+        # to everything cached before them. `position_bias`/`additive_mask` are the matching rows of the attention bias, shared by all blocks.
+        query, key, geglu_local, geglu_attention_value = self.expand_inputs(x)
+        key, geglu_attention_value = kv_cache.update(block_idx, start, key, geglu_attention_value)
+
+        attn_mask = torch.addcmul(additive_mask, position_bias, F.softplus(self.position_bias_mult))
+        if self.num_heads > 1 and attn_mask.dim() == 3:
+            attn_mask = attn_mask.unsqueeze(1) # per-sequence (padding) masks, broadcast over the heads
+        attention = F.scaled_dot_product_attention(query, key, geglu_attention_value, attn_mask=attn_mask)
+
+        return self.project_outputs(x, geglu_local, attention)
+
+    def expand_inputs(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         # Shared LayerNorm for linear layers and attention
         x = self.norm(x)
 
@@ -303,10 +452,9 @@ class LatentAttentionBlock(nn.Module):
         if self.num_heads > 1:
             query, key, geglu_local, geglu_attention_value = map(lambda x: einops.rearrange(x, 'b n (h d) -> b h n d', h=self.num_heads), (query, key, geglu_local, geglu_attention_value))
 
+        return query, key, geglu_local, geglu_attention_value
 
-        # Compute attention. Something to note is that there are no attention heads here. This seemed to work a bit better, maybe due to not needing memory `.contiguous()` calls or similar
-        attention = F.scaled_dot_product_attention(query, key, geglu_attention_value, attn_mask=attn_mask)
-
+    def project_outputs(self, residual: torch.Tensor, geglu_local: torch.Tensor, attention: torch.Tensor) -> torch.Tensor:
         if self.num_heads > 1:
             attention = einops.rearrange(attention, 'b h n d -> b n (h d)')
             geglu_local = einops.rearrange(geglu_local, 'b h n d -> b n (h d)')
@@ -320,6 +468,108 @@ class LatentAttentionBlock(nn.Module):
         return x
 
 
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """ Fused output layer + mean cross-entropy (+ argmax), computed in chunks of tokens so that the full logits never exist at once."""
+    # The gradients are computed in the forward pass, chunk by chunk, while the chunk's logits are around anyways (softmax - onehot),
+    # and just scaled in the backward pass. So nothing of size (tokens x vocab) is ever saved for the backward pass either.
+    @staticmethod
+    def forward(ctx, hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, chunk_size: int, ignore_index: int):
+        needs_grad_hidden, needs_grad_weight = ctx.needs_input_grad[:2]
+        valid       = targets != ignore_index
+        num_valid   = valid.sum().clamp(min=1)
+        loss        = torch.zeros((), device=hidden.device, dtype=torch.float)
+        predictions = torch.empty_like(targets)
+        grad_hidden = torch.empty_like(hidden) if needs_grad_hidden else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float) if needs_grad_weight else None
+
+        for start in range(0, hidden.shape[0], chunk_size):
+            chunk_hidden, chunk_targets, chunk_valid = hidden[start:start+chunk_size], targets[start:start+chunk_size], valid[start:start+chunk_size]
+            logits = F.linear(chunk_hidden, weight).float()
+            predictions[start:start+chunk_size] = logits.argmax(-1)
+
+            logsumexp     = logits.logsumexp(-1)
+            target_logits = logits.gather(-1, chunk_targets.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+            loss += ((logsumexp - target_logits) * chunk_valid).sum()
+
+            if needs_grad_hidden or needs_grad_weight:
+                # d(mean loss)/d(logits) = (softmax - onehot) / num_valid, computed in place in the logits buffer
+                grad_logits = logits.sub_(logsumexp.unsqueeze(-1)).exp_()
+                grad_logits[torch.arange(len(chunk_targets), device=hidden.device), chunk_targets.clamp(min=0)] -= 1.
+                grad_logits.mul_((chunk_valid / num_valid).unsqueeze(-1))
+                if needs_grad_hidden:
+                    grad_hidden[start:start+chunk_size] = grad_logits.to(weight.dtype) @ weight
+                if needs_grad_weight:
+                    grad_weight += grad_logits.T @ chunk_hidden.float()
+
+        ctx.save_for_backward(grad_hidden, grad_weight)
+        ctx.weight_dtype = weight.dtype
+        ctx.mark_non_differentiable(predictions)
+        return loss / num_valid, predictions
+
+    @staticmethod
+    def backward(ctx, grad_loss: torch.Tensor, grad_predictions: torch.Tensor):
+        grad_hidden, grad_weight = ctx.saved_tensors
+        grad_hidden = grad_hidden * grad_loss.to(grad_hidden.dtype) if grad_hidden is not None else None
+        grad_weight = (grad_weight * grad_loss).to(ctx.weight_dtype) if grad_weight is not None else None
+        return grad_hidden, grad_weight, None, None, None
+
+
+@torch.no_grad()
+def chunked_token_losses(hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, chunk_size: int) -> tuple[torch.Tensor, torch.Tensor]:
+    # Per-token (float32) cross-entropy and argmax, for evaluation. Same chunking as above, without any gradients.
+    losses, predictions = torch.empty(targets.shape, device=hidden.device, dtype=torch.float), torch.empty_like(targets)
+    for start in range(0, hidden.shape[0], chunk_size):
+        logits = F.linear(hidden[start:start+chunk_size], weight).float()
+        losses[start:start+chunk_size] = F.cross_entropy(logits, targets[start:start+chunk_size], reduction='none', ignore_index=loss_fn.ignore_index)
+        predictions[start:start+chunk_size] = logits.argmax(-1)
+    return losses, predictions
+
+
+class KVCache:
+    """ Per-block keys & attention values of the positions processed so far, for incremental decoding. Preallocated up to `capacity` positions."""
+    def __init__(self, num_blocks: int, key_padding: torch.Tensor | None = None, capacity: int | None = None):
+        self.capacity    = capacity or hyp['misc']['sequence_length']['max']
+        self.keys        = [None] * num_blocks
+        self.values      = [None] * num_blocks
+        self.length      = 0 # Positions before this are committed. Anything written past it is scratch space, which the next forward overwrites.
+        self.key_padding = None if key_padding is None else F.pad(key_padding, (0, self.capacity - key_padding.shape[1])) # (batch, capacity) bool, True for the left-padding of shorter prompts
+
+    def update(self, block_idx: int, start: int, key: torch.Tensor, value: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # Writes the keys & values of positions `start:end` and returns those of all positions up to `end`. Works with and without a heads dim.
+        end = start + key.shape[-2]
+        assert end <= self.capacity, f"KV cache capacity of {self.capacity} positions exceeded"
+        if self.keys[block_idx] is None:
+            self.keys[block_idx]   = key.new_empty(*key.shape[:-2], self.capacity, key.shape[-1])
+            self.values[block_idx] = value.new_empty(*value.shape[:-2], self.capacity, value.shape[-1])
+        self.keys[block_idx][..., start:end, :]   = key
+        self.values[block_idx][..., start:end, :] = value
+        return self.keys[block_idx][..., :end, :], self.values[block_idx][..., :end, :]
+
+    def select(self, batch_indices: torch.Tensor) -> None:
+        # Keeps only the given sequences, e.g. to drop finished ones from a running batch
+        self.keys   = [keys[batch_indices] for keys in self.keys]
+        self.values = [values[batch_indices] for values in self.values]
+        if self.key_padding is not None:
+            self.key_padding = self.key_padding[batch_indices]
+
+    def extend(self, other: 'KVCache') -> None:
+        # Appends the sequences of `other`, right-aligned so that they end at this cache's length and padded in front. Attention only
+        # depends on the distance between positions, so the keys & values stay valid when shifted. This lets new sequences join a running batch.
+        offset = self.length - other.length
+        assert offset >= 0 and other.capacity == self.capacity, "can only add sequences that are at most as long as the ones in the cache"
+        for buffers, other_buffers in ((self.keys, other.keys), (self.values, other.values)):
+            for block_idx, (buffer, other_buffer) in enumerate(zip(buffers, other_buffers)):
+                shifted = buffer.new_zeros(other_buffer.shape[0], *buffer.shape[1:])
+                shifted[..., offset:self.length, :] = other_buffer[..., :other.length, :]
+                buffers[block_idx] = torch.cat([buffer, shifted])
+
+        batchsize, other_batchsize = len(self.keys[0]) - len(other.keys[0]), len(other.keys[0])
+        key_padding       = self.key_padding if self.key_padding is not None else torch.zeros((batchsize, self.capacity), dtype=torch.bool, device=self.keys[0].device)
+        other_key_padding = torch.ones((other_batchsize, self.capacity), dtype=torch.bool, device=self.keys[0].device)
+        other_key_padding[:, offset:] = other.key_padding[:, :self.capacity-offset] if other.key_padding is not None else False
+        self.key_padding  = torch.cat([key_padding, other_key_padding])
+
+
 #############################################
 #            Network Definition             #
 #############################################
@@ -333,19 +583,84 @@ class SpeedyLangNet(nn.Module):
     def embed(self, x: torch.Tensor) -> torch.Tensor:
         return self.net_dict['embedding'](x)
 
-    def forward(
+    def hidden(
             self, 
             x: torch.Tensor,
             first_acting_token_idx: int | None = None,
             last_acting_token_idx: int | None = None,
-    ):
+            num_planning_sequences: int = 0,
+            segment_ids: torch.Tensor | None = None,
+    ) -> torch.Tensor:
+        # Everything up to (but excluding) the output layer. The 50k-vocab logits are by far the largest activation,
+        # so paths that only need some of them (e.g. `plan_top_k`) start from here.
+        # `segment_ids` (batch x length) are for packed sequences (see `BatchSampler`): tokens only attend within their own segment.
+        # The mask is built once per forward, and shared by all blocks. Padding (-1) is a segment of its own, so no row is ever fully masked.
+        segment_mask = None
+        if segment_ids is not None:
+            same_segment = segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)
+            segment_mask = torch.where(same_segment, 0., ctx.negative_infinity_matrix_base[:segment_ids.shape[1], :segment_ids.shape[1]])
+
         if x.dtype == torch.int64:
             x = self.embed(x)
         for attn_block in self.net_dict['attn_layers']:
-            x = attn_block(x, first_acting_token_idx, last_acting_token_idx)
+            x = attn_block(x, first_acting_token_idx, last_acting_token_idx, num_planning_sequences, segment_mask)
+        x = self.net_dict['norm'](x)
+        return x
+
+    def logits(self, hidden: torch.Tensor) -> torch.Tensor:
+        return self.net_dict['outputs'](hidden)
+
+    def cross_entropy(self, hidden: torch.Tensor, targets: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # Mean loss & argmax predictions over all tokens, straight from the hidden states, without materializing the (batch x length x vocab) logits
+        loss, predictions = ChunkedLinearCrossEntropy.apply(
+            hidden.flatten(0, -2), self.net_dict['outputs'].weight, targets.flatten(), hyp['misc']['loss_chunk_size'], loss_fn.ignore_index,
+        )
+        return loss, predictions.view(targets.shape)
+
+    def token_losses(self, hidden: torch.Tensor, targets: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # Per-token losses & argmax predictions (no gradients), in the shape of `targets`. Used by the evals to average over regions.
+        losses, predictions = chunked_token_losses(hidden.flatten(0, -2), self.net_dict['outputs'].weight, targets.flatten(), hyp['misc']['loss_chunk_size'])
+        return losses.view(targets.shape), predictions.view(targets.shape)
+
+    @torch.no_grad()
+    def decode(
+            self,
+            x: torch.Tensor,
+            kv_cache: KVCache,
+            first_acting_token_idx: int | None = None,
+            last_acting_token_idx: int | None = None,
+            commit: bool = True,
+    ) -> torch.Tensor:
+        # Hidden states of the new positions `x` (tokens or embeddings), which continue the ones in `kv_cache`. Same result as the matching
+        # rows of `hidden` over the whole sequence, at the cost of the new positions only. `commit=False` leaves the cache's length as it was,
+        # so the next call overwrites these positions again, e.g. for the speculative planning/acting spans in `generate_plan_act`.
+        start, end = kv_cache.length, kv_cache.length + x.shape[1]
+        position_bias, additive_mask = ctx.attention_bias_rows(start, end, first_acting_token_idx, last_acting_token_idx)
+        if kv_cache.key_padding is not None:
+            # Non-padding positions never attend to padding. Padding attends to (only) padding, so that no row is fully masked
+            key_padding   = kv_cache.key_padding[:, :end]
+            attends_pad   = key_padding.unsqueeze(1) & ~key_padding[:, start:end].unsqueeze(2)
+            additive_mask = torch.where(attends_pad, -float("inf"), additive_mask)
+
+        if x.dtype == torch.int64:
+            x = self.embed(x)
+        for block_idx, attn_block in enumerate(self.net_dict['attn_layers']):
+            x = attn_block.decode(x, kv_cache, block_idx, start, position_bias, additive_mask)
         x = self.net_dict['norm'](x)
-        x = self.net_dict['outputs'](x)
+
+        if commit:
+            kv_cache.length = end
         return x
+
+    def forward(
+            self, 
+            x: torch.Tensor,
+            first_acting_token_idx: int | None = None,
+            last_acting_token_idx: int | None = None,
+            num_planning_sequences: int = 0,
+            segment_ids: torch.Tensor | None = None,
+    ):
+        return self.logits(self.hidden(x, first_acting_token_idx, last_acting_token_idx, num_planning_sequences, segment_ids))
     
 
 def make_attn(settings: dict[str, Any]):
@@ -362,7 +677,7 @@ def make_net(settings: dict[str, Any]):
         'outputs': nn.Linear(settings['width'], total_num_tokens, bias=False),
     })
     net = SpeedyLangNet(network_dict)
-    net = net.to(hyp['misc']['device'], torch.bfloat16)
+    net = net.to(hyp['misc']['device'], hyp['misc']['dtype'])
     net.train()
 
     # Initialize the embedding and output matrixes, with weights scaled based upon the dimensionality of the network.
@@ -372,6 +687,34 @@ def make_net(settings: dict[str, Any]):
     return net
 
 
+def net_checkpoint(net: SpeedyLangNet, settings: dict[str, Any]) -> dict[str, Any]:
+    # The weights, plus everything that's needed to rebuild the network: the `make_net` settings, and the `hyp` entries that the blocks read when they're built
+    return {
+        'settings': {key: settings[key] for key in ('depth', 'width', 'linear_value', 'num_heads')},
+        'hyp_net': dict(hyp['net']),
+        'max_sequence_length': hyp['misc']['sequence_length']['max'],
+        'state_dict': net.state_dict(),
+    }
+
+
+def save_net(net: SpeedyLangNet, path: str, settings: dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(net_checkpoint(net, settings), path)
+
+
+def load_net(path: str) -> tuple[SpeedyLangNet, dict[str, Any]]:
+    # Rebuilds a network saved with `save_net` (or a training checkpoint) on the device & in the dtype set in `hyp['misc']`. Returns it together with its `make_net` settings.
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    hyp['net'].update(checkpoint['hyp_net'])
+    if checkpoint['max_sequence_length'] != hyp['misc']['sequence_length']['max']:
+        hyp['misc']['sequence_length']['max'] = checkpoint['max_sequence_length']
+        ctx.reset() # the position bias & masks are sized by the max sequence length
+
+    net = make_net(checkpoint['settings'])
+    net.load_state_dict(checkpoint['state_dict'])
+    return net, checkpoint['settings']
+
+
 ########################################
 #          Training Helpers            #
 ########################################
@@ -379,20 +722,239 @@ def make_net(settings: dict[str, Any]):
 # Get a single batch item. Currently used in the training loop
 @torch.no_grad()
 def get_batch(data_dict, key, batchsize, length):
-    start_indexes     = torch.randint(len(data_dict[key])-length-1, (batchsize,), device=hyp['misc']['device']) # warning, completely random sampling, not a random derangement, that might help performance a bit!
-    sequence_indexes  = start_indexes.unsqueeze(-1) + batch_index_offsets[:length].unsqueeze(0) # slice, as batch_index_offsets are pre-allocated to max length for efficiency
-    sampled_sequences = torch.take_along_dim(data_dict[key], sequence_indexes.flatten(), dim=0).view(batchsize, length).long() # have to flatten and reshape due to take_along_dim being 1d
+    start_indexes     = torch.randint(len(data_dict[key])-length-1, (batchsize,), device=hyp['misc']['device'], generator=ctx.data_generator) # warning, completely random sampling, not a random derangement, that might help performance a bit!
+    sequence_indexes  = start_indexes.unsqueeze(-1) + ctx.batch_index_offsets[:length].unsqueeze(0) # slice, as batch_index_offsets are pre-allocated to max length for efficiency
+    sampled_sequences = data_dict[key].take(sequence_indexes.flatten()).view(batchsize, length).long() # flat 1d gather, works for both plain token tensors and memory-mapped TokenShards
 
     return sampled_sequences
 
 
+def pack_documents(document_starts: torch.Tensor, num_tokens: int, length: int, seed: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Packs the documents of a token stream into windows of (at most) `length` tokens, so that no window holds a part of a document
+    # without its beginning. Documents that are longer than that are cut into full windows first, and what's left of them (as well as
+    # all shorter documents) is then packed best-fit, in random order: each piece goes into the fullest window that still has room for it.
+    # Returns the pieces (start & length in the token stream), and the range of pieces of every window: window i is made of the pieces
+    # `window_offsets[i]:window_offsets[i+1]`, in order. Whatever isn't covered by them is padding.
+    document_starts = torch.as_tensor(document_starts, dtype=torch.long)
+    if len(document_starts) == 0 or document_starts[0] != 0:
+        document_starts = torch.cat([torch.zeros(1, dtype=torch.long), document_starts]) # tokens before the first document count as one
+    document_lengths = torch.diff(document_starts, append=torch.tensor([num_tokens]))
+
+    # Full windows, one piece each
+    num_full   = document_lengths // length
+    full_first = torch.repeat_interleave(document_starts, num_full)
+    full_index = torch.arange(len(full_first)) - torch.repeat_interleave(torch.cumsum(num_full, 0) - num_full, num_full)
+    full_starts = full_first + full_index * length
+
+    # The remainders, best-fit. `free` is sorted by the space that's left in a window, `windows` holds the pieces of every window.
+    remainder_starts, remainder_lengths = document_starts + num_full * length, document_lengths % length
+    order = torch.randperm(len(document_starts), generator=torch.Generator().manual_seed(seed))
+    free, windows = [], []
+    for start, piece_length in zip(remainder_starts[order].tolist(), remainder_lengths[order].tolist()):
+        if piece_length == 0:
+            continue
+        slot = bisect.bisect_left(free, (piece_length, -1))
+        if slot < len(free):
+            space, window = free.pop(slot)
+        else:
+            space, window = length, len(windows)
+            windows.append([])
+        windows[window].append((start, piece_length))
+        bisect.insort(free, (space - piece_length, window))
+
+    packed = [piece for window in windows for piece in window]
+    piece_starts   = torch.cat([full_starts, torch.tensor([start for start, _ in packed], dtype=torch.long)])
+    piece_lengths  = torch.cat([torch.full_like(full_starts, length), torch.tensor([piece_length for _, piece_length in packed], dtype=torch.long)])
+    window_offsets = torch.cat([torch.arange(len(full_starts) + 1), len(full_starts) + torch.cumsum(torch.tensor([len(window) for window in windows], dtype=torch.long), 0)])
+    return piece_starts, piece_lengths, window_offsets
+
+
+class BatchSampler:
+    """ Samples the training batches from a deterministic stream of its own, and loads the next `num_prefetch` of them in the background."""
+    # The start indexes are drawn synchronously (that's cheap, and keeps the stream independent of timing), the gather from the
+    # memory-mapped shards and the copy to the device (from pinned memory, on a side stream) happen in a background thread while the
+    # current step runs. The batches are prefetched with the shape of the last request; a request with a different shape (when the
+    # sequence length grows) discards them and rewinds the stream, so the batches are exactly the same as without any prefetching.
+    #
+    # mode='random' samples every start index uniformly (with replacement), like `get_batch`. mode='permutation' goes through the
+    # data in epochs: every epoch cuts the token stream into windows of the current sequence length (at a random offset), and
+    # visits all of them once, in a random order. A new sequence length starts a new epoch. mode='packed' does the same with the windows
+    # of `pack_documents` (repacked every epoch), which needs the document starts that `prepare_data.py` records. Its batches come with
+    # segment ids: the index of the document piece every token belongs to, -1 for padding (see `SpeedyLangNet.hidden`).
+    def __init__(
+            self,
+            tokens: token_shards.TokenShards | torch.Tensor,
+            seed: int,
+            mode: Literal['random', 'permutation', 'packed'] = 'random',
+            num_prefetch: int = 2,
+            document_starts: torch.Tensor | None = None,
+    ):
+        self.tokens       = tokens
+        self.mode         = mode
+        self.num_prefetch = num_prefetch
+        self.document_starts = document_starts if document_starts is not None else getattr(tokens, 'document_starts', None)
+        if mode == 'packed' and self.document_starts is None:
+            raise ValueError(
+                "mode='packed' needs the document starts of the training data, which these token shards don't have. "
+                "Delete them and run `python prepare_data.py` to tokenize the data again."
+            )
+        if self.document_starts is not None:
+            self.document_starts = torch.as_tensor(self.document_starts, dtype=torch.long)
+        self.device       = torch.device(hyp['misc']['device'])
+        self.generator    = torch.Generator().manual_seed(seed)
+        self.stream       = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.executor     = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch_sampler')
+        self.pending      = collections.deque() # (shape, sampler state before drawing it, future) per prefetched batch
+
+        # Permutation state: the epoch's permutation of windows (and packing) is generated from `epoch_seed`, so that it can be restored from a checkpoint
+        self.epoch_seed, self.offset, self.position, self.window_length = None, 0, 0, None
+        self.permutation, self.packing = None, None
+
+    def state_dict(self) -> dict[str, Any]:
+        # As of the next batch that hasn't been handed out yet, prefetched ones don't count
+        return self.pending[0][1] if self.pending else self._state()
+
+    def load_state_dict(self, state: dict[str, Any]) -> None:
+        self._discard()
+        self._restore(state)
+
+    def next(self, batchsize: int, length: int) -> tuple[torch.Tensor, torch.Tensor | None]:
+        # Returns the batch, and its segment ids (only with mode='packed', None otherwise)
+        if self.pending and self.pending[0][0] != (batchsize, length):
+            self._discard()
+        if not self.pending:
+            self._submit(batchsize, length)
+        _, _, future = self.pending.popleft()
+        while len(self.pending) < self.num_prefetch:
+            self._submit(batchsize, length)
+
+        batch, segment_ids, ready = future.result()
+        if ready is not None:
+            torch.cuda.current_stream(self.device).wait_event(ready)
+            for tensor in (batch, segment_ids) if segment_ids is not None else (batch,):
+                tensor.record_stream(torch.cuda.current_stream(self.device)) # allocated on the side stream, used on this one
+        return batch, segment_ids
+
+    def close(self) -> None:
+        self._discard()
+        self.executor.shutdown(wait=True)
+
+    def _state(self) -> dict[str, Any]:
+        return {'rng': self.generator.get_state(), 'epoch_seed': self.epoch_seed, 'offset': self.offset, 'position': self.position, 'window_length': self.window_length}
+
+    def _restore(self, state: dict[str, Any]) -> None:
+        self.generator.set_state(state['rng'])
+        self.offset, self.position = state['offset'], state['position']
+        if state['epoch_seed'] is not None:
+            self._start_epoch(state['window_length'], state['epoch_seed'])
+        else:
+            self.epoch_seed, self.window_length, self.permutation, self.packing = None, None, None, None
+
+    def _discard(self) -> None:
+        # Drop the prefetched batches and rewind to before the first of them
+        if self.pending:
+            for _, _, future in self.pending:
+                future.cancel()
+            self._restore(self.pending[0][1])
+            self.pending.clear()
+
+    def _submit(self, batchsize: int, length: int) -> None:
+        state  = self._state()
+        starts = self._draw_starts(batchsize, length)
+        self.pending.append(((batchsize, length), state, self.executor.submit(self._load, starts, length, self.packing)))
+
+    def _start_epoch(self, length: int, epoch_seed: int | None = None) -> None:
+        if epoch_seed is None:
+            epoch_seed  = int(torch.randint(2**62, (), generator=self.generator))
+            self.offset = int(torch.randint(length, (), generator=self.generator)) if self.mode == 'permutation' else 0
+            self.position = 0
+        if self.mode == 'packed':
+            self.packing = pack_documents(self.document_starts, len(self.tokens), length, epoch_seed)
+            num_windows  = len(self.packing[2]) - 1
+        else:
+            num_windows  = (len(self.tokens) - self.offset - 1) // length # -1: the last window still needs one more token
+        self.epoch_seed, self.window_length = epoch_seed, length
+        self.permutation = torch.randperm(num_windows, generator=torch.Generator().manual_seed(epoch_seed))
+
+    def _draw_starts(self, batchsize: int, length: int) -> torch.Tensor:
+        if self.mode == 'random':
+            return torch.randint(len(self.tokens)-length-1, (batchsize,), generator=self.generator)
+
+        starts = []
+        while batchsize > 0:
+            if self.window_length != length or self.position >= len(self.permutation):
+                self._start_epoch(length)
+            windows = self.permutation[self.position:self.position+batchsize]
+            starts.append(windows if self.mode == 'packed' else self.offset + windows * length) # packed windows are looked up in `_load`
+            self.position += len(windows)
+            batchsize     -= len(windows)
+        return torch.cat(starts)
+
+    @torch.no_grad()
+    def _load(
+            self, starts: torch.Tensor, length: int, packing: tuple[torch.Tensor, torch.Tensor, torch.Tensor] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor | None, torch.cuda.Event | None]:
+        # Runs in the background thread
+        if packing is None:
+            batch, segment_ids = self.tokens.take(starts.unsqueeze(-1) + torch.arange(length)).long(), None
+        else:
+            batch, segment_ids = self._gather_packed(starts, length, *packing)
+
+        if self.stream is None:
+            return batch.to(self.device), segment_ids if segment_ids is None else segment_ids.to(self.device), None
+        with torch.cuda.stream(self.stream):
+            batch = batch.pin_memory().to(self.device, non_blocking=True)
+            if segment_ids is not None:
+                segment_ids = segment_ids.pin_memory().to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, segment_ids, ready
+
+    def _gather_packed(
+            self, windows: torch.Tensor, length: int, piece_starts: torch.Tensor, piece_lengths: torch.Tensor, window_offsets: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        # One flat gather for all pieces of all windows: every piece is written to its place in its row, the rest is padding
+        def ranks_within(counts: torch.Tensor) -> torch.Tensor:
+            # 0..count-1 for every group of `counts`, concatenated
+            return torch.arange(int(counts.sum())) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+
+        num_pieces = window_offsets[windows + 1] - window_offsets[windows]
+        segments   = ranks_within(num_pieces) # the index of every piece within its window
+        pieces     = torch.repeat_interleave(window_offsets[windows], num_pieces) + segments
+        rows       = torch.repeat_interleave(torch.arange(len(windows)), num_pieces)
+        lengths    = piece_lengths[pieces]
+        ends       = torch.cumsum(lengths, 0)
+        columns    = ends - lengths - (ends - lengths)[torch.repeat_interleave(torch.cumsum(num_pieces, 0) - num_pieces, num_pieces)] # piece offsets within their rows
+
+        token_pieces  = torch.repeat_interleave(torch.arange(len(pieces)), lengths)
+        token_offsets = ranks_within(lengths)
+        token_rows, token_columns = rows[token_pieces], columns[token_pieces] + token_offsets
+
+        batch       = torch.zeros(len(windows), length, dtype=torch.long)
+        segment_ids = torch.full((len(windows), length), -1, dtype=torch.long)
+        batch[token_rows, token_columns]       = self.tokens.take(piece_starts[pieces][token_pieces] + token_offsets).long()
+        segment_ids[token_rows, token_columns] = segments[token_pieces]
+        return batch, segment_ids
+
+
+@torch.no_grad()
+def mark_segments(inputs: torch.Tensor, targets: torch.Tensor, segment_ids: torch.Tensor | None, start_token: int) -> None:
+    # Packed sequences: every segment starts on the special token (like the sequence itself), instead of on the last token of the
+    # segment before it, and the padding isn't trained on. In-place, before any span masking, which takes precedence.
+    if segment_ids is None:
+        return
+    inputs[segment_ids != segment_ids.roll(1, dims=-1)] = start_token
+    targets[segment_ids < 0] = loss_fn.ignore_index
+
+
 @torch.no_grad()
-def get_causal_data(sequence: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+def get_causal_data(sequence: torch.Tensor, segment_ids: torch.Tensor | None = None) -> tuple[torch.Tensor, torch.Tensor]:
     targets  = torch.empty_like(sequence).copy_(sequence)
 
     # Inputs: add special token to beginning
     # Just roll the tensor and replace the first (previously final) token to get the causality going
     inputs = sequence.roll(1, dims=-1)
+    mark_segments(inputs, targets, segment_ids, hyp['misc']['causal_token'])
     inputs[:, 0] = hyp['misc']['causal_token']
 
     return inputs, targets
@@ -402,6 +964,7 @@ def get_causal_data(sequence: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]
 def get_planning_data(
         sequence: torch.Tensor,
         first_acting_token_idx: int,
+        segment_ids: torch.Tensor | None = None,
 ) -> tuple[torch.Tensor, torch.Tensor]:
     targets = torch.zeros_like(
         sequence, 
@@ -410,6 +973,7 @@ def get_planning_data(
     ).copy_(sequence)  # copy sequence to not have negative downstream effects
 
     inputs = sequence.roll(1, dims=-1)
+    mark_segments(inputs, targets, segment_ids, hyp['misc']['planning_token'])
     inputs [:, first_acting_token_idx:] = hyp['misc']['mask_token']
     inputs[:, 0] = hyp['misc']['planning_token']
 
@@ -417,14 +981,13 @@ def get_planning_data(
 
 
 @torch.no_grad()
-def get_acting_data(
-        net: SpeedyLangNet,
+def get_acting_tokens(
         sequence: torch.Tensor,
-        planning_output: torch.Tensor,
         first_acting_token_idx: int,
         last_acting_token_idx: int,
-        top_k: int = 5,
+        segment_ids: torch.Tensor | None = None,
 ) -> tuple[torch.Tensor, torch.Tensor]:
+    # The token part of the acting data; the planning span (`last_acting_token_idx:`) is overwritten by the recombined plan after embedding
     targets = torch.zeros_like(
         sequence, 
         device=hyp['misc']['device'], 
@@ -432,25 +995,66 @@ def get_acting_data(
     ).copy_(sequence)
 
     inputs = sequence.roll(1, dims=-1)
+    mark_segments(inputs, targets, segment_ids, hyp['misc']['acting_token'])
     inputs[:, first_acting_token_idx:last_acting_token_idx] = hyp['misc']['acting_token']
     inputs[:, 0] = hyp['misc']['acting_token']
+
+    return inputs, targets
+
+
+@torch.no_grad()
+def get_acting_data(
+        net: SpeedyLangNet,
+        sequence: torch.Tensor,
+        planning_hidden: torch.Tensor,
+        first_acting_token_idx: int,
+        last_acting_token_idx: int,
+        top_k: int = 5,
+        segment_ids: torch.Tensor | None = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    # `planning_hidden` are the planning pass' hidden states (`net.hidden`), only the planning span's logits are ever computed from them
+    inputs, targets = get_acting_tokens(sequence, first_acting_token_idx, last_acting_token_idx, segment_ids)
     inputs = net.embed(inputs)
-    inputs[:, last_acting_token_idx:] = recombine_outputs(net, planning_output[:, last_acting_token_idx:], top_k)
+    inputs[:, last_acting_token_idx:] = recombine_outputs(net, planning_hidden[:, last_acting_token_idx:], top_k)
 
     return inputs, targets
 
 
 @torch.no_grad()
-def recombine_outputs(net: SpeedyLangNet, planning_output: torch.Tensor, top_k: int) -> torch.Tensor:
-    planning_output.grad = None
-    values, indices = torch.topk(planning_output, k=top_k, dim=-1)
+def plan_top_k(net: SpeedyLangNet, planning_hidden: torch.Tensor, top_k: int) -> tuple[torch.Tensor, torch.Tensor]:
+    # Top-k of the planning logits, streamed through the output layer in vocab chunks: only a (batch x span x chunk) slice of logits
+    # is alive at any time, and each chunk's top-k is merged into the running top-k.
+    output_weight    = net.net_dict['outputs'].weight
+    vocab_chunk_size = hyp['misc']['vocab_chunk_size']
+
+    values, indices = None, None
+    for chunk_start in range(0, output_weight.shape[0], vocab_chunk_size):
+        chunk_logits = F.linear(planning_hidden, output_weight[chunk_start:chunk_start+vocab_chunk_size])
+        chunk_values, chunk_indices = torch.topk(chunk_logits, k=min(top_k, chunk_logits.shape[-1]), dim=-1)
+        chunk_indices += chunk_start
+        if values is not None:
+            chunk_values, chunk_indices = torch.cat([values, chunk_values], dim=-1), torch.cat([indices, chunk_indices], dim=-1)
+            chunk_values, selected = torch.topk(chunk_values, k=min(top_k, chunk_values.shape[-1]), dim=-1)
+            chunk_indices = chunk_indices.gather(-1, selected)
+        values, indices = chunk_values, chunk_indices
+
     normalized_values = values / values.sum(dim=-1, keepdim=True)
+    return normalized_values, indices
+
+
+@torch.no_grad()
+def embed_plan(net: SpeedyLangNet, normalized_values: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
     embedded = net.embed(indices)
     weighted = embedded * normalized_values.unsqueeze(-1)
     result = weighted.sum(dim=-2)
     return result
 
 
+@torch.no_grad()
+def recombine_outputs(net: SpeedyLangNet, planning_hidden: torch.Tensor, top_k: int) -> torch.Tensor:
+    return embed_plan(net, *plan_top_k(net, planning_hidden, top_k))
+
+
 def randomize_masking_rate(mean: float, concentration: int = 8) -> float:
     alpha = mean * concentration
     beta = (1 - mean) * concentration
@@ -471,6 +1075,310 @@ def get_first_and_last_acting_token_idx(seq_len: int, planning_rate: float, acti
 loss_fn = nn.CrossEntropyLoss(reduction='mean', ignore_index=-1)
 
 
+def sample_acting_span(settings: dict[str, Any], curr_length: int) -> tuple[int, int]:
+    planner_masking_rate = settings['planner_masking_rate']
+    actor_masking_rate = settings['actor_masking_rate']
+
+    if settings['randomize_masking_rate']:
+        planner_masking_rate = randomize_masking_rate(planner_masking_rate)
+        actor_masking_rate = randomize_masking_rate(actor_masking_rate)
+    actor_masking_rate = min(actor_masking_rate, planner_masking_rate - (1.1/curr_length))  # at least 1 token less than the planner
+
+    return get_first_and_last_acting_token_idx(
+        seq_len=curr_length,
+        planning_rate=planner_masking_rate,
+        acting_rate=actor_masking_rate,
+    )
+
+
+def plan_act_sequential(
+        net: SpeedyLangNet,
+        sequence: torch.Tensor,
+        first_acting_token_idx: int,
+        last_acting_token_idx: int,
+        settings: dict[str, Any],
+        segment_ids: torch.Tensor | None = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Plans, then acts on the same sequences: two forward passes per microbatch. Returns the loss, and the acting predictions & targets.
+    inputs, targets = get_planning_data(sequence, first_acting_token_idx=first_acting_token_idx, segment_ids=segment_ids)
+    hidden = net.hidden(inputs, segment_ids=segment_ids)
+    loss_planning, _ = net.cross_entropy(hidden, targets)
+    loss_planning = loss_planning / settings["planning_divider"]
+
+    inputs, targets = get_acting_data(
+        net, sequence, hidden.detach(),
+        first_acting_token_idx=first_acting_token_idx,
+        last_acting_token_idx=last_acting_token_idx,
+        top_k=settings['top_k'],
+        segment_ids=segment_ids,
+    )
+    hidden = net.hidden(
+        inputs, 
+        first_acting_token_idx=first_acting_token_idx,
+        last_acting_token_idx=last_acting_token_idx,
+        segment_ids=segment_ids,
+    )
+    loss_acting, predictions = net.cross_entropy(hidden, targets)
+    loss_acting = loss_acting / settings["acting_divider"]
+
+    return loss_planning + loss_acting, predictions, targets
+
+
+def plan_act_pipelined(
+        net: SpeedyLangNet,
+        sequence: torch.Tensor,
+        first_acting_token_idx: int,
+        last_acting_token_idx: int,
+        settings: dict[str, Any],
+        carry: dict[str, Any] | None,
+        segment_ids: torch.Tensor | None = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict[str, Any]]:
+    # Software-pipelined plan-act: one forward pass per microbatch, which plans the new `sequence` and, batched with that,
+    # acts on the sequences that were planned in the previous microbatch (`carry`). Same number of sequence-passes as `plan_act_sequential`,
+    # but in half the (twice as large) forward calls, which keeps the device busier for small models and short sequences.
+    # The only difference in the math is that the plan for the acting half is one microbatch old -- which across an optimizer step means
+    # it was made with the weights from before that step. The plan is re-embedded with the current weights, though.
+    planning_inputs, planning_targets = get_planning_data(sequence, first_acting_token_idx=first_acting_token_idx, segment_ids=segment_ids)
+    num_planning_sequences = len(planning_inputs)
+
+    if carry is not None and carry['inputs'].shape[1] != sequence.shape[1]:
+        carry = None # The sequence length grew, so the planned sequences don't fit into this batch anymore. Dropped, it's once per growth step.
+
+    if carry is None:
+        hidden = net.hidden(planning_inputs, segment_ids=segment_ids)
+        loss, predictions = net.cross_entropy(hidden, planning_targets)
+        loss = loss / settings["planning_divider"]
+        targets = planning_targets
+    else:
+        with torch.no_grad():
+            acting_inputs = net.embed(carry['inputs'])
+            acting_inputs[:, carry['last_acting_token_idx']:] = embed_plan(net, carry['plan_values'], carry['plan_indices'])
+
+        hidden = net.hidden(
+            torch.cat([net.embed(planning_inputs), acting_inputs]),
+            first_acting_token_idx=carry['first_acting_token_idx'],
+            last_acting_token_idx=carry['last_acting_token_idx'],
+            num_planning_sequences=num_planning_sequences,
+            segment_ids=None if segment_ids is None else torch.cat([segment_ids, carry['segment_ids']]),
+        )
+        targets = carry['targets']
+        loss_planning, _           = net.cross_entropy(hidden[:num_planning_sequences], planning_targets)
+        loss_acting, predictions   = net.cross_entropy(hidden[num_planning_sequences:], targets)
+        loss = loss_planning / settings["planning_divider"] + loss_acting / settings["acting_divider"]
+
+    # Only the top-k of the plan is carried over to the next microbatch, not the full logits
+    acting_tokens, acting_targets = get_acting_tokens(sequence, first_acting_token_idx, last_acting_token_idx, segment_ids)
+    plan_values, plan_indices = plan_top_k(net, hidden[:num_planning_sequences, last_acting_token_idx:].detach(), settings['top_k'])
+    carry = {
+        'inputs': acting_tokens, 'targets': acting_targets,
+        'plan_values': plan_values, 'plan_indices': plan_indices,
+        'first_acting_token_idx': first_acting_token_idx, 'last_acting_token_idx': last_acting_token_idx,
+        'segment_ids': segment_ids,
+    }
+
+    return loss, predictions, targets, carry
+
+
+def forward_backward(
+        net: SpeedyLangNet,
+        sequence: torch.Tensor,
+        settings: dict[str, Any],
+        plan_act_carry: dict[str, Any] | None = None,
+        num_microbatches: int = 1,
+        segment_ids: torch.Tensor | None = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict[str, Any] | None]:
+    # One training microbatch: the causal or plan-act forward pass(es), and the backward pass of the loss (averaged over `num_microbatches`).
+    # Returns the loss, the predictions & targets, and the carry of the pipelined plan-act schedule. `segment_ids` are for packed sequences.
+    if settings['plan_act']:
+        first_acting_token_idx, last_acting_token_idx = sample_acting_span(settings, sequence.shape[1])
+
+        if settings['plan_act_schedule'] == 'pipelined':
+            loss, predictions, targets, plan_act_carry = plan_act_pipelined(
+                net, sequence, first_acting_token_idx, last_acting_token_idx, settings, plan_act_carry, segment_ids,
+            )
+        else:
+            loss, predictions, targets = plan_act_sequential(net, sequence, first_acting_token_idx, last_acting_token_idx, settings, segment_ids)
+    else:
+        inputs, targets = get_causal_data(sequence, segment_ids)
+        loss, predictions = net.cross_entropy(net.hidden(inputs, segment_ids=segment_ids), targets)
+
+    loss.div(num_microbatches).backward()
+    return loss, predictions, targets, plan_act_carry
+
+
+########################################
+#              Generation              #
+########################################
+
+# Autoregressive sampling with a KV cache (see `KVCache` & `SpeedyLangNet.decode`), so every new token only costs a forward over itself.
+# Prompts are lists of token ids, batched by left-padding them to the same length. The linear position bias only depends on the
+# distance between tokens, so the padding doesn't change anything but the masks.
+
+@torch.no_grad()
+def sample_from_logits(
+        logits: torch.Tensor,
+        temperature: float = 1.,
+        top_k: int | None = None,
+        top_p: float | None = None,
+        generator: torch.Generator | None = None,
+) -> torch.Tensor:
+    # temperature 0 is greedy decoding. top-k and top-p (nucleus) filtering can be combined.
+    logits = logits[..., :hyp['misc']['num_tokens']].float() # never sample the special tokens
+    if temperature == 0.:
+        return logits.argmax(-1)
+
+    logits = logits / temperature
+    if top_k is not None:
+        kth_largest = torch.topk(logits, k=min(top_k, logits.shape[-1]), dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_largest, -float("inf"))
+    if top_p is not None and top_p < 1.:
+        sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+        sorted_probs = sorted_logits.softmax(-1)
+        outside_nucleus = sorted_probs.cumsum(-1) - sorted_probs > top_p # always keeps the most likely token
+        logits = logits.scatter(-1, sorted_indices, sorted_logits.masked_fill(outside_nucleus, -float("inf")))
+
+    probs = logits.softmax(-1)
+    return torch.multinomial(probs.flatten(0, -2), 1, generator=generator).view(probs.shape[:-1])
+
+
+@torch.no_grad()
+def pad_prompts(prompts: list[list[int]], start_token: int) -> tuple[torch.Tensor, torch.Tensor | None]:
+    # Left-pads the prompts (each prefixed with `start_token`, like in training) to the same length. Returns the inputs, and the padding mask (None if there's no padding)
+    length  = 1 + max(len(prompt) for prompt in prompts)
+    inputs  = torch.full((len(prompts), length), start_token, dtype=torch.long)
+    padding = torch.zeros((len(prompts), length), dtype=torch.bool)
+    for i, prompt in enumerate(prompts):
+        inputs[i, length-len(prompt):] = torch.tensor(prompt, dtype=torch.long)
+        padding[i, :length-len(prompt)-1] = True
+    return inputs.to(hyp['misc']['device']), padding.to(hyp['misc']['device']) if padding.any() else None
+
+
+class CausalDecoder:
+    """ Incremental next-token decoding state of a batch of sequences. `propose` samples the next token of every sequence, `commit` appends tokens to them."""
+    lookahead = 0 # positions past the committed ones that `propose` needs
+
+    @torch.no_grad()
+    def __init__(self, net: SpeedyLangNet, prompts: list[list[int]]):
+        self.net = net
+        inputs, key_padding = pad_prompts(prompts, hyp['misc']['causal_token'])
+        self.kv_cache    = KVCache(len(net.net_dict['attn_layers']), key_padding)
+        self.next_hidden = net.decode(inputs, self.kv_cache)[:, -1:] # predicts the next token
+
+    @property
+    def length(self) -> int:
+        return self.kv_cache.length
+
+    def fits(self, max_new_tokens: int) -> bool:
+        # The last new token is only sampled, never committed
+        return self.length + max_new_tokens - 1 + self.lookahead <= self.kv_cache.capacity
+
+    @torch.no_grad()
+    def propose(self, sample: Callable[[torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        return sample(self.net.logits(self.next_hidden))
+
+    @torch.no_grad()
+    def commit(self, tokens: torch.Tensor) -> None:
+        self.next_hidden = self.net.decode(tokens, self.kv_cache)[:, -1:]
+
+    def select(self, batch_indices: torch.Tensor) -> None:
+        self.kv_cache.select(batch_indices)
+        self.next_hidden = self.next_hidden[batch_indices]
+
+    def extend(self, other: 'CausalDecoder') -> None:
+        # Adds the sequences of another decoder to this batch. They mustn't be longer than this batch's sequences (see `KVCache.extend`).
+        self.kv_cache.extend(other.kv_cache)
+        self.next_hidden = torch.cat([self.next_hidden, other.next_hidden])
+
+
+class PlanActDecoder(CausalDecoder):
+    """ Decoding the way the model is trained in plan-act mode. Every `propose` first plans the next `planning_length` tokens (one planning forward),
+    and then acts on that plan (one acting forward), which fills in the first `acting_length` of them, conditioned on the (recombined top-k) plan
+    for the rest. The acting forward's causal prediction of the next token comes along with the acting span, so every round proposes
+    `acting_length + 1` tokens. Planning & acting passes start with different special tokens, so they each have their own cache."""
+    @torch.no_grad()
+    def __init__(self, net: SpeedyLangNet, prompts: list[list[int]], planning_length: int, acting_length: int, planning_top_k: int = 5):
+        assert 0 < acting_length < planning_length, "the acting span has to be shorter than the planning span"
+        self.net             = net
+        self.planning_length = planning_length
+        self.acting_length   = acting_length
+        self.planning_top_k  = planning_top_k
+        self.lookahead       = planning_length
+
+        planning_inputs, key_padding = pad_prompts(prompts, hyp['misc']['planning_token'])
+        acting_inputs, _             = pad_prompts(prompts, hyp['misc']['acting_token'])
+        self.planning_cache = KVCache(len(net.net_dict['attn_layers']), key_padding)
+        self.kv_cache       = KVCache(len(net.net_dict['attn_layers']), key_padding) # the acting cache
+        net.decode(planning_inputs, self.planning_cache)
+        self.next_hidden    = net.decode(acting_inputs, self.kv_cache)[:, -1:]
+
+    @torch.no_grad()
+    def propose(self, sample: Callable[[torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        # The spans continue the (committed) context: the planning span is [first, first+planning_length), and the acting span is [first, last).
+        # That's the same layout as in training, so the masks & the plan recombination are the same too. Neither span is committed to the caches.
+        batchsize              = len(self.next_hidden)
+        first_acting_token_idx = self.length
+        last_acting_token_idx  = first_acting_token_idx + self.acting_length
+
+        planning_hidden = self.net.decode(
+            torch.full((batchsize, self.planning_length), hyp['misc']['mask_token'], device=hyp['misc']['device']), self.planning_cache, commit=False,
+        )
+        acting_inputs = torch.cat([
+            self.net.embed(torch.full((batchsize, self.acting_length), hyp['misc']['acting_token'], device=hyp['misc']['device'])),
+            recombine_outputs(self.net, planning_hidden[:, self.acting_length:], self.planning_top_k),
+        ], dim=1)
+        acting_hidden = self.net.decode(acting_inputs, self.kv_cache, first_acting_token_idx, last_acting_token_idx, commit=False)
+
+        return sample(self.net.logits(torch.cat([self.next_hidden, acting_hidden[:, :self.acting_length]], dim=1)))
+
+    @torch.no_grad()
+    def commit(self, tokens: torch.Tensor) -> None:
+        # Overwrites the spans' scratch positions in both caches
+        self.net.decode(tokens, self.planning_cache)
+        super().commit(tokens)
+
+    def select(self, batch_indices: torch.Tensor) -> None:
+        self.planning_cache.select(batch_indices)
+        super().select(batch_indices)
+
+    def extend(self, other: 'PlanActDecoder') -> None:
+        assert (other.planning_length, other.acting_length, other.planning_top_k) == (self.planning_length, self.acting_length, self.planning_top_k)
+        self.planning_cache.extend(other.planning_cache)
+        super().extend(other)
+
+
+@torch.no_grad()
+def generate(decoder: CausalDecoder, max_new_tokens: int, **sampling_settings) -> torch.Tensor:
+    # Returns the (batch x max_new_tokens) new tokens. See `sample_from_logits` for the sampling settings.
+    assert decoder.fits(max_new_tokens), "prompt + new tokens (+ planning span) are longer than the max sequence length"
+    sample    = partial(sample_from_logits, **sampling_settings)
+    generated = []
+    num_generated = 0
+    while True:
+        generated.append(decoder.propose(sample))
+        num_generated += generated[-1].shape[1]
+        if num_generated >= max_new_tokens:
+            break
+        decoder.commit(generated[-1])
+
+    return torch.cat(generated, dim=1)[:, :max_new_tokens]
+
+
+def generate_causal(net: SpeedyLangNet, prompts: list[list[int]], max_new_tokens: int, **sampling_settings) -> torch.Tensor:
+    return generate(CausalDecoder(net, prompts), max_new_tokens, **sampling_settings)
+
+
+def generate_plan_act(
+        net: SpeedyLangNet,
+        prompts: list[list[int]],
+        max_new_tokens: int,
+        planning_length: int,
+        acting_length: int,
+        planning_top_k: int = 5,
+        **sampling_settings,
+) -> torch.Tensor:
+    return generate(PlanActDecoder(net, prompts, planning_length, acting_length, planning_top_k), max_new_tokens, **sampling_settings)
+
+
 ##############################
 #        Scheduling          #
 ##############################
@@ -515,27 +1423,340 @@ def init_param_groups_dict(net, base_lr):
     return param_groups
 
 
-def get_grad_norm(net):
-    # Gets the entire grad norm of the network.
+def is_cuda_device(device: str | torch.device | None = None) -> bool:
+    return torch.device(device or hyp['misc']['device']).type == 'cuda'
+
+
+def synchronize(device: str | torch.device | None = None) -> None:
+    # Waits for all queued work on the device. A no-op on cpu, where everything runs synchronously anyways.
+    device = torch.device(device or hyp['misc']['device'])
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+
+class Timer:
+    """ Portable timer for the training loop: cuda events on cuda (no extra syncs while running), wall-clock time elsewhere."""
+    def __init__(self, device: str | torch.device | None = None):
+        self.device   = torch.device(device or hyp['misc']['device'])
+        self.use_cuda = self.device.type == 'cuda'
+        if self.use_cuda:
+            self.starter, self.ender = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+
+    def start(self) -> None:
+        synchronize(self.device)
+        if self.use_cuda:
+            self.starter.record()
+        else:
+            self.start_time = time.perf_counter()
+
+    def stop(self) -> float:
+        # Returns the elapsed seconds since the last `start`
+        if self.use_cuda:
+            self.ender.record()
+            synchronize(self.device)
+            return 1e-3 * self.starter.elapsed_time(self.ender)
+        synchronize(self.device)
+        return time.perf_counter() - self.start_time
+
+
+def get_grad_norm(net) -> torch.Tensor:
+    # Gets the entire grad norm of the network. As a (0d float32) tensor on the device, so that it can be read back together with other metrics.
     grad_norm = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float64)
     for p in net.parameters():
         if p.grad is not None:
             param_norm = p.grad.detach().data.norm(2)
             grad_norm += param_norm.square()
-    grad_norm = (grad_norm ** 0.5).item()
-    return grad_norm
+    return (grad_norm ** 0.5).float()
 
 
-def grow_sequence_length(old_length, old_batchsize):
-    # Dynamically grows the sequence length and changes the batchsize to avoid OOMs
+def grow_sequence_length(old_length, old_batchsize, batchsize_table: dict[int, int] | None = None):
+    # Dynamically grows the sequence length and changes the batchsize to avoid OOMs (from the autotuned table, if there is one)
     new_length        = min(2*old_length, hyp['misc']['sequence_length']['max'])
-    new_batchsize     = tokens_per_batch_capacity // new_length
+    new_batchsize     = batchsize_table[new_length] if batchsize_table else tokens_per_batch_capacity // new_length
 
     print(f"| increasing sequence length (old: {old_length}, new: {new_length}), adjusting batchsize as necessary to fit (old: {old_batchsize}, new: {new_batchsize})")
 
     return new_length, new_batchsize
 
 
+##############################
+#       Checkpointing        #
+##############################
+
+# Training checkpoints hold everything that's needed to pick a run up exactly where it left off: the network (in the `save_net` format,
+# so `load_net` & serve.py can read them too), the optimizer & scheduler states, the RNG states, and the state of the dynamic
+# batchsize/sequence length schedulers & the logged history. They're snapshotted on the training thread (device->host copies, which are
+# only queued on cuda), and then written to disk from a background thread. Files are replaced atomically, a crash mid-write keeps the previous one.
+
+def get_rng_states() -> dict[str, Any]:
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'python': random.getstate(),
+    }
+
+
+def set_rng_states(rng_states: dict[str, Any]) -> None:
+    torch.set_rng_state(rng_states['torch'])
+    if rng_states['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states['cuda'])
+    random.setstate(rng_states['python'])
+
+
+def snapshot(state: Any) -> Any:
+    # Copies all tensors in a nested state (and the containers around them) to the cpu. Copies from cuda go to pinned memory, non-blocking,
+    # so they're only queued here. They're stream-ordered before any later in-place updates (e.g. `opt.step()`), so they see the current values.
+    if isinstance(state, torch.Tensor):
+        if state.device.type == 'cpu':
+            return state.detach().clone()
+        copy = torch.empty(state.shape, dtype=state.dtype, pin_memory=state.is_cuda)
+        return copy.copy_(state.detach(), non_blocking=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class AsyncCheckpointWriter:
+    """ Writes checkpoints from a background thread. At most one write is in flight, which bounds the extra host memory to one snapshot."""
+    def __init__(self):
+        self.thread = None
+        self.error  = None
+
+    def save(self, state: dict[str, Any], path: str) -> None:
+        self.wait()
+        state = snapshot(state)
+        copies_done = None
+        if is_cuda_device():
+            copies_done = torch.cuda.Event()
+            copies_done.record()
+        self.thread = threading.Thread(target=self._write, args=(state, path, copies_done))
+        self.thread.start()
+
+    def _write(self, state: dict[str, Any], path: str, copies_done: Any) -> None:
+        try:
+            if copies_done is not None:
+                copies_done.synchronize()
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self) -> None:
+        # Blocks until the last checkpoint is on disk, and re-raises any error from writing it
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def optimizer_state_dict(opt: torch.optim.Optimizer) -> dict[str, Any]:
+    # The param groups carry their lr lambdas along (see `init_param_groups_dict`), which can't be pickled. The scheduler has its own copy.
+    state_dict = opt.state_dict()
+    state_dict['param_groups'] = [{key: value for key, value in group.items() if key != 'scheduler'} for group in state_dict['param_groups']]
+    return state_dict
+
+
+##############################
+#        Distributed         #
+##############################
+
+# Data-parallel training over several processes, launched with e.g. `torchrun --nproc_per_node 2 main.py ...` (the gloo backend works on cpu).
+# Every rank samples its own batches (from its own `BatchSampler` stream) and evaluates its own share of the eval set, and the gradients are averaged across ranks before each optimizer step.
+# All the other random & dynamic decisions (dithered microbatch steps, randomized masking rates, sequence length growth, weight decay, stopping)
+# are made from state that is identical on all ranks: the global RNGs are seeded the same everywhere, and the grad norm, loss & time they
+# depend on are all-reduced. So the ranks never disagree on the batch shape, the number of microbatches, or when to stop.
+# We reduce the gradients by hand instead of wrapping the net in DDP, as DDP only hooks into `forward`, and we go through `hidden` & `cross_entropy`.
+
+GRAD_BUCKET_NUMEL = 2**24 # Gradients are all-reduced in flat buckets of about this many elements
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: str | None = None) -> None:
+    # Sets up the process group from the torchrun environment variables, and picks this rank's device. Only the main process prints.
+    global print
+    device = torch.device(hyp['misc']['device'])
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+        hyp['misc']['device'] = str(device)
+    dist.init_process_group(backend=backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+    if not is_main_process():
+        print = lambda *args, **kwargs: None
+
+
+@torch.no_grad()
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+@torch.no_grad()
+def all_reduce_gradients(net: nn.Module, bucket_numel: int = GRAD_BUCKET_NUMEL) -> None:
+    # Averages the gradients across ranks. Small gradients are flattened into shared buckets, so that there are only a few (large) all-reduces.
+    grads, bucket, numel = [p.grad for p in net.parameters() if p.grad is not None], [], 0
+    for i, grad in enumerate(grads):
+        bucket.append(grad)
+        numel += grad.numel()
+        if numel >= bucket_numel or i == len(grads) - 1:
+            flat = torch.cat([g.flatten() for g in bucket])
+            dist.all_reduce(flat)
+            flat /= get_world_size()
+            for g, reduced in zip(bucket, flat.split([g.numel() for g in bucket])):
+                g.copy_(reduced.view_as(g))
+            bucket, numel = [], 0
+
+
+def all_gather_object(obj: Any) -> list[Any]:
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+##############################
+#    Batchsize Autotuning    #
+##############################
+
+# `tokens_per_batch_capacity` is a fit for 40 GB A100s, so on other hardware, runs either OOM or leave memory unused.
+# With `autotune_batchsize`, `train` instead measures the memory of one training microbatch (the exact forward & backward,
+# incl. both plan-act passes) at every sequence length that `grow_sequence_length` visits, and picks the largest batchsize per
+# length that fits into the memory budget. Memory is linear in the batchsize, so two small probes per length are enough:
+# peak(batchsize) = fixed + batchsize * per_sequence. On cuda, the probes read the caching allocator's peak. Elsewhere (e.g. for
+# testing on cpu), they add up the tensors that autograd keeps for the backward pass, which is what grows with the batchsize.
+
+AUTOTUNE_MEMORY_FRACTION = .9 # Of the device's memory, the rest is headroom for fragmentation, the evals, etc.
+
+
+def get_sequence_lengths() -> list[int]:
+    # Every sequence length that training goes through, in order (see `grow_sequence_length`)
+    lengths = [hyp['misc']['sequence_length']['initial']]
+    while lengths[-1] < hyp['misc']['sequence_length']['max']:
+        lengths.append(min(2*lengths[-1], hyp['misc']['sequence_length']['max']))
+    return lengths
+
+
+def get_memory_budget(memory_fraction: float = AUTOTUNE_MEMORY_FRACTION) -> int:
+    if is_cuda_device():
+        total_memory = torch.cuda.get_device_properties(torch.device(hyp['misc']['device'])).total_memory
+    else:
+        total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return int(memory_fraction * total_memory)
+
+
+class MemoryTracker:
+    """ Peak memory that is allocated while it's entered, on top of what was allocated before (see the explanation above)."""
+    def __init__(self, exclude: list[torch.Tensor] = ()):
+        self.exclude  = {t.untyped_storage().data_ptr() for t in exclude} # e.g. the parameters, which autograd saves as well
+        self.storages = {}
+        self.peak     = 0
+
+    def __enter__(self):
+        if is_cuda_device():
+            synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.baseline = torch.cuda.memory_allocated()
+        else:
+            self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+            self.hooks.__enter__()
+        return self
+
+    def pack(self, tensor: torch.Tensor) -> torch.Tensor:
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.exclude:
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def __exit__(self, *exc_info) -> None:
+        if is_cuda_device():
+            synchronize()
+            self.peak = torch.cuda.max_memory_allocated() - self.baseline
+        else:
+            self.hooks.__exit__(*exc_info)
+            self.peak = sum(self.storages.values())
+
+
+def measure_microbatch_memory(net: SpeedyLangNet, settings: dict[str, Any], batchsize: int, length: int, generator: torch.Generator) -> int:
+    # Peak memory of a training microbatch on random tokens. Runs two, so that the pipelined plan-act schedule gets to its full (carry) batch.
+    peak, plan_act_carry = 0, None
+    for _ in range(2):
+        sequence = torch.randint(hyp['misc']['num_tokens'], (batchsize, length), generator=generator).to(hyp['misc']['device'])
+        segment_ids = torch.zeros_like(sequence) if settings.get('data_sampling') == 'packed' else None # packed batches also carry their segment masks
+        with MemoryTracker(exclude=list(net.parameters())) as tracker:
+            _, _, _, plan_act_carry = forward_backward(net, sequence, settings, plan_act_carry, segment_ids=segment_ids)
+        net.zero_grad(set_to_none=True) # the next probe allocates the grads again, so they're part of every peak
+        peak = max(peak, tracker.peak)
+    return peak
+
+
+def tune_batchsizes(net: SpeedyLangNet, settings: dict[str, Any], memory_budget: int | None = None) -> dict[int, int]:
+    # The largest batchsize per sequence length that fits into `memory_budget` bytes (default: see `get_memory_budget`)
+    memory_budget = memory_budget or get_memory_budget()
+    if is_cuda_device():
+        # Weights (and whatever else is around) are allocated already, the AdamW moments come with the first step. Grads etc. are in the peaks.
+        param_bytes    = sum(p.numel() * p.element_size() for p in net.parameters())
+        resident_bytes = torch.cuda.memory_allocated() + 2 * param_bytes
+    else:
+        # Nothing but the saved activations is tracked: weights, grads, AdamW moments & the float32 output layer grad of the fused cross-entropy
+        resident_bytes = estimate_model_cost(hyp['net']['num_blocks'], hyp['net']['residual_depth'])['static_bytes']
+
+    rng_states = get_rng_states() # probing mustn't change the run's random numbers (plan-act spans, etc.)
+    generator  = torch.Generator().manual_seed(0)
+    batchsize_table = {}
+    for length in get_sequence_lengths():
+        probe_batchsize = max(1, tokens_per_batch_capacity // length // 8) # well below what the fitted formula would use, to not OOM here
+        while True:
+            try:
+                peak_small = measure_microbatch_memory(net, settings, probe_batchsize, length, generator)
+                peak_large = measure_microbatch_memory(net, settings, 2 * probe_batchsize, length, generator)
+                break
+            except torch.OutOfMemoryError:
+                net.zero_grad(set_to_none=True)
+                if probe_batchsize == 1:
+                    raise RuntimeError(f"A single sequence of length {length} doesn't fit into memory.")
+                probe_batchsize //= 2
+
+        per_sequence = max(peak_large - peak_small, 1) / probe_batchsize
+        fixed        = peak_small - probe_batchsize * per_sequence
+        batchsize    = math.floor((memory_budget - resident_bytes - fixed) / per_sequence)
+        if batchsize < 1:
+            raise RuntimeError(f"Specified configuration takes up too much memory (no batchsize at sequence length {length} fits into {memory_budget/2**30:.2f} GiB)")
+        batchsize_table[length] = batchsize
+    set_rng_states(rng_states)
+    if is_cuda_device():
+        torch.cuda.empty_cache()
+
+    if get_world_size() > 1:
+        # Every rank needs the same batchsize, so take the one that fits on all of them
+        batchsizes = torch.tensor(list(batchsize_table.values()), device=hyp['misc']['device'])
+        dist.all_reduce(batchsizes, op=dist.ReduceOp.MIN)
+        batchsize_table = dict(zip(batchsize_table, batchsizes.tolist()))
+
+    print(
+        f"| autotuned batchsizes for a {memory_budget/2**30:.2f} GiB budget: "
+        + ", ".join(f"{batchsize} x {length}" for length, batchsize in batchsize_table.items())
+        + f" (fitted formula: " + ", ".join(f"{tokens_per_batch_capacity // length} x {length}" for length in batchsize_table) + ")"
+    )
+    return batchsize_table
+
+
 ##############################
 #          Logging           #
 ##############################
@@ -591,6 +1812,132 @@ def format_num_params(num_params: int, round_to_digits: int = 1) -> str:
     return f"{before_dot}{after_dot}{scalar}"
 
 
+# `train` emits one record per eval: the `history_names` metrics of that eval point, plus its 'eval_idx'. They go through a `MetricsSink`,
+# which only queues them on the training thread, and hands them to its consumers in batches from a background thread: whenever `train` flushes
+# (at the checkpoint cadence, so that what's on disk lines up with the checkpoints), and at the end of the run. So a crashed run keeps its curves
+# up to the last flush. Consumers are anything with a `write(records)` and a `close()`: wandb, the run store & a csv file of eval points below.
+
+class MetricsSink:
+    """ Hands the per-eval records of a run to its consumers from a background thread, so that logging never blocks training."""
+    def __init__(self, consumers: list[Any]):
+        self.consumers = consumers
+        self.queue     = queue.Queue()
+        self.error     = None
+        self.thread    = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def emit(self, record: dict[str, Any]) -> None:
+        self.queue.put(('record', record))
+
+    def flush(self) -> None:
+        # Writes the buffered records out (in the background), and re-raises any error from writing the ones before
+        self.queue.put(('flush', None))
+        self._raise()
+
+    def close(self) -> None:
+        # Blocks until everything is written and the consumers are closed
+        self.queue.put(('close', None))
+        self.thread.join()
+        self._raise()
+
+    def _raise(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self) -> None:
+        records = []
+        while True:
+            kind, record = self.queue.get()
+            if kind == 'record':
+                records.append(record)
+                continue
+            try:
+                if records:
+                    for consumer in self.consumers:
+                        consumer.write(records)
+                if kind == 'close':
+                    for consumer in self.consumers:
+                        consumer.close()
+            except Exception as error:
+                self.error = error
+            records = []
+            if kind == 'close':
+                return
+
+
+class WandbConsumer:
+    """ Logs records to the current wandb run."""
+    def write(self, records: list[dict[str, Any]]) -> None:
+        import wandb
+        for record in records:
+            wandb.log({
+                'train/loss': record['train_loss'],
+                'train/acc': record['train_acc'],
+                'train/pplx': record['train_pplx'],
+                'val/loss/causal': record['val_loss_causal'],
+                'val/acc/causal': record['val_acc_causal'],
+                'val/pplx/causal': record['val_pplx_causal'],
+                'val/loss/planning': record['val_loss_planning'],
+                'val/acc/planning': record['val_acc_planning'],
+                'val/pplx/planning': record['val_pplx_planning'],
+                'val/loss/acting': record['val_loss_acting'],
+                'val/acc/acting': record['val_acc_acting'],
+                'val/pplx/acting': record['val_pplx_acting'],
+                'tokens_seen': record['tokens_seen'],
+                'epoch': record['epoch'],
+                'batch_size': record['batch_size'],
+                'sequence_length': record['seq_length'],
+                'cumulative_time': record['cumulative_time'],
+                'tokens_per_sec': record['tokens_seen'] / max(record['cumulative_time'], 1e-9),
+                'learning_rate': record['learning_rate'],
+                'weight_decay': record['weight_decay'],
+            })
+
+    def close(self) -> None:
+        pass
+
+
+class RunStoreConsumer:
+    """ Appends records to the metrics of a run in the run store (see run_store.py), one part per write."""
+    def __init__(self, directory: str, run_id: str, first_eval: int = 0):
+        from run_store import RunStore
+        self.store, self.run_id = RunStore(directory), run_id
+        self.store.truncate_metrics(run_id, first_eval) # whatever the store holds from here on is going to be redone
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        self.store.append_metrics(self.run_id, records[0]['eval_idx'], {name: [record[name] for record in records] for name in history_names})
+
+    def close(self) -> None:
+        pass
+
+
+class CsvConsumer:
+    """ Appends records to a csv file, one row per eval point (with the run's id), and writes the header if the file is new."""
+    def __init__(self, path: str, run_id: str, first_eval: int = 0):
+        self.path, self.run_id = path, run_id
+        if os.path.exists(path):
+            # Like `RunStoreConsumer`: whatever the file holds of this run from `first_eval` on is going to be redone
+            import polars as pl
+            df   = pl.read_csv(path)
+            kept = df.filter((pl.col('run_id') != run_id) | (pl.col('eval_idx') < first_eval))
+            if len(kept) < len(df):
+                tmp_path = path + '.tmp'
+                kept.write_csv(tmp_path)
+                os.replace(tmp_path, path)
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        import polars as pl
+        df = pl.DataFrame([{'run_id': self.run_id, 'eval_idx': record['eval_idx'], **{name: float(record[name]) for name in history_names}} for record in records])
+        include_header = not os.path.exists(self.path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'ab') as f:
+            df.write_csv(f, include_header=include_header)
+
+    def close(self) -> None:
+        pass
+
+
 ########################################
 #           Train and Eval             #
 ########################################
@@ -600,164 +1947,248 @@ def calc_pplx(loss: torch.Tensor | float) -> torch.Tensor | float:
     return 2.71828 ** loss
 
 
+class MetricsAccumulator:
+    """ Running means of named groups of metrics (e.g. the loss & acc of the causal, acting & planning regions), all in one buffer on the device."""
+    # Adding to it is an in-place device op, so the training & eval loops never have to wait for the device to read a metric.
+    # All the means come back to the host in a single transfer: `compute` does it (the one sync), or `start_readback` queues it
+    # asynchronously (into pinned memory, on cuda), so that a later `compute` finds the values there already.
+    # The buffer holds every group's sums followed by its count, so that the counts are summed across ranks along with the sums.
+    def __init__(self, groups: dict[Any, tuple[str, ...]], device: str | torch.device | None = None):
+        self.groups, self.slices, self.count_idxs, offset = {}, {}, {}, 0
+        for group, names in groups.items():
+            self.groups[group]     = tuple(names)
+            self.slices[group]     = slice(offset, offset + len(names))
+            self.count_idxs[group] = offset + len(names)
+            offset += len(names) + 1
+        self.device = torch.device(device or hyp['misc']['device'])
+        self.sums   = torch.zeros(offset, device=self.device, dtype=torch.float) # float32 here to prevent truncation errors
+        self.counts = dict.fromkeys(self.groups, 0) # the local counts, for checking on the host whether a group was added to
+        self.host, self.ready = None, None # the values of the last readback, and the event that marks when they've arrived
+
+    def __getitem__(self, group: Any) -> torch.Tensor:
+        # The running sums of one group, a view into the shared buffer
+        return self.sums[self.slices[group]]
+
+    def add(self, group: Any, values: torch.Tensor) -> None:
+        # `values` are the metrics of one step (a 1d tensor, in the order of the group's names), on the device
+        self[group].add_(values)
+        self.sums[self.count_idxs[group]].add_(1)
+        self.counts[group] += 1
+        self.host = None
+
+    def all_reduce(self) -> None:
+        # Sums the sums & counts across ranks, in a single collective, so that the means are over all of them,
+        # even if the ranks added different numbers of times (e.g. the eval batches don't always split evenly)
+        if get_world_size() > 1:
+            dist.all_reduce(self.sums)
+            self.host = None
+
+    def start_readback(self) -> None:
+        with torch.profiler.record_function('MetricsAccumulator.readback'):
+            if self.device.type == 'cuda':
+                self.host  = torch.empty(self.sums.shape, dtype=self.sums.dtype, pin_memory=True)
+                self.host.copy_(self.sums, non_blocking=True)
+                self.ready = torch.cuda.Event()
+                self.ready.record()
+            else:
+                self.host, self.ready = self.sums.to('cpu', copy=True), None
+
+    def compute(self) -> dict[Any, dict[str, float]]:
+        # The means of all metrics, per group & name. Groups that nothing was added to yet are all zeros.
+        if self.host is None:
+            self.start_readback()
+        if self.ready is not None:
+            self.ready.synchronize()
+        values = self.host.tolist()
+        return {
+            group: {name: value / max(values[self.count_idxs[group]], 1) for name, value in zip(names, values[self.slices[group]])}
+            for group, names in self.groups.items()
+        }
+
+    def reset(self) -> None:
+        self.sums.zero_()
+        self.counts = dict.fromkeys(self.groups, 0)
+        self.host, self.ready = None, None
+
+    def state_dict(self) -> dict[str, Any]:
+        return {'sums': self.sums.cpu(), 'counts': dict(self.counts)}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self.counts = dict(state_dict['counts'])
+        if state_dict['sums'].numel() == self.sums.numel():
+            self.sums.copy_(state_dict['sums'])
+        else:
+            # Checkpoints from before the counts were in the buffer: only the sums, one group after the other
+            sums = state_dict['sums'].tolist()
+            for group, names in self.groups.items():
+                self[group].copy_(torch.tensor(sums[:len(names)]))
+                self.sums[self.count_idxs[group]] = self.counts[group]
+                sums = sums[len(names):]
+        self.host, self.ready = None, None
+
+
 @torch.no_grad()
 def _eval_causal(
         net: SpeedyLangNet,
-        eval_batchsize: int,
-        num_eval_steps: int,
-):
-    # float32 here to prevent truncation errors
-    val_loss, val_acc = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-    
-    for _ in range(num_eval_steps):
-        sequence = get_batch(data, key='eval', batchsize=eval_batchsize, length=hyp['misc']['sequence_length']['max'])
-
+        eval_batches: list[torch.Tensor],
+        metrics: MetricsAccumulator,
+) -> None:
+    # Adds the (loss, acc) of every eval batch to the 'causal' group of `metrics`
+    for sequence in eval_batches:
         inputs, targets = get_causal_data(sequence)
-        outputs = net(inputs)
-        val_loss += 1./num_eval_steps * loss_fn(outputs.flatten(0, 1).float(), targets.flatten(0, 1))
-        val_acc  += 1./num_eval_steps * (outputs.argmax(-1) == targets).float().mean()
+        losses, predictions = net.token_losses(net.hidden(inputs), targets)
+        metrics.add('causal', torch.stack([losses.mean(), (predictions == targets).float().mean()]))
 
-    val_pplx = calc_pplx(val_loss)
-    return val_loss.item(), val_acc.item(), val_pplx.item()
+
+# The (loss, acc) pairs that the plan-act evals measure: the planning pass, then the acting pass over the full sequence, and over its causal prefix,
+# acting span & planning span (the regions before/between/after the acting token indexes)
+plan_act_eval_names   = ('planning', 'acting_full', 'acting_causal', 'acting_acting', 'acting_planning')
+plan_act_metric_names = tuple(f"{metric}_{name}" for name in plan_act_eval_names for metric in ('loss', 'acc'))
 
 
 @torch.no_grad()
-def _eval_plan_act(
+def _eval_plan_act_grid(
         net: SpeedyLangNet,
-        eval_batchsize: int,
-        num_eval_steps: int,
-        first_acting_token_idx: int,
-        last_acting_token_idx: int,
-        top_k: int,
-):
-    val_loss_planning, val_acc_planning = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-    val_loss_acting_full, val_acc_acting_full = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-    val_loss_acting_causal, val_acc_acting_causal = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-    val_loss_acting_acting, val_acc_acting_acting = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-    val_loss_acting_planning, val_acc_acting_planning = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
-
-    for _ in range(num_eval_steps):
-        sequence = get_batch(data, key='eval', batchsize=eval_batchsize, length=hyp['misc']['sequence_length']['max'])
-
-        inputs, targets = get_planning_data(sequence, first_acting_token_idx)
-        outputs = net(inputs)
-        val_loss_planning += 1./num_eval_steps * loss_fn(outputs.flatten(0, 1).float(), targets.flatten(0, 1))
-        val_acc_planning += 1./num_eval_steps * (outputs.argmax(-1) == targets).float().mean()
-
-        inputs, targets = get_acting_data(
-            net=net,
-            sequence=sequence,
-            planning_output=outputs,
-            first_acting_token_idx=first_acting_token_idx,
-            last_acting_token_idx=last_acting_token_idx,
-            top_k=top_k,
-        )
-        outputs = net(
-            inputs, 
-            first_acting_token_idx=first_acting_token_idx,
-            last_acting_token_idx=last_acting_token_idx,    
-        )
-        val_loss_acting_full += 1./num_eval_steps * loss_fn(outputs.flatten(0, 1).float(), targets.flatten(0, 1))
-        val_acc_acting_full += 1./num_eval_steps * (outputs.argmax(-1) == targets).float().mean()
-        val_loss_acting_causal += 1./num_eval_steps * loss_fn(
-            outputs[:, :first_acting_token_idx].flatten(0, 1).float(), 
-            targets[:, :first_acting_token_idx].flatten(0, 1),
-        )
-        val_acc_acting_causal += 1./num_eval_steps * (
-            outputs[:, :first_acting_token_idx].argmax(-1) 
-            == targets[:, :first_acting_token_idx]
-        ).float().mean()
-        val_loss_acting_acting += 1./num_eval_steps * loss_fn(
-            outputs[:, first_acting_token_idx:last_acting_token_idx].flatten(0, 1).float(), 
-            targets[:, first_acting_token_idx:last_acting_token_idx].flatten(0, 1),
-        )
-        val_acc_acting_acting += 1./num_eval_steps * (
-            outputs[:, first_acting_token_idx:last_acting_token_idx].argmax(-1) 
-            == targets[:, first_acting_token_idx:last_acting_token_idx]
-        ).float().mean()
-        val_loss_acting_planning += 1./num_eval_steps * loss_fn(
-            outputs[:, last_acting_token_idx:].flatten(0, 1).float(), 
-            targets[:, last_acting_token_idx:].flatten(0, 1),
-        )
-        val_acc_acting_planning += 1./num_eval_steps * (
-            outputs.argmax(-1)[:, last_acting_token_idx:]
-            == targets[:, last_acting_token_idx:]
-        ).float().mean()
-
-    val_pplx_planning = calc_pplx(val_loss_planning)
-    val_pplx_acting_full = calc_pplx(val_loss_acting_full)
-    val_pplx_acting_causal = calc_pplx(val_loss_acting_causal)
-    val_pplx_acting_acting = calc_pplx(val_loss_acting_acting)
-    val_pplx_acting_planning = calc_pplx(val_loss_acting_planning)
-
-    return (
-        val_loss_planning, val_acc_planning, val_pplx_planning,
-        val_loss_acting_full, val_acc_acting_full, val_pplx_acting_full,
-        val_loss_acting_causal, val_acc_acting_causal, val_pplx_acting_causal,
-        val_loss_acting_acting, val_acc_acting_acting, val_pplx_acting_acting,
-        val_loss_acting_planning, val_acc_acting_planning, val_pplx_acting_planning,
-    )
+        eval_batches: list[torch.Tensor],
+        acting_spans: list[tuple[int, int]],
+        top_ks: list[int],
+        metrics: MetricsAccumulator,
+) -> None:
+    # Evaluates every combination of the (first_acting_token_idx, last_acting_token_idx) `acting_spans` & `top_ks`. Adds the `plan_act_metric_names`
+    # of every eval batch to the (first_acting_token_idx, last_acting_token_idx, top_k) groups of `metrics`.
+    #
+    # Shares all the work that the combinations have in common. Everything before `first_acting_token_idx` is plain causal attention over the same
+    # inputs, for any span: so both passes run over each batch once with nothing masked, into a KV cache, and every span only decodes the rest
+    # (`commit=False`, from `first_acting_token_idx` on) on top of it. The spans are visited from the last `first_acting_token_idx` to the first,
+    # so the scratch positions that a span overwrites are never part of the prefix of a later one. The planning pass only depends on
+    # `first_acting_token_idx`, so it runs once for all the spans that start there, and its top-k is taken once, with the largest k: every smaller k
+    # is a prefix of it. The acting passes of all `top_ks` have the same mask, so they run as one forward, stacked along the batch dimension.
+    spans_by_first = collections.defaultdict(list)
+    for first_acting_token_idx, last_acting_token_idx in acting_spans:
+        spans_by_first[first_acting_token_idx].append(last_acting_token_idx)
+
+    num_blocks = len(net.net_dict['attn_layers'])
+    max_k      = max(top_ks)
+
+    for sequence in eval_batches:
+        batchsize, length = sequence.shape
+
+        # The shared prefixes: a span that starts at the very end masks nothing
+        inputs, targets = get_planning_data(sequence, first_acting_token_idx=length)
+        planning_cache  = KVCache(num_blocks, capacity=length)
+        prefix_losses, prefix_predictions = net.token_losses(net.decode(inputs, planning_cache), targets)
+        prefix_correct  = (prefix_predictions == targets).float()
+
+        inputs, _    = get_acting_tokens(sequence, first_acting_token_idx=length, last_acting_token_idx=length)
+        acting_cache = KVCache(num_blocks, capacity=length)
+        acting_prefix_losses, acting_prefix_predictions = net.token_losses(net.decode(inputs, acting_cache), targets)
+        acting_prefix_correct = (acting_prefix_predictions == targets).float()
+        acting_cache.select(torch.arange(batchsize, device=sequence.device).repeat(len(top_ks))) # one copy per top-k
+
+        for first_acting_token_idx in sorted(spans_by_first, reverse=True):
+            last_acting_token_indices = spans_by_first[first_acting_token_idx]
+            suffix_targets = targets[:, first_acting_token_idx:]
+
+            inputs, _ = get_planning_data(sequence, first_acting_token_idx)
+            planning_cache.length = first_acting_token_idx
+            hidden = net.decode(inputs[:, first_acting_token_idx:], planning_cache, commit=False)
+            losses, predictions = net.token_losses(hidden, suffix_targets)
+            planning = torch.stack([
+                prefix_losses[:, :first_acting_token_idx].sum() + losses.sum(),
+                prefix_correct[:, :first_acting_token_idx].sum() + (predictions == suffix_targets).sum(),
+            ]) / targets.numel()
+
+            plan_start = min(last_acting_token_indices)
+            plan_values, plan_indices = plan_top_k(net, hidden[:, plan_start-first_acting_token_idx:], max_k)
+
+            for last_acting_token_idx in last_acting_token_indices:
+                tokens, _ = get_acting_tokens(sequence, first_acting_token_idx, last_acting_token_idx)
+                values, indices = plan_values[:, last_acting_token_idx-plan_start:], plan_indices[:, last_acting_token_idx-plan_start:]
+                acting_width = last_acting_token_idx - first_acting_token_idx
+
+                inputs = net.embed(tokens[:, first_acting_token_idx:]).repeat(len(top_ks), 1, 1)
+                for i, top_k in enumerate(top_ks):
+                    # The normalized top-k values are just the (renormalized) first k of the normalized top-`max_k` ones
+                    inputs[i*batchsize:(i+1)*batchsize, acting_width:] = embed_plan(
+                        net, values[..., :top_k] / values[..., :top_k].sum(dim=-1, keepdim=True), indices[..., :top_k],
+                    )
+                acting_cache.length = first_acting_token_idx
+                hidden_acting = net.decode(inputs, acting_cache, first_acting_token_idx, last_acting_token_idx, commit=False)
+                losses, predictions = net.token_losses(hidden_acting, suffix_targets.repeat(len(top_ks), 1))
+                losses  = losses.view(len(top_ks), *suffix_targets.shape)
+                correct = (predictions.view(len(top_ks), *suffix_targets.shape) == suffix_targets).float()
+
+                causal_prefix = [acting_prefix_losses[:, :first_acting_token_idx], acting_prefix_correct[:, :first_acting_token_idx]]
+                acting = torch.stack([
+                    *[(prefix.sum() + metric.sum(dim=(1, 2))) / targets.numel() for prefix, metric in zip(causal_prefix, (losses, correct))], # full
+                    *[prefix.mean().expand(len(top_ks)) for prefix in causal_prefix],                                                        # causal
+                    *[metric[:, :, :acting_width].mean(dim=(1, 2)) for metric in (losses, correct)],                                           # acting
+                    *[metric[:, :, acting_width:].mean(dim=(1, 2)) for metric in (losses, correct)],                                           # planning
+                ], dim=-1)
+                for i, top_k in enumerate(top_ks):
+                    metrics.add((first_acting_token_idx, last_acting_token_idx, top_k), torch.cat([planning, acting[i]]))
+
+
+
+def eval_batchsize() -> int:
+    # Number of sequences per batch relative to the max-length batchsize capacity, downscale factor hardcoded to help prevent OOMs. Tunable
+    return max(math.floor(tokens_per_batch_capacity/(hyp['misc']['sequence_length']['max'])//16), 1)
 
 
 @torch.no_grad()
-def quick_evaluation(net: SpeedyLangNet):
+def quick_evaluation(net: SpeedyLangNet) -> dict[str, float]:
+    # The causal & (a single setting of the) plan-act metrics, averaged over the eval set & all ranks, read back from the device at once
     net.eval()
-    
-    eval_batchsize           = max(math.floor(tokens_per_batch_capacity/(hyp['misc']['sequence_length']['max'])//16), 1) # Number of sequences per batch relative to the max-length batchsize capacity, downscale factor hardcoded to help prevent OOMs. Tunable
-    num_eval_sequences       = hyp['opt']['num_eval_tokens']//hyp['misc']['sequence_length']['max']
-    num_eval_steps           = num_eval_sequences//eval_batchsize
-
-    causal_loss, causal_acc, causal_pplx = _eval_causal(
-        net=net,
-        eval_batchsize=eval_batchsize,
-        num_eval_steps=num_eval_steps,
-    )
 
+    eval_batches = ctx.eval_batches(eval_batchsize())
     first_acting_token_idx, last_acting_token_idx = get_first_and_last_acting_token_idx(
         seq_len=max_sequence_length,
         planning_rate=0.25,
         acting_rate=0.01,
     )
-    (
-        val_loss_planning, val_acc_planning, val_pplx_planning,
-        val_loss_acting_full, val_acc_acting_full, val_pplx_acting_full,
-        _, _, _, _, _, _, _, _, _,
-    ) = _eval_plan_act(
-        net=net,
-        eval_batchsize=eval_batchsize,
-        num_eval_steps=num_eval_steps,
-        first_acting_token_idx=first_acting_token_idx,
-        last_acting_token_idx=last_acting_token_idx,
-        top_k=5
-    )
+    plan_act = (first_acting_token_idx, last_acting_token_idx, 5)
+    metrics  = MetricsAccumulator({'causal': ('loss', 'acc'), plan_act: plan_act_metric_names})
 
-    net.train()
+    _eval_causal(net, eval_batches, metrics)
+    _eval_plan_act_grid(net, eval_batches, [plan_act[:2]], [plan_act[2]], metrics)
+    metrics.all_reduce()
+    results = metrics.compute()
 
-    return (
-        causal_loss, causal_acc, causal_pplx,
-        val_loss_planning, val_acc_planning, val_pplx_planning,
-        val_loss_acting_full, val_acc_acting_full, val_pplx_acting_full,
-    )
+    net.train()
+    return {
+        'loss_causal': results['causal']['loss'], 'acc_causal': results['causal']['acc'],
+        **{name: results[plan_act][name] for name in ('loss_planning', 'acc_planning', 'loss_acting_full', 'acc_acting_full')},
+    }
 
 
 @torch.no_grad()
 def full_evaluation(net: SpeedyLangNet):
     net.eval()
-    
-    eval_batchsize           = max(math.floor(tokens_per_batch_capacity/(hyp['misc']['sequence_length']['max'])//16), 1) # Number of sequences per batch relative to the max-length batchsize capacity, downscale factor hardcoded to help prevent OOMs. Tunable
-    num_eval_sequences       = hyp['opt']['num_eval_tokens']//hyp['misc']['sequence_length']['max']
-    num_eval_steps           = num_eval_sequences//eval_batchsize
-
-    causal_loss, causal_acc, causal_pplx = _eval_causal(
-        net=net,
-        eval_batchsize=eval_batchsize,
-        num_eval_steps=num_eval_steps,
-    )
+
+    eval_batches = ctx.eval_batches(eval_batchsize())
+
+    acting_mask_widths = range(1, 11)
+    last_acting_token_indices = range(13, max_sequence_length, 10)
+    top_ks = [1, 2, 3, 4, 5]
+
+    settings = list(itertools.product(acting_mask_widths, last_acting_token_indices, top_ks))
+    acting_spans = list(dict.fromkeys((last_acting_token_idx - acting_mask_width, last_acting_token_idx) for acting_mask_width, last_acting_token_idx, _ in settings))
+    metrics = MetricsAccumulator({
+        'causal': ('loss', 'acc'),
+        **{(last_acting_token_idx - acting_mask_width, last_acting_token_idx, top_k): plan_act_metric_names for acting_mask_width, last_acting_token_idx, top_k in settings},
+    })
+
+    _eval_causal(net, eval_batches, metrics)
+    _eval_plan_act_grid(net, eval_batches, acting_spans, top_ks, metrics)
+    metrics.all_reduce()
+    grid_results = metrics.compute() # one device sync for the whole grid
+
+    causal_loss, causal_acc = grid_results['causal']['loss'], grid_results['causal']['acc']
     results = {
         "setting": ["causal"], 
         "loss": [causal_loss], 
         "acc": [causal_acc], 
-        "pplx": [causal_pplx],
+        "pplx": [calc_pplx(causal_loss)],
         "loss_planning": [None],
         "acc_planning": [None],
         "pplx_planning": [None],
@@ -774,55 +2205,34 @@ def full_evaluation(net: SpeedyLangNet):
         "acc_acting_planning": [None],
         "pplx_acting_planning": [None],
     }
-    
-    acting_mask_widths = range(1, 11)
-    last_acting_token_indices = range(13, max_sequence_length, step=10)
-    top_ks = [1, 2, 3, 4, 5]
 
-    for acting_mask_width, last_acting_token_idx, top_k in itertools.product(
-        acting_mask_widths, last_acting_token_indices, top_ks
-    ):
+    for acting_mask_width, last_acting_token_idx, top_k in settings:
         first_acting_token_idx = last_acting_token_idx - acting_mask_width
-
-        (
-            val_loss_planning, val_acc_planning, val_pplx_planning,
-            val_loss_acting_full, val_acc_acting_full, val_pplx_acting_full,
-            val_loss_acting_causal, val_acc_acting_causal, val_pplx_acting_causal,
-            val_loss_acting_acting, val_acc_acting_acting, val_pplx_acting_acting,
-            val_loss_acting_planning, val_acc_acting_planning, val_pplx_acting_planning,
-        ) = _eval_plan_act(
-            net=net,
-            eval_batchsize=eval_batchsize,
-            num_eval_steps=num_eval_steps,
-            first_acting_token_idx=first_acting_token_idx,
-            last_acting_token_idx=last_acting_token_idx,
-            top_k=top_k
-        )
+        setting_results = grid_results[first_acting_token_idx, last_acting_token_idx, top_k]
 
         results["setting"].append(str((first_acting_token_idx, last_acting_token_idx)))
         results["loss"].append(None)
         results["acc"].append(None)
         results["pplx"].append(None)
-        results["loss_planning"].append(val_loss_planning)
-        results["acc_planning"].append(val_acc_planning)
-        results["pplx_planning"].append(val_pplx_planning)
-        results["loss_acting_full"].append(val_loss_acting_full)
-        results["acc_acting_full"].append(val_acc_acting_full)
-        results["pplx_acting_full"].append(val_pplx_acting_full)
-        results["loss_acting_causal"].append(val_loss_acting_causal)
-        results["acc_acting_causal"].append(val_acc_acting_causal)
-        results["pplx_acting_causal"].append(val_pplx_acting_causal)
-        results["loss_acting_acting"].append(val_loss_acting_acting)
-        results["acc_acting_acting"].append(val_acc_acting_acting)
-        results["pplx_acting_acting"].append(val_pplx_acting_acting)
-        results["loss_acting_planning"].append(val_loss_acting_planning)
-        results["acc_acting_planning"].append(val_acc_acting_planning)
-        results["pplx_acting_planning"].append(val_pplx_acting_planning)
+        for name in plan_act_eval_names:
+            results[f"loss_{name}"].append(setting_results[f"loss_{name}"])
+            results[f"acc_{name}"].append(setting_results[f"acc_{name}"])
+            results[f"pplx_{name}"].append(calc_pplx(setting_results[f"loss_{name}"]))
 
     net.train()
     return results
 
 
+# The per-eval logs that `train` keeps (and checkpoints), in this order
+history_names = (
+    'train_loss', 'val_loss_causal', 'train_acc', 'val_acc_causal', 'train_pplx', 'val_pplx_causal',
+    'val_loss_planning', 'val_acc_planning', 'val_pplx_planning',
+    'val_loss_acting', 'val_acc_acting', 'val_pplx_acting',
+    'grad_norm', 'cumulative_time', 'tokens_seen', 'epoch',
+    'batch_size', 'seq_length', 'learning_rate', 'weight_decay',
+)
+
+
 def train(net: SpeedyLangNet | None = None, **settings):
 
     #################
@@ -832,10 +2242,22 @@ def train(net: SpeedyLangNet | None = None, **settings):
     # Get network
     net = net or make_net(settings)
 
+    if get_world_size() > 1:
+        # Same weights on all ranks, and each rank samples its own batches (see the Distributed section)
+        for p in net.parameters():
+            dist.broadcast(p.data, src=0)
+
+    # The training batches come from a separate, deterministic stream per rank (and run), and are prefetched in the background
+    sampler = BatchSampler(
+        ctx.data['train'], seed=torch.initial_seed() * get_world_size() + get_rank(),
+        mode=settings.get('data_sampling', 'random'), num_prefetch=settings.get('num_prefetch', 2),
+    )
+
     # Init wandb 
     # TODO: update run name with the new options
     # TODO: use same run name for full eval at the end
-    if settings['log_wandb']:
+    if settings['log_wandb'] and is_main_process():
+        import wandb
         wandb.finish()  # Finish any previous runs
         wandb.init(
             project=settings['wandb_project'], 
@@ -843,6 +2265,7 @@ def train(net: SpeedyLangNet | None = None, **settings):
             name=get_run_name(
                 depth=settings['depth'],
                 width=settings['width'],
+                seed=settings['seed'],
                 num_heads=settings['num_heads'],
                 linear_value=settings['linear_value'],
                 plan_act=settings['plan_act'],
@@ -863,15 +2286,33 @@ def train(net: SpeedyLangNet | None = None, **settings):
     microbatch_steps = 0. # The noninteger estimate of microbatches required based upon the grad norm (sampled by dithering at each step.)
     discrete_sampled_microbatch_steps = max(1, int(microbatch_steps))
 
+    # Checkpointing & resuming (see the Checkpointing section)
+    checkpoint_path  = settings.get('checkpoint_path')
+    resuming         = checkpoint_path is not None and settings.get('resume') and os.path.exists(checkpoint_path)
+
+    # Measured batchsizes per sequence length instead of the fitted `tokens_per_batch_capacity` (see the Batchsize Autotuning section).
+    # A resumed run keeps the table it was started with.
+    batchsize_table = tune_batchsizes(net, settings, settings.get('memory_budget')) if settings.get('autotune_batchsize') and not resuming else None
+
     # Start at the initial length and maximum allowable batchsize. The batchsize is adjusted so that we see roughly the same number of tokens per batch. This means that shorter sequence lengths will have much larger batch sizes.
     curr_length     = hyp['misc']['sequence_length']['initial']
-    curr_batchsize  = tokens_per_batch_capacity // hyp['misc']['sequence_length']['initial']
-    final_batchsize = tokens_per_batch_capacity /  hyp['misc']['sequence_length']['max']
-    assert final_batchsize > 1, f"Error: Specified configuration takes up too much memory (calculated final batchsize {final_batchsize} is less than 1!)"
+    if batchsize_table:
+        curr_batchsize  = batchsize_table[curr_length]
+        final_batchsize = batchsize_table[hyp['misc']['sequence_length']['max']]
+    else:
+        curr_batchsize  = tokens_per_batch_capacity // hyp['misc']['sequence_length']['initial']
+        final_batchsize = tokens_per_batch_capacity /  hyp['misc']['sequence_length']['max']
+        assert final_batchsize > 1, f"Error: Specified configuration takes up too much memory (calculated final batchsize {final_batchsize} is less than 1!)"
 
     # Validation parameters
     val_loss_causal, val_acc, val_pplx = None, None, None
 
+    # Metrics stay on the device until they're needed, and then come back in one transfer (see `MetricsAccumulator`): the training metrics once per
+    # eval, and the loss & grad norm that the weight decay & microbatch schedulers depend on once per optimizer step, asynchronously (see below)
+    train_metrics      = MetricsAccumulator({'train': ('loss', 'acc', 'grad_norm')})
+    step_metrics       = MetricsAccumulator({'loss': ('loss',), 'grad_norm': ('grad_norm',)})
+    step_metrics_ready = False # whether `step_metrics` holds the last optimizer step's values, waiting to be applied
+
     # Get the total number of parameters in our model and use that to generate/calculate the base lr.
     total_trainable_params = sum([p.data.numel() if p.requires_grad else 0 for p in net.parameters()])
 
@@ -881,7 +2322,7 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
     # Briefly log some details up front. (TODO: Condense nicely later.)
     print("curr_batchsize:     ", curr_batchsize)
-    print("final_batchsize:    ", tokens_per_batch_capacity // hyp['misc']['sequence_length']['max'])
+    print("final_batchsize:    ", int(final_batchsize))
     print("max_sequence_length:", max_sequence_length)
 
 
@@ -910,7 +2351,7 @@ def train(net: SpeedyLangNet | None = None, **settings):
     # Create multiple parameter groups based on parameter name, as certain kinds of parameters seem to work best
     # with specific combinations of learning rates and schedulers
     param_groups_dict = init_param_groups_dict(net, base_lr)
-    opt               = torch.optim.AdamW(param_groups_dict.values(), fused=True)
+    opt               = torch.optim.AdamW(param_groups_dict.values(), fused=is_cuda_device())
     scheduler         = torch.optim.lr_scheduler.LambdaLR(opt, [k['scheduler'] for k in param_groups_dict.values()])
 
     # Save some results
@@ -923,6 +2364,63 @@ def train(net: SpeedyLangNet | None = None, **settings):
     sequence_lengths = []
     learning_rates, weight_decays = [], []
 
+    # Checkpoint writing & resuming
+    checkpoint_writer = AsyncCheckpointWriter()
+    num_evals        = 0
+    stop_run         = False
+    plan_act_carry   = None # Planned sequences waiting for their acting pass, for the pipelined plan-act schedule
+
+    if resuming:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+        net.load_state_dict(checkpoint['state_dict'])
+        opt.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        set_rng_states(checkpoint['rng'])
+        assert len(checkpoint['ranks']) == get_world_size(), "resume distributed runs with the same number of ranks"
+        rank_state = checkpoint['ranks'][get_rank()]
+        sampler.load_state_dict(rank_state['sampler'])
+
+        loop = checkpoint['loop']
+        t_secs, tokens_seen, curr_step, curr_microbatch_step = loop['t_secs'], loop['tokens_seen'], loop['curr_step'], loop['curr_microbatch_step']
+        microbatch_steps, discrete_sampled_microbatch_steps = loop['microbatch_steps'], loop['discrete_sampled_microbatch_steps']
+        curr_length, curr_batchsize = loop['curr_length'], loop['curr_batchsize']
+        val_loss_causal, num_evals, stop_run = loop['val_loss_causal'], loop['num_evals'], loop['finished']
+        batchsize_table = loop.get('batchsize_table')
+        plan_act_carry = {key: value.to(hyp['misc']['device']) if isinstance(value, torch.Tensor) else value for key, value in rank_state['plan_act_carry'].items()} if rank_state['plan_act_carry'] else None
+        if loop.get('step_metrics') is not None:
+            step_metrics.load_state_dict(loop['step_metrics'])
+            step_metrics_ready = True
+
+        history = checkpoint['history']
+        (
+            train_losses, val_losses_causal, train_accs, val_accs_causal, train_pplxs, val_pplxs_causal,
+            val_losses_planning, val_accs_planning, val_pplxs_planning,
+            val_losses_acting, val_accs_acting, val_pplxs_acting,
+            grad_norms, cumulative_time, tokens_seen_list, epochs_list,
+            batch_sizes, sequence_lengths, learning_rates, weight_decays,
+        ) = (history[name] for name in history_names)
+        print(f"| resuming from {checkpoint_path} at step {curr_step} ({tokens_seen:,} tokens seen, sequence length {curr_length}, batchsize {curr_batchsize})")
+        del checkpoint
+
+    history = (
+        train_losses, val_losses_causal, train_accs, val_accs_causal, train_pplxs, val_pplxs_causal,
+        val_losses_planning, val_accs_planning, val_pplxs_planning,
+        val_losses_acting, val_accs_acting, val_pplxs_acting,
+        grad_norms, cumulative_time, tokens_seen_list, epochs_list,
+        batch_sizes, sequence_lengths, learning_rates, weight_decays,
+    )
+
+    # The per-eval records go to the consumers of a `MetricsSink` (see the Logging section), from the main process
+    consumers = []
+    if is_main_process():
+        if settings['log_wandb']:
+            consumers.append(WandbConsumer())
+        if settings.get('run_store') is not None:
+            consumers.append(RunStoreConsumer(settings['run_store'], settings['run_id'], first_eval=num_evals))
+        if settings.get('metrics_csv') is not None:
+            consumers.append(CsvConsumer(settings['metrics_csv'], settings['run_id'], first_eval=num_evals))
+    sink = MetricsSink(consumers) if consumers else None
+
     #################
     # Training Mode #
     #################
@@ -930,61 +2428,45 @@ def train(net: SpeedyLangNet | None = None, **settings):
     ## print out the training column headers before each run.
     print_training_details(variables_to_log, column_labels_only=True)
 
-    ## For accurately timing GPU code
-    starter, ender = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
-    torch.cuda.synchronize() ## clean up any pre-net setup operations
-    starter.record()
+    ## For accurately timing GPU code (and plain wall-clock timing everywhere else)
+    timer = Timer()
+    timer.start() ## cleans up any pre-net setup operations, too
 
     net.train()
 
-    stop_run = False
-
     # Main loop. Most of the complexity here is in the dynamic growing scheduler(s).
-    while True:
-        sequence = get_batch(data, key='train', batchsize=curr_batchsize, length=curr_length)
+    while not stop_run: # a resumed run can have finished already
+        sequence, segment_ids = sampler.next(curr_batchsize, curr_length)
+        loss, predictions, targets, plan_act_carry = forward_backward(net, sequence, settings, plan_act_carry, discrete_sampled_microbatch_steps, segment_ids)
 
-        if settings['plan_act']:
-            planner_masking_rate = settings['planner_masking_rate']
-            actor_masking_rate = settings['actor_masking_rate']
+        tokens_seen += curr_batchsize * curr_length * get_world_size()
 
-            if settings['randomize_masking_rate']:
-                planner_masking_rate = randomize_masking_rate(planner_masking_rate)
-                actor_masking_rate = randomize_masking_rate(actor_masking_rate)
-            actor_masking_rate = min(actor_masking_rate, planner_masking_rate - (1.1/curr_length))  # at least 1 token less than the planner
+        # Apply the last optimizer step's weight decay & microbatch updates. Their inputs were read back while this forward/backward was queued, so this doesn't wait.
+        if step_metrics_ready:
+            step_values = step_metrics.compute()
 
-            first_acting_token_idx, last_acting_token_idx = get_first_and_last_acting_token_idx(
-                seq_len=curr_length,
-                planning_rate=planner_masking_rate,
-                acting_rate=actor_masking_rate,
-            )
+            # Dynamic weight decay scheduling. Based upon something similar to the reciprocal of the perplexity of the network over the data [inspired by section 5 of https://arxiv.org/pdf/2204.02311.pdf]
+            # Smaller models have a higher base, and weight decay kicks in more sharply later. For larger models, it activates more early
+            opt.param_groups[0]['weight_decay'] = 1./weight_decay_pow_base**(step_values['loss']['loss']+1e-8) * hyp['opt']['weight_decay']
 
-            inputs, targets = get_planning_data(sequence, first_acting_token_idx=first_acting_token_idx)
-            outputs = net(inputs)
-            loss_planning = loss_fn(outputs.flatten(0, 1), targets.flatten(0, 1)) / settings["planning_divider"]
+            # The next several lines calculate a dynamic batchsize, simulated through manual dithering. The grad norm is sampled every few steps.
+            # There could be improvements or losses in changing the dithering strategy, since determinism and gradient descent can lead to some very not-so-nice (and subtle) loss oscillations.
+            if step_metrics.counts['grad_norm']:
+                grad_norm = step_values['grad_norm']['grad_norm']
 
-            inputs, targets = get_acting_data(
-                net, sequence, outputs,
-                first_acting_token_idx=first_acting_token_idx,
-                last_acting_token_idx=last_acting_token_idx,
-                top_k=settings['top_k'],
-            )
-            outputs = net(
-                inputs, 
-                first_acting_token_idx=first_acting_token_idx,
-                last_acting_token_idx=last_acting_token_idx,
-            )
-            loss_acting = loss_fn(outputs.flatten(0, 1), targets.flatten(0, 1)) / settings["acting_divider"]
+                grad_norm_per_param = grad_norm/(total_trainable_params**.5) # This should keep the expected grad norm per parameter roughly the same (ignoring initializations) unless I did my napkin math wrong (feel free to correct it and test it out if so! <3 :') )
+                grad_norm_target    = (((microbatch_grad_norm_steps_scale * (curr_step - 1 + 1e-2))) ** microbatch_expected_grad_norm_pow) # as of the step it was sampled at
+                ratio_diff          = grad_norm_per_param/(grad_norm_target)
 
-            loss = loss_planning + loss_acting
-            loss.div(discrete_sampled_microbatch_steps).backward()
-        else:
-            inputs, targets = get_causal_data(sequence)
-            outputs = net(inputs)
-            loss = loss_fn(outputs.flatten(0, 1), targets.flatten(0, 1))
-            loss.div(discrete_sampled_microbatch_steps).backward()
+                # Update the fractional number of steps based on the % difference between the grad norm and expected grad norm.
+                microbatch_steps *= 1. + (hyp['opt']['microbatch']['sample_every'] * hyp['opt']['microbatch']['scale_lr'] * (ratio_diff - 1))
+                microbatch_steps  = max(microbatch_steps, 1e-1) # Clamp to keep this from going to zero, so that we can bounce back if needed
+            step_metrics_ready = False
 
-        tokens_seen += curr_batchsize * curr_length
-        epoch = tokens_seen/len(data['train'])
+        # Average the gradients across ranks once per optimizer step, after the last microbatch
+        if get_world_size() > 1 and curr_microbatch_step % discrete_sampled_microbatch_steps == 0:
+            all_reduce_gradients(net)
+        epoch = tokens_seen/len(ctx.data['train'])
 
         do_eval = curr_step % 10 == 0 and curr_microbatch_step % discrete_sampled_microbatch_steps == 0
             
@@ -999,10 +2481,11 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
         # Quick non-eval summary every N training steps, at the end of every microbatch group, including when we are not doing a _full eval_ here so that the resulting stats are complete
         if do_eval:
-            train_acc          = (outputs.detach().argmax(-1) == targets).float().mean().item()
-            train_loss         = loss.detach().cpu().item()
-
-            grad_norm = get_grad_norm(net)
+            valid = targets != loss_fn.ignore_index # packed batches have padding
+            train_metrics.reset()
+            train_metrics.add('train', torch.stack([loss.detach().float(), ((predictions == targets) & valid).sum() / valid.sum(), get_grad_norm(net)]))
+            train_metrics.all_reduce()
+            train_loss, train_acc, grad_norm = train_metrics.compute()['train'].values()
 
             train_losses.append(train_loss)
             train_accs.append(train_acc)
@@ -1022,27 +2505,21 @@ def train(net: SpeedyLangNet | None = None, **settings):
             # Step the optimizer, then scheduler
             opt.step()
 
-            # Dynamic weight decay scheduling. Based upon something similar to the reciprocal of the perplexity of the network over the data [inspired by section 5 of https://arxiv.org/pdf/2204.02311.pdf]
-            # Smaller models have a higher base, and weight decay kicks in more sharply later. For larger models, it activates more early
-            opt.param_groups[0]['weight_decay'] = 1./weight_decay_pow_base**(loss.detach()+1e-8).item() * hyp['opt']['weight_decay']
+            # The inputs of the weight decay & microbatch schedulers, read back asynchronously, and applied after the next forward/backward (at the top of the loop).
+            # The weight decay is set before the next `opt.step`, same as if it was set right here. The grad norm's microbatch update arrives one step later than that
+            # would, though: it only takes effect on the dithered draw of the next step. The same grad norm & loss on all ranks, so that they make the same decisions.
+            step_metrics.reset()
+            step_metrics.add('loss', loss.detach().float().view(1))
+            if curr_step % hyp['opt']['microbatch']['sample_every'] == 0:
+                step_metrics.add('grad_norm', get_grad_norm(net).view(1))
+            step_metrics.all_reduce()
+            step_metrics.start_readback()
+            step_metrics_ready = True
             scheduler.step()
 
             # Check if we need to double our sequence length
             if curr_step % hyp['misc']['sequence_length']['growth_steps'] == 0 and curr_step != 0 and curr_length < hyp['misc']['sequence_length']['max']:
-                curr_length, curr_batchsize = grow_sequence_length(curr_length, curr_batchsize)
-
-            # The next several lines calculate a dynamic batchsize, simulated through manual dithering
-            # There could be improvements or losses in changing the dithering strategy, since determinism and gradient descent can lead to some very not-so-nice (and subtle) loss oscillations.
-            if curr_step % hyp['opt']['microbatch']['sample_every'] == 0:
-                grad_norm = get_grad_norm(net)
-
-                grad_norm_per_param = grad_norm/(total_trainable_params**.5) # This should keep the expected grad norm per parameter roughly the same (ignoring initializations) unless I did my napkin math wrong (feel free to correct it and test it out if so! <3 :') )
-                grad_norm_target    = (((microbatch_grad_norm_steps_scale * (curr_step + 1e-2))) ** microbatch_expected_grad_norm_pow)
-                ratio_diff          = grad_norm_per_param/(grad_norm_target)
-
-                # Update the fractional number of steps based on the % difference between the grad norm and expected grad norm.
-                microbatch_steps *= 1. + (hyp['opt']['microbatch']['sample_every'] * hyp['opt']['microbatch']['scale_lr'] * (ratio_diff - 1))
-                microbatch_steps  = max(microbatch_steps, 1e-1) # Clamp to keep this from going to zero, so that we can bounce back if needed
+                curr_length, curr_batchsize = grow_sequence_length(curr_length, curr_batchsize, batchsize_table)
 
             # simple bernoulli dithering with probabilities based on how close we are to each integer
             base, dither_prob = divmod(microbatch_steps, 1)
@@ -1057,17 +2534,16 @@ def train(net: SpeedyLangNet | None = None, **settings):
             curr_step += 1
 
         if do_eval:
-            ender.record()
-            torch.cuda.synchronize()
-
-            t_secs += 1e-3 * starter.elapsed_time(ender)
-            train_loss = loss.detach().cpu().item() # Update the loss for the training details printout
+            t_secs += timer.stop()
 
-            (
-                val_acc, val_loss_causal, val_pplx,
-                val_loss_planning, val_acc_planning, val_pplx_planning,
-                val_loss_acting, val_acc_acting, val_pplx_acting,
-            ) = quick_evaluation(net)
+            # Every rank evaluated its own batches (averaged across ranks in there). The slowest rank's time decides about stopping, for all ranks.
+            eval_results = quick_evaluation(net)
+            if get_world_size() > 1:
+                t_secs = max(all_gather_object(t_secs))
+            val_loss_causal, val_acc                 = eval_results['loss_causal'], eval_results['acc_causal']
+            val_loss_planning, val_acc_planning      = eval_results['loss_planning'], eval_results['acc_planning']
+            val_loss_acting, val_acc_acting          = eval_results['loss_acting_full'], eval_results['acc_acting_full']
+            val_pplx, val_pplx_planning, val_pplx_acting = calc_pplx(val_loss_causal), calc_pplx(val_loss_planning), calc_pplx(val_loss_acting)
 
             val_losses_causal.append(val_loss_causal)
             val_accs_causal.append(val_acc)
@@ -1080,39 +2556,51 @@ def train(net: SpeedyLangNet | None = None, **settings):
             val_pplxs_acting.append(val_pplx_acting)
             
             
-            if settings['log_wandb']:
-                wandb.log({
-                    'train/loss': train_loss,
-                    'train/acc': train_acc,
-                    'train/pplx': calc_pplx(train_loss),
-                    'val/loss/causal': val_loss_causal, 
-                    'val/acc/causal': val_acc, 
-                    'val/pplx/causal': val_pplx,
-                    'val/loss/planning': val_loss_planning,
-                    'val/acc/planning': val_acc_planning,
-                    'val/pplx/planning': val_pplx_planning,
-                    'val/loss/acting': val_loss_acting,
-                    'val/acc/acting': val_acc_acting,
-                    'val/pplx/acting': val_pplx_acting,
-                    'tokens_seen': tokens_seen, 
-                    'epoch': epoch,
-                    'batch_size': curr_batchsize,
-                    'sequence_length': curr_length,
-                    'cumulative_time': t_secs,
-                    'learning_rate': opt.param_groups[0]['lr'],
-                    'weight_decay': opt.param_groups[0]['weight_decay'],
-                })
+            if sink is not None:
+                sink.emit({'eval_idx': num_evals, **{name: values[-1] for name, values in zip(history_names, history)}})
 
             # Print out our training details
             ## We also check to see if we're on our final eval loop (assum that max_curr_step lines up with the eval_every value) so we can print the 'bottom' of the table for each round.
             print_training_details(format_for_table(variables_to_log, locals=locals()), is_final_entry=stop_run)
 
-            torch.cuda.synchronize()
-            starter.record()
+            num_evals += 1
+            if checkpoint_path is not None and (num_evals % hyp['opt']['save_every_n_evals'] == 0 or stop_run):
+                # The state that differs between ranks (their data streams), gathered in rank order
+                rank_state = {
+                    'sampler': sampler.state_dict(),
+                    'plan_act_carry': {key: value.cpu() if isinstance(value, torch.Tensor) else value for key, value in plan_act_carry.items()} if plan_act_carry else None,
+                }
+                rank_states = all_gather_object(rank_state) if get_world_size() > 1 else [rank_state]
+                step_metrics_state = step_metrics.state_dict() if step_metrics_ready else None # not applied yet, that happens after the next forward/backward
+                if is_main_process():
+                    checkpoint_writer.save({
+                        **net_checkpoint(net, settings),
+                        'optimizer': optimizer_state_dict(opt),
+                        'scheduler': scheduler.state_dict(),
+                        'rng': get_rng_states(),
+                        'loop': {
+                            't_secs': t_secs, 'tokens_seen': tokens_seen, 'curr_step': curr_step,
+                            'curr_microbatch_step': curr_microbatch_step + 1, # as of the next iteration, this one is done after the eval
+                            'microbatch_steps': microbatch_steps, 'discrete_sampled_microbatch_steps': discrete_sampled_microbatch_steps,
+                            'curr_length': curr_length, 'curr_batchsize': curr_batchsize, 'batchsize_table': batchsize_table,
+                            'val_loss_causal': val_loss_causal, 'num_evals': num_evals, 'finished': stop_run,
+                            'step_metrics': step_metrics_state,
+                        },
+                        'ranks': rank_states,
+                        'history': dict(zip(history_names, history)),
+                    }, checkpoint_path)
+
+            if sink is not None and (num_evals % hyp['opt']['save_every_n_evals'] == 0 or stop_run):
+                sink.flush()
+
+            timer.start()
             net.train()
         curr_microbatch_step += 1
-        if stop_run:
-            break
+
+    sampler.close()
+    checkpoint_writer.wait()
+    if sink is not None:
+        sink.close()
 
     return (
         net, val_loss_causal,
@@ -1134,7 +2622,7 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "-c", "--log_csv", 
         action="store_true", 
-        help="Log results to csv-file. FLAG"
+        help="Log results to the --logfile. FLAG"
     )
     parser.add_argument(
         "--append", 
@@ -1144,9 +2632,15 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--logfile", 
         type=str,
-        default="results_041.csv", 
-        help="Log the results to this file. "
-        "TYPE: str; DEFAULT: 'results_041.csv'"
+        default="results/run_store", 
+        help="Log the results to this run store directory (see run_store.py), or to this csv-file, if it ends in .csv (one row per run, with stringified lists). "
+        "TYPE: str; DEFAULT: 'results/run_store'"
+    )
+    parser.add_argument(
+        "--metrics_csv",
+        type=str, default=None,
+        help="Also stream the metrics of every run to this csv-file while it trains, one row per eval point (appended to, if it exists). "
+        "TYPE: str; DEFAULT: None"
     )
     parser.add_argument(
         "-w", "--log_wandb", 
@@ -1248,6 +2742,88 @@ def get_args() -> argparse.Namespace:
         help="1.0 is for a 40GB A100; reduce or increase as needed. You may need to include some slack. "
         "TYPE: float; DEFAULT: 1.0"
     )
+    parser.add_argument(
+        "--data_sampling",
+        type=str, choices=["random", "permutation", "packed"], default="random",
+        help="How to sample the training sequences. 'random' draws every start index uniformly (with replacement). "
+        "'permutation' goes through the data in epochs, visiting every window of the current sequence length once, in random order. "
+        "'packed' does the same with windows that are packed with whole documents, which only attend within themselves "
+        "(needs data prepared with document starts, and an extra batch x length x length mask per forward). "
+        "TYPE: str; DEFAULT: 'random'"
+    )
+    parser.add_argument(
+        "--num_prefetch",
+        type=int, default=2,
+        help="Number of training batches to load ahead of time in the background. "
+        "Doesn't change which batches are used. TYPE: int; DEFAULT: 2"
+    )
+    parser.add_argument(
+        "--autotune_batchsize",
+        action="store_true",
+        help="Measure the memory of a training step at every sequence length before training, and use the largest batchsizes "
+        "that fit into --memory_budget, instead of the ones derived from --gpu_capacity_scalar. FLAG"
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float, default=None,
+        help="Memory (in GiB) that --autotune_batchsize fits the batchsizes into. "
+        f"TYPE: float; DEFAULT: None ({100*AUTOTUNE_MEMORY_FRACTION:.0f}%% of the device's memory, shared between the jobs of a --devices sweep on the same device)"
+    )
+    parser.add_argument(
+        "--device",
+        type=str, default=hyp['misc']['device'],
+        help="Device to train and evaluate on, for example 'cuda', 'cuda:1' or 'cpu'. "
+        f"TYPE: str; DEFAULT: '{hyp['misc']['device']}' (cuda if available, else cpu)"
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str, choices=["bfloat16", "float16", "float32"], default="bfloat16",
+        help="Dtype of the network weights and activations. "
+        "TYPE: str; DEFAULT: 'bfloat16'"
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str, default=None,
+        help="If set, save every trained network to this directory (as <run name>.pt), e.g. to serve it with `python serve.py`. "
+        "TYPE: str; DEFAULT: None"
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str, choices=["nccl", "gloo"], default=None,
+        help="Backend for data-parallel training, which is used when launched with torchrun (e.g. `torchrun --nproc_per_node 2 main.py ...`). "
+        "TYPE: str; DEFAULT: None (nccl on cuda, gloo otherwise)"
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str, default=None,
+        help="If set, write a training checkpoint (as <run name>.ckpt) every `save_every_n_evals` evals and at the end of every run. "
+        "Checkpoints are written in the background and hold everything needed to resume exactly. "
+        "TYPE: str; DEFAULT: None"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume every run from its checkpoint in --checkpoint_dir, if there is one (finished runs aren't trained any further). FLAG"
+    )
+    parser.add_argument(
+        "--devices",
+        type=str, nargs="+", default=None,
+        help="Run the sweep in parallel worker processes on these devices (e.g. `--devices cuda:0 cuda:1`), "
+        "as many jobs per device as fit with --gpu_capacity_scalar. Results are logged as the runs finish. "
+        "TYPE: list[str]; DEFAULT: None (run everything one after the other in this process, on --device)"
+    )
+    parser.add_argument(
+        "--jobs_per_device",
+        type=int, default=None,
+        help="Number of jobs to run on each of the --devices at the same time. "
+        "TYPE: int; DEFAULT: None (as many as fit into a cuda device's memory with --gpu_capacity_scalar; 1 on cpu)"
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int, default=1,
+        help="How often a failed job of a --devices sweep is retried (from its checkpoint, if there's a --checkpoint_dir). "
+        "TYPE: int; DEFAULT: 1"
+    )
     parser.add_argument(
         "--seed", 
         type=int, default=100, 
@@ -1316,6 +2892,16 @@ def get_args() -> argparse.Namespace:
         type=int, default=5,
         help="Top-k for the acting task. TYPE: int; DEFAULT: 5"
     )
+    parser.add_argument(
+        "--plan_act_schedule",
+        type=str, choices=["sequential", "pipelined"], default="sequential",
+        help="How to schedule the planning and acting forward passes. "
+        "'sequential' plans and then acts on every microbatch (two forward passes). "
+        "'pipelined' acts on the previous microbatch's plans in the same forward pass as it plans the current one "
+        "(one forward pass, but the plans are one microbatch old). "
+        "Use `python benchmarks.py plan_act_schedule` to see which is faster on your hardware. "
+        "TYPE: str; DEFAULT: 'sequential'"
+    )
 
     # PARSE ARGS
     args = parser.parse_args()
@@ -1333,6 +2919,10 @@ def get_args() -> argparse.Namespace:
     args.linear_value = [args.linear_value] if isinstance(args.linear_value, int) else args.linear_value
     args.linear_value = list(set([bool(v) for v in args.linear_value]))
 
+    if args.resume and args.checkpoint_dir is None:
+        raise ValueError("--resume needs the --checkpoint_dir to resume from.")
+    if args.devices is not None and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        raise ValueError("--devices runs a sweep in independent processes, it can't be combined with data-parallel training.")
     if args.plan_act and args.loss_divider_method == "zip" and len(args.planning_divider) != len(args.acting_divider):
         raise ValueError("If loss_divider_method is 'zip', all dividers must have the same length.")
 
@@ -1434,6 +3024,327 @@ def get_run_name(
     return run_name
 
 
+##############################
+#        Sweep Runner        #
+##############################
+
+# Every (setting, seed) pair of a sweep is an independent training run, a "job". With --devices, the jobs are fanned out over
+# worker processes instead of running one after the other. Every job gets a freshly spawned process (a clean CUDA context, and
+# a crashed or OOM-killed run can't take the sweep down with it), and a device runs as many jobs side by side as their
+# memory budget allows: --gpu_capacity_scalar is in units of a 40 GB A100, so e.g. four 0.25-jobs share one A100.
+# Failed jobs are retried (resuming from their checkpoint if there is a --checkpoint_dir), and every finished job is
+# appended to the logfile right away, so the rows are in order of completion, not of the settings.
+
+REFERENCE_DEVICE_MEMORY = 40 * 1024**3 # What a --gpu_capacity_scalar of 1.0 fills up
+
+
+def get_sweep_jobs(args: argparse.Namespace, settings: list[tuple]) -> list[dict[str, Any]]:
+    # Every setting goes through the same seeds over its different runs
+    return [
+        dict(job_num=setting_num * args.num_runs + run_num, setting_num=setting_num, setting=setting, run_num=run_num, seed=args.seed + run_num)
+        for setting_num, setting in enumerate(settings)
+        for run_num in range(args.num_runs)
+    ]
+
+
+def get_device_slots(devices: list[str], gpu_capacity_scalar: float, jobs_per_device: int | None = None) -> list[str]:
+    # One entry per job that can run at the same time; interleaved over the devices, so that jobs get spread out before they get packed.
+    # Listing a device more than once adds its slots again.
+    slots_per_device = []
+    for device in devices:
+        if jobs_per_device is not None:
+            num_slots = jobs_per_device
+        elif is_cuda_device(device):
+            total_memory = torch.cuda.get_device_properties(torch.device(device)).total_memory
+            num_slots = max(1, math.floor(total_memory / (REFERENCE_DEVICE_MEMORY * gpu_capacity_scalar)))
+        else:
+            num_slots = 1 # the cpu is shared by everything anyway; set --jobs_per_device to pack more
+        slots_per_device.append((device, num_slots))
+
+    return [device for i in range(max(n for _, n in slots_per_device)) for device, num_slots in slots_per_device if i < num_slots]
+
+
+def run_job(args: argparse.Namespace, job: dict[str, Any], num_jobs: int, num_settings: int, resume: bool = False) -> dict[str, list]:
+    import polars as pl
+
+    scale, depth, width, num_heads, linear_value, planning_divider, acting_divider = job['setting']
+    seed, run_num = job['seed'], job['run_num']
+
+    # Change the model scale; width is rounded to nearest 64, and both are None if scaled by model_scale -> get depth and width here
+    num_params, num_non_embedding_params, depth, width = change_model_scale(scale, depth, width, num_heads)
+
+    # Print some feedback
+    title = (
+        f"::: STARTING RUN {job['job_num']+1}/{num_jobs} "
+        f"(Setting {job['setting_num']+1}/{num_settings}, Run {run_num+1}/{args.num_runs})"
+        f"\n:::    {num_heads=}"
+        f"\n:::    {linear_value=}"
+        f"\n:::    {model_scale=:.4f}"
+        f"\n:::    {depth=}"
+        f"\n:::    {width=}"
+        f"\n:::    num_params={format_num_params(num_params)}"
+        f"\n:::    num_non_embedding_params={format_num_params(num_non_embedding_params)}"
+        f"\n:::    plan_act={args.plan_act}"
+        f"\n:::    {planning_divider=}"
+        f"\n:::    {acting_divider=}"
+        f"\n:::    planner_masking_rate={args.planner_masking_rate}"
+        f"\n:::    actor_masking_rate={args.actor_masking_rate}"
+        f"\n:::    randomize_masking_rate={args.randomize_masking_rate}"
+        f"\n:::    top_k={args.top_k}"
+        f"\n:::    plan_act_schedule={args.plan_act_schedule}"
+    )
+    max_len = max(len(line) for line in title.split("\n"))
+    title = "\n".join([line + " " * (max_len - len(line)) + " :::" for line in title.split("\n")])
+    sep = ":" * max(len(line) for line in title.split("\n"))
+    title = "\n\n" + "\n".join([sep, title, sep]) + "\n\n"
+    print(title)
+
+    # Seed
+    torch.manual_seed(seed)
+    random.seed(seed)
+
+    run_name = get_run_name(
+        depth=depth,
+        width=width,
+        seed=seed,
+        num_heads=num_heads,
+        linear_value=linear_value,
+        plan_act=args.plan_act,
+        planning_divider=planning_divider,
+        acting_divider=acting_divider,
+        randomize_masking_rate=args.randomize_masking_rate,
+        top_k=args.top_k,
+    )
+    checkpoint_path = os.path.join(args.checkpoint_dir, run_name + ".ckpt") if args.checkpoint_dir is not None else None
+
+    # The metadata of the run. It goes into the run store right away (if we log to one), so that partial runs can be told apart, too.
+    run_info = {
+        "run_name": run_name,
+        "plan_act": args.plan_act,
+        "planning_divider": planning_divider,
+        "acting_divider": acting_divider,
+        "randomize_masking_rate": args.randomize_masking_rate,
+        "top_k": args.top_k,
+        "model_scale": model_scale,
+        "depth": hyp['net']['num_blocks'],
+        "width": hyp['net']['residual_depth'],
+        "num_params": num_params,
+        "num_non_embedding_params": num_non_embedding_params,
+        "num_heads": num_heads,
+        "linear_value": linear_value,
+        "seed": seed,
+        "run_num": run_num+1,
+        "max_epochs": args.max_epochs,
+        "max_steps": args.max_steps,
+        "max_tokens": args.max_tokens,
+        "max_time_seconds": args.max_time_seconds,
+        "gpu_capacity_scalar": args.gpu_capacity_scalar,
+    }
+    run_store, run_id = args.logfile if args.log_csv and not args.logfile.endswith(".csv") else None, run_name
+    if run_store is not None and is_main_process():
+        from run_store import RunStore
+        # Only a run that `train` will actually resume (from its checkpoint) continues the latest run of its name, any other gets an id of its own
+        resuming = resume and checkpoint_path is not None and os.path.exists(checkpoint_path)
+        run_id = RunStore(run_store).new_run_id(run_name, resume=resuming)
+        RunStore(run_store).write_run(run_id, {"last_val_loss": None, **run_info, "full_evaluation_file": None, "finished": False})
+
+    # Train
+    (
+        net, last_val_loss,
+        train_losses, train_pplxs, train_accs,
+        val_losses_causal, val_accs_causal, val_pplxs_causal,
+        val_losses_planning, val_accs_planning, val_pplxs_planning,
+        val_losses_acting, val_accs_acting, val_pplxs_acting,
+        grad_norms, cumulative_times,
+        tokens_seen_list, epochs_list,
+        batch_sizes, sequence_lengths, learning_rates, weight_decays,
+    ) = train(
+        net=None,  # you can give this the net and it will just continue training on it
+        depth=depth,
+        width=width,
+        num_heads=num_heads,
+        linear_value=linear_value,
+        max_epochs=args.max_epochs,
+        max_steps=args.max_steps,
+        max_tokens=args.max_tokens,
+        max_time_seconds=args.max_time_seconds,
+        log_wandb=args.log_wandb,
+        wandb_project=args.wandb_project,
+        # include everything you want to log to wandb below, even if it's not used in the training function
+        num_params=num_params,
+        num_non_embedding_params=num_non_embedding_params,
+        model_scale=model_scale,
+        gpu_token_capacity=gpu_token_capacity,
+        tokens_per_batch_capacity=tokens_per_batch_capacity,
+        max_sequence_length=max_sequence_length,
+        seed=seed,
+        plan_act=args.plan_act,
+        planning_divider=planning_divider,
+        acting_divider=acting_divider,
+        randomize_masking_rate=args.randomize_masking_rate,
+        top_k=args.top_k,
+        plan_act_schedule=args.plan_act_schedule,
+        planner_masking_rate=args.planner_masking_rate,
+        actor_masking_rate=args.actor_masking_rate,
+        checkpoint_path=checkpoint_path,
+        resume=resume,
+        autotune_batchsize=args.autotune_batchsize,
+        data_sampling=args.data_sampling,
+        num_prefetch=args.num_prefetch,
+        memory_budget=int(args.memory_budget * 2**30) if args.memory_budget is not None else None,
+        run_store=run_store,
+        metrics_csv=args.metrics_csv,
+        run_id=run_id,
+    )
+
+    # TODO: if args.plan_act, do a full evaluation here; save it; save reference to it in results
+    # Every rank evaluates its share of the eval set, only the main process writes the (all-reduced) results
+    if args.plan_act:
+        full_eval_results = full_evaluation(net)
+        full_eval_path = "results/full_evaluations/" + run_name + ".csv"
+        if is_main_process():
+            os.makedirs("results/full_evaluations", exist_ok=True)
+            pl.DataFrame(full_eval_results).write_csv(full_eval_path)
+    else:
+        full_eval_path = None
+
+    if args.save_dir is not None and is_main_process():
+        save_net(net, os.path.join(args.save_dir, run_name + ".pt"), dict(depth=depth, width=width, linear_value=linear_value, num_heads=num_heads))
+
+    # You can do whatever you want with your net here; I delete it to save VRAM
+    del net
+
+    # The curves are lists here, `log_results` decides how to store them
+    return {
+        "run_id": [run_id],
+        "last_val_loss": [last_val_loss],
+        **{name: [value] for name, value in run_info.items()},
+        "train_loss": [train_losses],
+        "train_pplx": [train_pplxs],
+        "train_acc": [train_accs],
+        "val_loss_causal": [val_losses_causal],
+        "val_acc_causal": [val_accs_causal],
+        "val_pplx_causal": [val_pplxs_causal],
+        "val_loss_planning": [val_losses_planning],
+        "val_acc_planning": [val_accs_planning],
+        "val_pplx_planning": [val_pplxs_planning],
+        "val_loss_acting": [val_losses_acting],
+        "val_acc_acting": [val_accs_acting],
+        "val_pplx_acting": [val_pplxs_acting],
+        "grad_norm": [grad_norms],
+        "cumulative_time": [cumulative_times],
+        "tokens_seen": [tokens_seen_list],
+        "epoch": [epochs_list],
+        "batch_size": [batch_sizes],
+        "seq_length": [sequence_lengths],
+        "learning_rate": [learning_rates],
+        "weight_decay": [weight_decays],
+        "full_evaluation_file": [full_eval_path],
+    }
+
+
+def log_results(args: argparse.Namespace, results: dict[str, list], overwrite: bool = False) -> None:
+    # Into the run store (see run_store.py), where `train` has already written the curves, so only the run's metadata is left to update.
+    # Or as a row of the old csv format, with every curve as a stringified list, if the logfile is a .csv file.
+    import polars as pl
+
+    if not args.logfile.endswith(".csv"):
+        from run_store import RunStore
+        info = {name: values[0] for name, values in results.items() if name not in history_names}
+        RunStore(args.logfile).write_run(info.pop("run_id", info["run_name"]), {**info, "finished": True})
+        return
+
+    df = pl.DataFrame({
+        name: [str(values[0])] if name in history_names else values
+        for name, values in results.items() if name not in ("run_id", "run_name")
+    })
+    if not os.path.exists(args.logfile) or overwrite:
+        df.write_csv(args.logfile)
+    else:
+        with open(args.logfile, 'ab') as f:
+            df.write_csv(f, include_header=False)
+
+
+def _sweep_worker(
+        args: argparse.Namespace, job: dict[str, Any], num_jobs: int, num_settings: int,
+        device: str, jobs_on_device: int, resume: bool, result_queue: "multiprocessing.Queue",
+) -> None:
+    # Runs in a freshly spawned process, so everything module-level is at its defaults here
+    try:
+        hyp['misc']['device'] = device
+        hyp['misc']['dtype'] = getattr(torch, args.dtype)
+        if is_cuda_device(device) and torch.device(device).index is not None:
+            torch.cuda.set_device(torch.device(device))
+        ctx.reset()
+        if args.autotune_batchsize and args.memory_budget is None:
+            args.memory_budget = get_memory_budget(AUTOTUNE_MEMORY_FRACTION / jobs_on_device) / 2**30 # the jobs packed onto a device share it
+        change_gpu_token_capacity(args.gpu_capacity_scalar)
+        result_queue.put((job['job_num'], run_job(args, job, num_jobs, num_settings, resume), None))
+    except BaseException:
+        result_queue.put((job['job_num'], None, traceback.format_exc()))
+
+
+def run_sweep(args: argparse.Namespace, jobs: list[dict[str, Any]], num_settings: int) -> None:
+    slots = get_device_slots(args.devices, args.gpu_capacity_scalar, args.jobs_per_device)
+    jobs_per_device = collections.Counter(slots)
+    print(f"| sweep: {len(jobs)} job(s) on {len(slots)} slot(s) {dict(jobs_per_device)}")
+
+    mp_context   = multiprocessing.get_context('spawn') # cuda can't be used in forked processes
+    result_queue = mp_context.Queue()
+    pending      = collections.deque(jobs)
+    running      = {} # job_num -> (job, device, process)
+    attempts     = collections.Counter()
+    failed, num_done, overwrite = [], 0, not args.append
+
+    try:
+        while pending or running:
+            while pending and slots:
+                job, device = pending.popleft(), slots.pop(0)
+                # A retry picks up from the last checkpoint of the failed attempt, if there is one
+                resume  = args.resume or (attempts[job['job_num']] > 0 and args.checkpoint_dir is not None)
+                process = mp_context.Process(target=_sweep_worker, args=(args, job, len(jobs), num_settings, device, jobs_per_device[device], resume, result_queue))
+                process.start()
+                running[job['job_num']] = (job, device, process)
+
+            try:
+                job_num, results, error = result_queue.get(timeout=1.)
+            except queue.Empty:
+                # A worker that died without reporting back (segfault, OOM killer, ...) is a failed job, too
+                crashed = [job_num for job_num, (_, _, process) in running.items() if process.exitcode not in (None, 0)]
+                if not crashed:
+                    continue
+                job_num, results, error = crashed[0], None, f"worker process exited with code {running[crashed[0]][2].exitcode}"
+            if job_num not in running:
+                continue # late report of a worker that was already counted as crashed
+
+            job, device, process = running.pop(job_num)
+            process.join()
+            slots.append(device)
+
+            if error is None:
+                num_done += 1
+                print(f"| sweep: job {job_num+1}/{len(jobs)} finished on {device} | {num_done}/{len(jobs)} done, {len(running)} running, {len(pending)} pending")
+                if args.log_csv:
+                    log_results(args, results, overwrite=overwrite)
+                    overwrite = False
+                continue
+
+            attempts[job_num] += 1
+            retry = attempts[job_num] <= args.max_retries
+            print(f"| sweep: job {job_num+1}/{len(jobs)} failed on {device} (attempt {attempts[job_num]}/{args.max_retries+1}){', retrying' if retry else ''}\n{error}")
+            if retry:
+                pending.append(job)
+            else:
+                failed.append(job_num)
+    finally:
+        for _, _, process in running.values():
+            process.terminate()
+            process.join()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)}/{len(jobs)} sweep job(s) failed: {[job_num+1 for job_num in sorted(failed)]}")
+
+
 def main():
     args = get_args()
     settings = get_settings(args)
@@ -1451,167 +3362,33 @@ def main():
             print("Aborting.")
             return
 
-    cumulative_run_num = 0
-    total_num_runs = int(len(settings) * args.num_runs)
-
-    global hyp, model_scale
+    hyp['misc']['device'] = args.device
+    hyp['misc']['dtype'] = getattr(torch, args.dtype)
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        init_distributed(args.dist_backend)
+    ctx.reset()  # the constant buffers are rebuilt on the selected device/dtype
+    if get_world_size() > 1:
+        # Only one rank prepares the data (if necessary), the others wait for it and then just memory-map the shards
+        if is_main_process():
+            ctx.data
+        dist.barrier()
     change_gpu_token_capacity(args.gpu_capacity_scalar)
 
-    for setting_num, (model_scale, depth, width, num_heads, linear_value, planning_divider, acting_divider) in enumerate(settings):
-        seed = args.seed  # reset seed so that every setting goes through the same seeds over the different runs
-
-        # Change the model scale; width is rounded to nearest 64, and both are None if scaled by model_scale -> get depth and width here
-        num_params, num_non_embedding_params, depth, width = change_model_scale(model_scale, depth, width, num_heads)
-        for run_num in range(args.num_runs):
-            cumulative_run_num += 1
-
-            # Print some feedback
-            title = (
-                f"::: STARTING RUN {cumulative_run_num}/{total_num_runs} "
-                f"(Setting {setting_num+1}/{len(settings)}, Run {run_num+1}/{args.num_runs})"
-                f"\n:::    {num_heads=}"
-                f"\n:::    {linear_value=}"
-                f"\n:::    {model_scale=:.4f}"
-                f"\n:::    {depth=}"
-                f"\n:::    {width=}"
-                f"\n:::    num_params={format_num_params(num_params)}"
-                f"\n:::    num_non_embedding_params={format_num_params(num_non_embedding_params)}"
-                f"\n:::    plan_act={args.plan_act}"
-                f"\n:::    {planning_divider=}"
-                f"\n:::    {acting_divider=}"
-                f"\n:::    planner_masking_rate={args.planner_masking_rate}"
-                f"\n:::    actor_masking_rate={args.actor_masking_rate}"
-                f"\n:::    randomize_masking_rate={args.randomize_masking_rate}"
-                f"\n:::    top_k={args.top_k}"
-            )
-            max_len = max(len(line) for line in title.split("\n"))
-            title = "\n".join([line + " " * (max_len - len(line)) + " :::" for line in title.split("\n")])
-            sep = ":" * max(len(line) for line in title.split("\n"))
-            title = "\n\n" + "\n".join([sep, title, sep]) + "\n\n"
-            print(title)
-
-            # Seed
-            torch.manual_seed(seed)
-            random.seed(seed)
-
-            # Train
-            (
-                net, last_val_loss,
-                train_losses, train_pplxs, train_accs,
-                val_losses_causal, val_accs_causal, val_pplxs_causal,
-                val_losses_planning, val_accs_planning, val_pplxs_planning,
-                val_losses_acting, val_accs_acting, val_pplxs_acting,
-                grad_norms, cumulative_times,
-                tokens_seen_list, epochs_list,
-                batch_sizes, sequence_lengths, learning_rates, weight_decays,
-            ) = train(
-                net=None,  # you can give this the net and it will just continue training on it
-                depth=depth,
-                width=width,
-                num_heads=num_heads,
-                linear_value=linear_value,
-                max_epochs=args.max_epochs,
-                max_steps=args.max_steps,
-                max_tokens=args.max_tokens,
-                max_time_seconds=args.max_time_seconds,
-                log_wandb=args.log_wandb,
-                wandb_project=args.wandb_project,
-                # include everything you want to log to wandb below, even if it's not used in the training function
-                num_params=num_params,
-                num_non_embedding_params=num_non_embedding_params,
-                model_scale=model_scale,
-                gpu_token_capacity=gpu_token_capacity,
-                tokens_per_batch_capacity=tokens_per_batch_capacity,
-                max_sequence_length=max_sequence_length,
-                seed=seed,
-                plan_act=args.plan_act,
-                planning_divider=planning_divider,
-                acting_divider=acting_divider,
-                randomize_masking_rate=args.randomize_masking_rate,
-                top_k=args.top_k,
-                planner_masking_rate=args.planner_masking_rate,
-                actor_masking_rate=args.actor_masking_rate,
-            )
+    jobs = get_sweep_jobs(args, settings)
+    if args.log_csv and not args.append and not args.logfile.endswith(".csv") and is_main_process():
+        from run_store import RunStore
+        RunStore(args.logfile).clear() # the same as overwriting a csv logfile, but up front, as the runs write their curves as they go
+    if args.devices is not None:
+        ctx.data  # prepare the data (if necessary) once here, instead of in every worker at the same time
+        run_sweep(args, jobs, len(settings))
+    else:
+        for job in jobs:
+            results = run_job(args, job, len(jobs), len(settings), resume=args.resume)
+            if args.log_csv and is_main_process():
+                log_results(args, results, overwrite=(not args.append) and job['job_num'] == 0)
 
-            # TODO: if args.plan_act, do a full evaluation here; save it; save reference to it in results
-            if args.plan_act:
-                full_eval_results = full_evaluation(net)
-                os.makedirs("results/full_evaluations", exist_ok=True)
-                full_eval_path = "results/full_evaluations/" + get_run_name(
-                    depth=depth,
-                    width=width,
-                    num_heads=num_heads,
-                    linear_value=linear_value,
-                    plan_act=args.plan_act,
-                    planning_divider=planning_divider,
-                    acting_divider=acting_divider,
-                    randomize_masking_rate=args.randomize_masking_rate,
-                    top_k=args.top_k,
-                ) + ".csv"
-                pl.DataFrame(full_eval_results).write_csv(full_eval_path)
-            else:
-                full_eval_path = None
-
-            # You can do whatever you want with your net here; I delete it to save VRAM
-            del net 
-
-            # Save results
-            results = {
-                "last_val_loss": [last_val_loss],
-                "plan_act": [args.plan_act],
-                "planning_divider": [planning_divider],
-                "acting_divider": [acting_divider],
-                "randomize_masking_rate": [args.randomize_masking_rate],
-                "top_k": [args.top_k],
-                "randomize_denoiser_settings": [args.randomize_denoiser_settings],
-                "randomize_mask_width": [args.randomize_mask_width],
-                "model_scale": [model_scale],
-                "depth": [hyp['net']['num_blocks']],
-                "width": [hyp['net']['residual_depth']],
-                "num_params": [num_params],
-                "num_non_embedding_params": [num_non_embedding_params],
-                "num_heads": [num_heads],
-                "linear_value": [linear_value],
-                "seed": [seed],
-                "run_num": [run_num+1],
-                "max_epochs": [args.max_epochs],
-                "max_steps": [args.max_steps],
-                "max_tokens": [args.max_tokens],
-                "max_time_seconds": [args.max_time_seconds],
-                "gpu_capacity_scalar": [args.gpu_capacity_scalar],
-                "train_loss": [str(train_losses)],
-                "train_pplx": [str(train_pplxs)],
-                "train_acc": [str(train_accs)],
-                "val_loss_causal": [str(val_losses_causal)],
-                "val_acc_causal": [str(val_accs_causal)],
-                "val_pplx_causal": [str(val_pplxs_causal)],
-                "val_loss_planning": [str(val_losses_planning)],
-                "val_acc_planning": [str(val_accs_planning)],
-                "val_pplx_planning": [str(val_pplxs_planning)],
-                "val_loss_acting": [str(val_losses_acting)],
-                "val_acc_acting": [str(val_accs_acting)],
-                "val_pplx_acting": [str(val_pplxs_acting)],
-                "grad_norm": [str(grad_norms)],
-                "cumulative_time": [str(cumulative_times)],
-                "tokens_seen": [str(tokens_seen_list)],
-                "epoch": [str(epochs_list)],
-                "batch_size": [str(batch_sizes)],
-                "seq_length": [str(sequence_lengths)],
-                "learning_rate": [str(learning_rates)],
-                "weight_decay": [str(weight_decays)],
-                "full_evaluation_file": [full_eval_path],
-            }
-            df = pl.DataFrame(results)
-
-
-            if args.log_csv:
-                if not os.path.exists(args.logfile) or ((not args.append) and (run_num == setting_num == 0)):
-                    df.write_csv(args.logfile)
-                else:
-                    with open(args.logfile, 'ab') as f:
-                        df.write_csv(f, include_header=False)
-
-            seed += 1
+    if get_world_size() > 1:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
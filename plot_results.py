@@ -1,17 +1,45 @@
 
+import argparse
 import ast
-from typing import Literal
+import concurrent.futures
+import glob
+import itertools
+import multiprocessing
+import os
+from typing import Any, Literal
 
 import colorsys
 import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 import polars as pl
 import numpy as np
 
+import results_cache
+import run_store
 
-def close_plt() -> None:
-    plt.cla()
-    plt.clf()
-    plt.close()
+
+# The columns that hold the x-values of the curves, for `plot_over`
+X_COLUMNS = {"epoch": "epoch", "token": "tokens_seen", "time_sec": "cumulative_time"}
+
+# The settings that are always in the labels of `draw_metric_curves` (if they're in the results), the others only if they're set or vary
+LABEL_COLUMNS = ("num_heads", "linear_value", "depth", "width")
+
+# The metrics that `plot_grid` plots by default
+PLOT_METRICS = (
+    "train_loss", "val_loss_causal", "val_loss_planning", "val_loss_acting",
+    "train_acc", "val_acc_causal", "val_acc_planning", "val_acc_acting",
+    "train_pplx", "val_pplx_causal", "val_pplx_planning", "val_pplx_acting",
+)
+
+# The settings that `plot_metric_curves` groups runs by (those of them that are in the results file, that is), in plotting order
+SETTING_COLUMNS = (
+    "num_heads", "linear_value", "depth", "width",
+    "ul2", "causal_denoisers", "randomize_denoiser_settings",
+    "randomize_mask_width", "causal_divider", "s_divider",
+    "r_divider", "x_divider",
+    "plan_act", "planning_divider", "acting_divider", "randomize_masking_rate", "top_k",
+)
 
 
 def series_to_array(series: pl.Series) -> np.ndarray:
@@ -65,8 +93,8 @@ def load_xs_ys_avg_y(
         to_plot: Literal["val_loss", "train_losses", "val_accs", "train_accs", "val_pplxs", "train_pplxs"] = "val_loss",
         plot_over: Literal["step", "epoch", "token", "time_sec"] = "step",
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Load x, y, and average y from a CSV file."""
-    filters = (pl.col("last_val_loss").ge(0))  # initial condition -> always true
+    """Load x, y, and average y from a run store (see run_store.py), or an old CSV results file."""
+    filters = pl.lit(True)
 
     if model_scale is not None:
         filters &= (pl.col("model_scale") == model_scale)
@@ -101,24 +129,31 @@ def load_xs_ys_avg_y(
     if x_divider is not None:
         filters &= (pl.col("x_divider") == x_divider)
 
-    df = pl.scan_csv(file).filter(filters).collect()
-    df.sort("run_num")
-    arrays = [series_to_array(df[to_plot][i]) for i in range(len(df[to_plot]))]
+    if plot_over != "step" and plot_over not in X_COLUMNS:
+        raise ValueError(f"{plot_over} not a valid x-value")
 
+    curves = load_curves(file, filters, [to_plot] + ([X_COLUMNS[plot_over]] if plot_over in X_COLUMNS else []))
     if plot_over == "step":
-        return load_steps_ys_avg_ys(df, arrays)
-    elif plot_over == "epoch":
-        return load_epochs_ys_avg_ys(df, arrays)
-    elif plot_over == "token":
-        return load_tokens_ys_avg_ys(df, arrays)
-    elif plot_over == "time_sec":
-        return load_time_ys_avg_ys(df, arrays)
-    else:
-        raise ValueError(f"{plot_over} not a valid x-value")
+        return load_steps_ys_avg_ys(curves[to_plot])
+    return interpolate_linearly(curves[X_COLUMNS[plot_over]], curves[to_plot])
+
+
+def scan_runs(file: str) -> pl.LazyFrame:
+    # One row per run, with its settings (and, in an old CSV results file, its curves)
+    return run_store.RunStore(file).scan_runs() if run_store.is_run_store(file) else pl.scan_csv(file)
+
+
+def load_curves(file: str, filters: pl.Expr, columns: list[str]) -> dict[str, list[np.ndarray]]:
+    # The `columns` curves of every run that matches the `filters`, ordered by run_num
+    if run_store.is_run_store(file):
+        return run_store.RunStore(file).load_curves(filters, columns)
+
+    # The old format: one row per finished run, with the curves as stringified lists
+    df = scan_runs(file).filter(pl.col("last_val_loss").ge(0) & filters).select("run_num", *columns).collect().sort("run_num")
+    return {column: [series_to_array(value) for value in df[column]] for column in columns}
 
 
 def load_steps_ys_avg_ys(
-        df: pl.DataFrame,
         arrays: list[np.ndarray],
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     min_len = min([len(a) for a in arrays])
@@ -129,30 +164,6 @@ def load_steps_ys_avg_ys(
     return xs, ys, avg_ys
 
 
-def load_epochs_ys_avg_ys(
-        df: pl.DataFrame,
-        arrays: list[np.ndarray],
-) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    xs = [series_to_array(df["epoch"][i]) for i in range(len(df["epoch"]))]
-    return interpolate_linearly(xs, arrays)
-
-
-def load_tokens_ys_avg_ys(
-        df: pl.DataFrame,
-        arrays: list[np.ndarray],
-) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    xs = [series_to_array(df["tokens_seen"][i]) for i in range(len(df["tokens_seen"]))]
-    return interpolate_linearly(xs, arrays)
-
-
-def load_time_ys_avg_ys(
-        df: pl.DataFrame,
-        arrays: list[np.ndarray],
-) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    xs = [series_to_array(df["cumulative_time"][i]) for i in range(len(df["cumulative_time"]))]
-    return interpolate_linearly(xs, arrays)
-
-
 def interpolate_linearly(
         xs: list[np.ndarray], ys: list[np.ndarray], num_samples: int = 500,
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
@@ -162,14 +173,9 @@ def interpolate_linearly(
     # Generate a single set of new x values for all datasets
     new_x_vals = np.linspace(0, max_x, num_samples)
 
-    new_ys = []
-    for x_vals, y_vals in zip(xs, ys):
-        # Interpolate y to the common set of new x values
-        new_y_vals = np.interp(new_x_vals, x_vals, y_vals)
-        new_ys.append(new_y_vals)
-
-    # Convert new_ys to a 2D numpy array for easy manipulation
-    new_ys = np.array(new_ys)
+    # Interpolate all ys to the common set of new x values at once
+    lengths = np.array([len(x_vals) for x_vals in xs])
+    new_ys  = interpolate_rows(np.tile(new_x_vals, (len(xs), 1)), pad_curves(xs, lengths), pad_curves(ys, lengths))
     
     # Calculate the average y values across all datasets
     avg_ys = np.nanmean(new_ys, axis=0)
@@ -177,12 +183,148 @@ def interpolate_linearly(
     return new_x_vals, new_ys, avg_ys
 
 
+def pad_curves(arrays: list[np.ndarray], lengths: np.ndarray) -> np.ndarray:
+    # Curves of different lengths as one (num_curves, max_length) array, every curve extended by repeating its last value
+    values = np.full((len(arrays), max(lengths.max(), 2)), np.nan)
+    values[np.repeat(np.arange(len(arrays)), lengths), np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = np.concatenate(arrays)
+    return np.take_along_axis(values, np.minimum(np.arange(values.shape[1]), lengths[:, None] - 1), axis=1)
+
+
+def interpolate_rows(new_xs: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    # `np.interp(new_xs[i], xs[i], ys[i])` for every row i at once: (num_curves, num_samples) from (num_curves, length) curves with ascending xs.
+    # Offsetting every row by more than the range of all values lays the rows out one after the other on a single axis,
+    # so that one `searchsorted` finds the segments of all new xs.
+    num_curves, length = xs.shape
+    low     = min(xs.min(), new_xs.min())
+    offsets = np.arange(num_curves)[:, None] * (max(xs.max(), new_xs.max()) - low + 1.)
+    idxs    = np.searchsorted((xs - low + offsets).ravel(), (new_xs - low + offsets).ravel(), side="right").reshape(new_xs.shape)
+    idxs    = np.clip(idxs - np.arange(num_curves)[:, None] * length - 1, 0, length - 2)
+
+    x0, x1 = np.take_along_axis(xs, idxs, axis=1), np.take_along_axis(xs, idxs + 1, axis=1)
+    y0, y1 = np.take_along_axis(ys, idxs, axis=1), np.take_along_axis(ys, idxs + 1, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Like `np.interp`, new xs before the first (after the last) x get the first (last) y
+        weights = np.clip(np.where(x1 > x0, (new_xs - x0) / (x1 - x0), 0.), 0., 1.)
+    return y0 + weights * (y1 - y0)
+
+
+class Results:
+    """ All runs of a results file, read once: their settings, and their curves as padded arrays. From the tables of results_cache.py."""
+    def __init__(self, runs: pl.DataFrame, metrics: pl.DataFrame):
+        self.curves_cache, self.aggregates = {}, {}
+        if "run_id" not in metrics.columns or metrics.is_empty():
+            # No eval points yet (e.g. a run store right after a sweep started, with only the runs' metadata): no settings or curves
+            self.setting_columns, self.runs, self.metrics = [], pl.DataFrame(), pl.DataFrame()
+            self.setting_starts, self.lengths = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            return
+        runs = runs.filter(pl.col("run_id").is_in(metrics["run_id"].unique().implode()))
+
+        # Runs of the same setting end up next to each other (in `run_num` order), so that per-setting reductions are over contiguous rows
+        self.setting_columns = [column for column in SETTING_COLUMNS if column in runs.columns]
+        self.runs = runs.sort(*self.setting_columns, "run_num", "run_id", nulls_last=True, maintain_order=True).with_row_index("run_idx")
+        is_first = pl.int_range(pl.len()) == 0
+        for column in self.setting_columns:
+            is_first |= pl.col(column).ne_missing(pl.col(column).shift())
+        self.setting_starts = self.runs.select(pl.arg_where(is_first))[:, 0].to_numpy()
+
+        self.metrics = (
+            metrics.join(self.runs.select("run_id", "run_idx"), on="run_id")
+            .sort("run_idx", "eval_idx")
+            .drop("run_id", "eval_idx")
+        )
+        self.lengths = np.bincount(self.metrics["run_idx"].to_numpy(), minlength=len(self.runs))
+
+    def settings(self) -> list[dict[str, Any]]:
+        if len(self.runs) == 0:
+            return []
+        return self.runs[self.setting_starts].select(self.setting_columns).to_dicts()
+
+    def curves(self, column: str) -> np.ndarray:
+        # (num_runs, max_num_evals), each run extended by repeating its last value
+        if column not in self.curves_cache:
+            if column not in self.metrics.columns:
+                raise ValueError(f"{column} is not a metric in the results")
+            self.curves_cache[column] = pad_curves(np.split(self.metrics[column].to_numpy(), np.cumsum(self.lengths)[:-1]), self.lengths)
+        return self.curves_cache[column]
+
+    def aggregate(
+            self, to_plot: str, plot_over: Literal["step", "epoch", "token", "time_sec"] = "step", num_samples: int = 500,
+    ) -> list[dict[str, Any]]:
+        # Per setting: its settings, the #params of its first run, and the (xs, ys, avg_ys) that `load_xs_ys_avg_y` would return for it
+        key = (to_plot, plot_over, num_samples)
+        if key not in self.aggregates:
+            self.aggregates[key] = self._aggregate(to_plot, plot_over, num_samples)
+        return self.aggregates[key]
+
+    def _aggregate(self, to_plot: str, plot_over: str, num_samples: int) -> list[dict[str, Any]]:
+        if plot_over != "step" and plot_over not in X_COLUMNS:
+            raise ValueError(f"{plot_over} not a valid x-value")
+        if len(self.runs) == 0:
+            return []
+        starts = self.setting_starts
+        ends   = np.append(starts[1:], len(self.runs))
+        ys     = self.curves(to_plot)
+
+        if plot_over == "step":
+            # Every setting is cut to the length of its shortest run, which makes the padding irrelevant; `np.mean` semantics for NaNs
+            lengths = np.minimum.reduceat(self.lengths, starts)
+            is_nan  = np.isnan(ys)
+            with np.errstate(invalid="ignore"):
+                avg_ys = np.where(
+                    np.logical_or.reduceat(is_nan, starts, axis=0), np.nan,
+                    np.add.reduceat(np.where(is_nan, 0., ys), starts, axis=0) / (ends - starts)[:, None],
+                )
+            xs = [((np.arange(length) + 1) * 12.5).astype(int) for length in lengths]
+        else:
+            # Every setting gets its own grid up to the largest x of its runs; `np.nanmean` semantics for NaNs
+            xs      = self.curves(X_COLUMNS[plot_over])
+            max_xs  = np.maximum.reduceat(xs.max(axis=1), starts)
+            new_xs  = np.linspace(0., np.repeat(max_xs, ends - starts), num_samples, axis=-1)
+            ys      = interpolate_rows(new_xs, xs, ys)
+            is_nan  = np.isnan(ys)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                avg_ys = np.add.reduceat(np.where(is_nan, 0., ys), starts, axis=0) / np.add.reduceat((~is_nan).astype(np.int64), starts, axis=0)
+            lengths = np.full(len(starts), num_samples)
+            xs      = list(new_xs[starts])
+
+        num_params = self.runs["num_params"].to_numpy()[starts] if "num_params" in self.runs.columns else [None] * len(starts)
+        return [
+            {"setting": setting, "num_params": num_params_, "xs": xs_, "ys": ys[start:end, :length], "avg_ys": avg_ys_[:length]}
+            for setting, num_params_, xs_, start, end, length, avg_ys_ in zip(self.settings(), num_params, xs, starts, ends, lengths, avg_ys)
+        ]
+
+
+def file_stamp(file: str) -> tuple:
+    # Changes whenever the results do: size & mtime of the file, or of all the files of a run store
+    paths = sorted(glob.glob(os.path.join(file, "**", "*.parquet"), recursive=True)) if run_store.is_run_store(file) else [file]
+    return tuple((path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths)
+
+
+_results = {}
+
+def load_results(file: str, use_cache: bool = True) -> Results:
+    # Read once per version of the file, so that replotting (another metric, over another x) only aggregates again, or not even that.
+    # Across processes, the parsed results are cached on disk (see results_cache.py), and only what was added since gets parsed.
+    stamp = file_stamp(file)
+    if file not in _results or _results[file][0] != stamp:
+        if use_cache:
+            runs, metrics = results_cache.ResultsCache(file).load()
+        elif run_store.is_run_store(file):
+            store = run_store.RunStore(file)
+            runs, metrics = store.scan_runs().collect(), store.scan_metrics().collect()
+        else:
+            with open(file, "rb") as f:
+                runs, metrics = results_cache.parse_csv(f.read())
+        _results[file] = stamp, Results(runs, metrics)
+    return _results[file][1]
+
+
 def get_unique_settings(file: str, targets: list[str]) -> list[str | int | float | bool]:
     settings = []
     
     # Load the unique combinations of the targets
     combinations = (
-        pl.scan_csv(file)
+        scan_runs(file)
         .select(*[pl.col(target) for target in targets])
         .collect()
         .unique()
@@ -225,7 +367,7 @@ def generate_distinct_colors(n):
 
 def unique_num_params(file: str) -> np.ndarray:
     return (
-        pl.scan_csv(file)
+        scan_runs(file)
         .select("num_params")
         .collect()
         ["num_params"]
@@ -236,7 +378,7 @@ def unique_num_params(file: str) -> np.ndarray:
 
 def unique_widths(file: str) -> np.ndarray:
     return (
-        pl.scan_csv(file)
+        scan_runs(file)
         .select("width")
         .collect()
         ["width"]
@@ -247,7 +389,7 @@ def unique_widths(file: str) -> np.ndarray:
 
 def unique_depths(file: str) -> np.ndarray:
     return (
-        pl.scan_csv(file)
+        scan_runs(file)
         .select("depth")
         .collect()
         ["depth"]
@@ -276,121 +418,226 @@ def plot_metric_curves(
         loglog: bool = False,
         plot_all: bool = False,
 ) -> None:
-    settings = get_unique_settings(
-        file,
-        [
-            "num_heads", "linear_value", "depth", "width",
-            "ul2", "causal_denoisers", "randomize_denoiser_settings",
-            "randomize_mask_width", "causal_divider", "s_divider",
-            "r_divider", "x_divider",
-        ],
-    )
+    filters = {
+        name: value for name, value in zip(SETTING_COLUMNS, (
+            num_heads, linear_value, depth, width,
+            ul2, causal_denoisers, randomize_denoiser_settings,
+            randomize_mask_width, causal_divider, s_divider, r_divider, x_divider,
+        ))
+        if value is not None
+    }
+    results = load_results(file)
+    curves  = select_curves(results, to_plot, plot_over, filters)
+
+    fig, ax = plt.subplots(figsize=(12, 7))
+    draw_metric_curves(ax, curves, results.setting_columns, to_plot, plot_over, loglog=loglog, plot_all=plot_all)
+    fig.tight_layout()
+    if show:
+        plt.show()
+    else:
+        # You should probably adjust the filename (or use `plot_grid`)
+        fig.savefig(f"{to_plot}_vs_{plot_over}.png", dpi=300)
+    plt.close(fig)  # in case you call this function multiple times with different settings
+
+
+def select_curves(results: Results, to_plot: str, plot_over: str, filters: dict[str, Any]) -> list[dict[str, Any]]:
+    # The aggregated curves of the settings that match all `filters` ({setting column: value})
+    if missing := set(filters) - set(results.setting_columns):
+        raise ValueError(f"{sorted(missing)} not in the results")
+    return [
+        curve for curve in results.aggregate(to_plot, plot_over)
+        if all(curve["setting"][name] == value for name, value in filters.items())
+    ]
+
+
+def draw_metric_curves(
+        ax: Axes,
+        curves: list[dict[str, Any]],
+        setting_columns: list[str],
+        to_plot: str,
+        plot_over: str,
+        loglog: bool = False,
+        plot_all: bool = False,
+) -> None:
+    # Settings that aren't always the same are named in the labels
+    varying = {name for name in setting_columns if len({curve["setting"][name] for curve in curves}) > 1}
 
-    for i, user_param in enumerate((
-        num_heads, linear_value, depth, width, 
-        ul2, causal_denoisers, randomize_denoiser_settings, 
-        randomize_mask_width, causal_divider, s_divider, r_divider, x_divider
-    )):
-        if user_param is not None:
-            settings = [setting for setting in settings if setting[i] == user_param]
-
-    colors = generate_distinct_colors(len(settings))
-
-    for color, (
-            num_heads_, linear_value_, depth_, width_,
-            ul2_, causal_denoisers_, randomize_denoiser_settings_, randomize_mask_width_,
-            causal_divider_, s_divider_, r_divider_, x_divider_,
-    ) in zip(colors, settings):
-        xs, ys, avg_ys = load_xs_ys_avg_y(
-            file,
-            depth=depth_,
-            width=width_,
-            num_heads=num_heads_,
-            linear_value=linear_value_,
-            ul2=ul2_,
-            causal_denoisers=causal_denoisers_,
-            randomize_denoiser_settings=randomize_denoiser_settings_,
-            randomize_mask_width=randomize_mask_width_,
-            causal_divider=causal_divider_,
-            s_divider=s_divider_,
-            r_divider=r_divider_,
-            x_divider=x_divider_,
-            to_plot=to_plot,
-            plot_over=plot_over,
-        )
+    colors = generate_distinct_colors(len(curves))
+
+    for color, curve in zip(colors, curves):
+        setting, xs, ys, avg_ys = curve["setting"], curve["xs"], curve["ys"], curve["avg_ys"]
         if plot_all:
             for y in ys:
-                if loglog:
-                    plt.loglog(xs, y, color=color, alpha=0.2)
-                else:
-                    plt.plot(xs, y, color=color, alpha=0.2)
-
-        num_params = pl.scan_csv(file).filter(
-            (pl.col("num_heads") == num_heads_)
-            & (pl.col("linear_value") == linear_value_)
-            & (pl.col("depth") == depth_)
-            & (pl.col("ul2") == ul2_)
-            & (pl.col("causal_denoisers") == causal_denoisers_)
-            & (pl.col("randomize_denoiser_settings") == randomize_denoiser_settings_)
-            & (pl.col("randomize_mask_width") == randomize_mask_width_)
-            & (pl.col("causal_divider") == causal_divider_)
-            & (pl.col("s_divider") == s_divider_)
-            & (pl.col("r_divider") == r_divider_)
-            & (pl.col("x_divider") == x_divider_)
-
-        ).collect()["num_params"][0]
-        
-        label = (
-            f"num_heads={num_heads_}, linear_value={linear_value_}, "
-            f"depth={depth_}, width={width_}, #params={format_num_params(num_params)}"
-        )
-        if ul2_:
-            label += ", ul2"
-        if causal_denoisers_:
-            label += ", causal_denoisers"
-        if randomize_denoiser_settings_:
-            label += ", randomize_denoiser_settings"
-        if loglog:
-            plt.loglog(xs, avg_ys, color=color if plot_all else None, label=label)
-        else:
-            plt.plot(xs, avg_ys, color=color if plot_all else None, label=label)
+                ax.plot(xs, y, color=color, alpha=0.2)
+
+        # Whichever of the model's shape settings the results have, then its size, then the other settings that are set or vary
+        label = [f"{name}={setting[name]}" for name in setting_columns if name in LABEL_COLUMNS]
+        if curve["num_params"] is not None and not np.isnan(curve["num_params"]):  # runs that didn't log it have NaN
+            label.append(f"#params={format_num_params(curve['num_params'])}")
+        for name in setting_columns:
+            if name in LABEL_COLUMNS:
+                continue
+            if setting[name] is True:
+                label.append(name)
+            elif name in varying and not isinstance(setting[name], bool):
+                label.append(f"{name}={setting[name]}")
+        ax.plot(xs, avg_ys, color=color if plot_all else None, label=", ".join(label))
+
+    if loglog:
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+    ax.set_xlabel(plot_over)
+    ax.set_ylabel(to_plot)
+    if curves: # e.g. no eval points yet
+        ax.legend()
+    ax.grid()
+    ax.set_title(f"{to_plot} vs {plot_over}")
+
+
+# `plot_grid` renders a figure for every combination of metric, x-axis and setting filter. The results are loaded & aggregated once,
+# in this process (that's cheap, see `Results`), and only the rendering, which is what takes the time, is spread over a process pool.
+# The workers are spawned, not forked (polars' thread pool doesn't survive a fork), and only use the object-oriented matplotlib API,
+# so they don't share any pyplot state.
+
+def render_figure(
+        curves: list[dict[str, Any]],
+        setting_columns: list[str],
+        to_plot: str,
+        plot_over: str,
+        path: str,
+        formats: tuple[str, ...] = ("png",),
+        loglog: bool = False,
+        plot_all: bool = False,
+        dpi: int = 300,
+) -> list[str]:
+    # Writes `path` + ".png", ".svg", ... and returns their paths
+    fig = Figure(figsize=(12, 7))
+    draw_metric_curves(fig.add_subplot(), curves, setting_columns, to_plot, plot_over, loglog=loglog, plot_all=plot_all)
+    fig.tight_layout()
+    paths = [f"{path}.{fmt}" for fmt in formats]
+    for figure_path in paths:
+        fig.savefig(figure_path, dpi=dpi)
+    return paths
 
 
-    fig = plt.gcf()
-    fig.set_size_inches(12, 7)
+def filter_name(filters: dict[str, Any]) -> str:
+    return "_".join(f"{name}={value}" for name, value in filters.items()) or "all"
 
-    plt.xlabel(plot_over)
-    plt.ylabel(to_plot)
-    plt.legend()
-    plt.grid()
-    plt.title(f"{to_plot} vs {plot_over}")
-    plt.tight_layout()
-    if show:
-        plt.show()
-    else:
-        # You should probably adjust the filename
-        plt.savefig(f"{to_plot}_vs_{plot_over}.png", dpi=300)
-    close_plt()  # in case you call this function multiple times with different settings
+
+def plot_grid(
+        file: str,
+        out_dir: str = "plots",
+        metrics: tuple[str, ...] = PLOT_METRICS,
+        plot_overs: tuple[str, ...] = ("step", "epoch", "token", "time_sec"),
+        filters: list[dict[str, Any]] | None = None,
+        formats: tuple[str, ...] = ("png",),
+        num_workers: int | None = None,
+        loglog: bool = False,
+        plot_all: bool = False,
+        dpi: int = 300,
+) -> list[str]:
+    # One figure per metric x x-axis x setting filter (a dict {setting column: value}, by default all runs),
+    # written to `out_dir` as "<metric>_vs_<x-axis>_<filter>.<format>". Returns the paths of all files written.
+    filters = filters or [{}]
+    results = load_results(file)
+    jobs = [
+        dict(
+            curves=select_curves(results, to_plot, plot_over, filters_), setting_columns=results.setting_columns,
+            to_plot=to_plot, plot_over=plot_over, path=os.path.join(out_dir, f"{to_plot}_vs_{plot_over}_{filter_name(filters_)}"),
+            formats=formats, loglog=loglog, plot_all=plot_all, dpi=dpi,
+        )
+        for to_plot, plot_over, filters_ in itertools.product(metrics, plot_overs, filters)
+    ]
+    os.makedirs(out_dir, exist_ok=True)
+
+    num_workers = min(num_workers or os.cpu_count() or 1, len(jobs))
+    if num_workers <= 1:
+        return [path for job in jobs for path in render_figure(**job)]
+    with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(render_figure, **job) for job in jobs]
+        return [path for future in futures for path in future.result()]
+
+
+def parse_filter(text: str) -> dict[str, Any]:
+    # "depth=8,width=384" -> {"depth": 8, "width": 384}
+    filters = {}
+    for item in text.split(","):
+        name, value = item.split("=", 1)
+        try:
+            filters[name.strip()] = ast.literal_eval(value.strip())
+        except (SyntaxError, ValueError):
+            filters[name.strip()] = value.strip()
+    return filters
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Plot the metric curves of a results file, for every metric, x-axis & setting filter.")
+    parser.add_argument(
+        "--file",
+        type=str, default="results/run_store",
+        help="The results: a run store, or an old .csv results file. TYPE: str; DEFAULT: 'results/run_store'"
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str, default="plots",
+        help="Directory to write the figures to. TYPE: str; DEFAULT: 'plots'"
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str, nargs="+", default=list(PLOT_METRICS),
+        help=f"The metrics to plot. TYPE: str; DEFAULT: {list(PLOT_METRICS)}"
+    )
+    parser.add_argument(
+        "--plot_over",
+        type=str, nargs="+", default=["step", "epoch", "token", "time_sec"], choices=["step", "epoch", "token", "time_sec"],
+        help="The x-axes to plot the metrics over. TYPE: str; DEFAULT: ['step', 'epoch', 'token', 'time_sec']"
+    )
+    parser.add_argument(
+        "--filter",
+        type=parse_filter, action="append", default=None,
+        help="Only plot the settings that match, e.g. 'depth=8,width=384'. Repeat for one set of figures per filter. "
+        "TYPE: str; DEFAULT: None (all settings)"
+    )
+    parser.add_argument(
+        "--formats",
+        type=str, nargs="+", default=["png"],
+        help="The file formats to write every figure in, e.g. png svg. TYPE: str; DEFAULT: ['png']"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int, default=os.cpu_count() or 1,
+        help="Number of rendering processes. TYPE: int; DEFAULT: os.cpu_count()"
+    )
+    parser.add_argument(
+        "--dpi",
+        type=int, default=300,
+        help="Resolution of raster formats. TYPE: int; DEFAULT: 300"
+    )
+    parser.add_argument(
+        "--loglog",
+        action="store_true",
+        help="Plot on log-log axes. FLAG"
+    )
+    parser.add_argument(
+        "--plot_all",
+        action="store_true",
+        help="Plot the curves of the individual runs, too, not only the average of every setting. FLAG"
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    plot_metric_curves(
-        file="results/results_four.csv",
-        depth=8,
-        width=384,
-        num_heads=1,
-        linear_value=False,
-        ul2=None,
-        causal_denoisers=None,
-        randomize_denoiser_settings=None,
-        randomize_mask_width= None,
-        causal_divider=None,
-        s_divider=None,
-        r_divider=None,
-        x_divider=None,
-        to_plot="val_loss_causal",
-        plot_over="epoch",
-        show=True,
-        loglog=False,
-        plot_all=False,
+    args  = get_args()
+    paths = plot_grid(
+        file=args.file,
+        out_dir=args.out_dir,
+        metrics=tuple(args.metrics),
+        plot_overs=tuple(args.plot_over),
+        filters=args.filter,
+        formats=tuple(args.formats),
+        num_workers=args.num_workers,
+        loglog=args.loglog,
+        plot_all=args.plot_all,
+        dpi=args.dpi,
     )
+    print(f"wrote {len(paths)} files to {args.out_dir}")
@@ -0,0 +1,243 @@
+import argparse
+import concurrent.futures
+import os
+import re
+import subprocess
+import time
+import zipfile
+from typing import Iterator
+
+import numpy as np
+import rich
+
+# This seems like one of the best choices right now for a fast/lightweight/simple tokenizer.
+import tiktoken
+
+import token_shards
+
+
+print = rich.print
+
+
+#############################################
+#           Corpus Preparation              #
+#############################################
+
+# Streams the raw corpus from disk in line-aligned chunks, tokenizes them over a process pool, and writes the tokens straight
+# into token shards as they come back (in order). Peak memory is a few in-flight chunks instead of several copies of the whole corpus,
+# and progress is committed to the shard index together with every shard, so a killed preparation run picks up where it left off.
+#
+# The token stream is exactly the same as `encode_ordinary` over the whole file at once. The gpt2 pre-tokenizer regex only looks
+# one character ahead (the `\s+(?!\S)` alternative), so we can only split where that lookahead can't make a difference.
+# That's between two lines where the first ends in two whitespace chars (e.g. " \n") and the second starts with exactly one
+# whitespace char followed by a non-whitespace char (e.g. " = Heading"). There, the whitespace run is always split right
+# before its last character, whether or not we split the text there. WikiText lines all look like " text ... \n", so these
+# boundaries are plentiful.
+#
+# The same holds at article titles (" = Title = ", as opposed to section headings like " = = Section = = "), which are always
+# preceded by an empty " \n" line. The workers split their chunks there, and record where in the token stream every article starts.
+
+RAW_DATA_SOURCE = 'https://wikitext.smerity.com/wikitext-103-raw-v1.zip'
+RAW_DATA_CACHE  = './data_raw/' # where to cache the data after downloading
+RAW_SPLITS      = {'train': 'wiki.train.raw', 'eval': 'wiki.valid.raw'}
+
+CHUNK_BYTES = 1 << 20 # Target size of a single chunk of raw text, chunks only end on safe boundaries so they can be a bit longer
+GROUP_SIZE  = 8       # Chunks per task sent to a worker, tokenized with one `encode_ordinary_batch` call
+
+DOCUMENT_TITLE = re.compile(r'^ = [^=\n].* = $', re.MULTILINE) # Top-level headings are article titles
+
+
+def download_wikitext(raw_data_cache: str = RAW_DATA_CACHE) -> str:
+    raw_dir = os.path.join(raw_data_cache, 'wikitext-103-raw')
+    if os.path.isdir(raw_dir):
+        return raw_dir
+
+    if not os.path.isfile(os.path.join(raw_data_cache, 'data.zip')):
+        os.makedirs(raw_data_cache, exist_ok=True)
+
+        # Needed due to the website 403-blocking python agents for download, it seems? Many thanks to Smerity for re-hosting these after the main files went down. <3 :')
+        subprocess.run(["wget", RAW_DATA_SOURCE, "-O", os.path.join(raw_data_cache, "data.zip")], stdout=subprocess.PIPE)
+
+    with zipfile.ZipFile(os.path.join(raw_data_cache, 'data.zip'), 'r') as zip_ref:
+        zip_ref.extractall(raw_data_cache)
+
+    return raw_dir
+
+
+def is_safe_boundary(tail: str, next_line: str) -> bool:
+    # `tail` are the last (at least) two chars before the boundary, `next_line` the text right after it. See the explanation at the top.
+    return (
+        len(tail) >= 2 and tail[-2] in ' \t\n' and tail[-1] == '\n'
+        and len(next_line) >= 2 and next_line[0] in ' \t' and not next_line[1].isspace()
+    )
+
+
+def iter_chunks(path: str, start_byte: int = 0, chunk_bytes: int = CHUNK_BYTES) -> Iterator[tuple[str, int]]:
+    # Yields (text, end_byte) of consecutive line-aligned chunks, starting from a byte offset that has to be a chunk boundary.
+    # Read as bytes so that offsets are exact, then decode like the text-mode `read()` did (utf-8, universal newlines).
+    with open(path, 'rb') as f:
+        f.seek(start_byte)
+        lines, num_bytes, offset, tail = [], 0, start_byte, ''
+
+        for raw_line in f:
+            line = raw_line.decode('utf-8')
+            if num_bytes >= chunk_bytes and is_safe_boundary(tail, line):
+                yield ''.join(lines).replace('\r\n', '\n').replace('\r', '\n'), offset
+                lines, num_bytes = [], 0
+
+            lines.append(line)
+            num_bytes += len(raw_line)
+            offset    += len(raw_line)
+            tail       = (tail + line)[-2:]
+
+        if lines:
+            yield ''.join(lines).replace('\r\n', '\n').replace('\r', '\n'), offset
+
+
+def iter_groups(chunks: Iterator[tuple[str, int]], group_size: int) -> Iterator[tuple[list[str], int]]:
+    group = []
+    for text, end_byte in chunks:
+        group.append(text)
+        if len(group) == group_size:
+            yield group, end_byte
+            group = []
+    if group:
+        yield group, end_byte
+
+
+_worker_tokenizer = None
+
+def _init_worker(encoding_name: str) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = tiktoken.get_encoding(encoding_name)
+
+
+def split_documents(text: str) -> list[tuple[str, bool]]:
+    # Splits a chunk in front of every article title (where that's a safe boundary), into (text, starts a document) pieces.
+    # A title at the very start of the chunk is fine, too: chunks begin on safe boundaries.
+    cuts = [
+        match.start() for match in DOCUMENT_TITLE.finditer(text)
+        if match.start() == 0 or is_safe_boundary(text[max(0, match.start()-2):match.start()], text[match.start():match.start()+2])
+    ]
+    bounds = [0] + [cut for cut in cuts if cut > 0] + [len(text)]
+    pieces = [(text[start:end], start in cuts) for start, end in zip(bounds[:-1], bounds[1:])]
+    return [(piece, is_document_start) for piece, is_document_start in pieces if piece]
+
+
+def _tokenize_group(texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    # Returns the tokens, and the offsets (into them) of the documents that start within them
+    pieces    = [piece for text in texts for piece in split_documents(text)]
+    tokenized = _worker_tokenizer.encode_ordinary_batch([text for text, _ in pieces], num_threads=1) # the pool provides the parallelism
+    offsets   = np.cumsum([0] + [len(tokens) for tokens in tokenized[:-1]])
+    document_starts = np.array([offset for offset, (_, is_document_start) in zip(offsets, pieces) if is_document_start], dtype=np.int64)
+    return np.concatenate([np.asarray(tokens, dtype=token_shards.TOKEN_DTYPE) for tokens in tokenized]), document_starts
+
+
+def ordered_parallel_map(pool: concurrent.futures.Executor, fn, items: Iterator, max_in_flight: int) -> Iterator:
+    # Like `pool.map`, but doesn't eagerly consume the whole input, so memory is bounded by `max_in_flight` tasks
+    in_flight = []
+    for item in items:
+        payload, *extra = item
+        in_flight.append((pool.submit(fn, payload), *extra))
+        if len(in_flight) >= max_in_flight:
+            future, *extra = in_flight.pop(0)
+            yield future.result(), *extra
+    for future, *extra in in_flight:
+        yield future.result(), *extra
+
+
+def prepare_split(
+        raw_path: str,
+        directory: str,
+        split: str,
+        num_workers: int = os.cpu_count() or 1,
+        chunk_bytes: int = CHUNK_BYTES,
+        group_size: int = GROUP_SIZE,
+        shard_size: int = token_shards.SHARD_SIZE,
+        encoding_name: str = 'gpt2',
+) -> None:
+    writer = token_shards.ShardWriter(directory, split, shard_size=None, resume=True)
+    source = writer.split_index.get('source', {})
+
+    if source.get('path') != os.path.abspath(raw_path):
+        # Not a resumable run of this split (different or no source), so start from scratch
+        writer = token_shards.ShardWriter(directory, split, shard_size=None)
+        source = {'path': os.path.abspath(raw_path), 'bytes_done': 0, 'complete': False}
+    if source['complete']:
+        print(f"| {split}: already prepared ({writer.split_index['num_tokens']:,} tokens), skipping")
+        return
+
+    total_bytes = os.path.getsize(raw_path)
+    start_byte  = source['bytes_done']
+    num_tokens  = writer.split_index['num_tokens']
+    if start_byte > 0:
+        print(f"| {split}: resuming at byte {start_byte:,}/{total_bytes:,} ({num_tokens:,} tokens already written)")
+
+    start_time, last_report, session_tokens = time.perf_counter(), 0., 0
+    with concurrent.futures.ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(encoding_name,)) as pool:
+        groups = iter_groups(iter_chunks(raw_path, start_byte, chunk_bytes), group_size)
+        for (tokens, document_starts), end_byte in ordered_parallel_map(pool, _tokenize_group, groups, max_in_flight=2*num_workers):
+            writer.write(tokens, document_starts)
+            num_tokens     += len(tokens)
+            session_tokens += len(tokens)
+
+            # Shards only ever end on chunk boundaries, so that the byte offset stored along with them is a valid place to resume from
+            if writer.buffered >= shard_size:
+                writer.flush(metadata={'source': {**source, 'bytes_done': end_byte}})
+
+            elapsed = time.perf_counter() - start_time
+            if elapsed - last_report > 5. or end_byte == total_bytes:
+                last_report = elapsed
+                tokens_per_sec = session_tokens / max(elapsed, 1e-9)
+                print(
+                    f"| {split}: {100*end_byte/total_bytes:5.1f}% ({end_byte:,}/{total_bytes:,} bytes) "
+                    f"| {num_tokens:,} tokens | {tokens_per_sec:,.0f} tokens/s"
+                )
+
+    writer.close(metadata={'source': {**source, 'bytes_done': total_bytes, 'complete': True}})
+    print(f"| {split}: done, {num_tokens:,} tokens in {len(writer.split_index['shards'])} shard(s)")
+
+
+def is_prepared(directory: str) -> bool:
+    # Splits converted from an old `data.pt` have no 'source' entry, they're complete by construction
+    splits = token_shards.read_index(directory)['splits']
+    return all(split in splits and splits[split].get('source', {}).get('complete', True) for split in RAW_SPLITS)
+
+
+def prepare_wikitext(directory: str, num_workers: int = os.cpu_count() or 1, **kwargs) -> None:
+    print("downloading data (if necessary) and tokenizing")
+    raw_dir = download_wikitext()
+    for split, filename in RAW_SPLITS.items():
+        prepare_split(os.path.join(raw_dir, filename), directory, split, num_workers=num_workers, **kwargs)
+    print("completed the tokenization process!")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tokenize WikiText-103 into token shards for training.")
+    parser.add_argument(
+        "--out",
+        type=str, default="data_shards",
+        help="Directory to write the token shards to. Reruns resume unfinished splits. "
+        "TYPE: str; DEFAULT: 'data_shards'"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int, default=os.cpu_count() or 1,
+        help="Number of tokenizer processes. TYPE: int; DEFAULT: os.cpu_count()"
+    )
+    parser.add_argument(
+        "--chunk_bytes",
+        type=int, default=CHUNK_BYTES,
+        help=f"Approximate size of the raw-text chunks sent to the workers. TYPE: int; DEFAULT: {CHUNK_BYTES}"
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int, default=token_shards.SHARD_SIZE,
+        help=f"Approximate number of tokens per shard (shards end on chunk boundaries). TYPE: int; DEFAULT: {token_shards.SHARD_SIZE}"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    prepare_wikitext(args.out, num_workers=args.num_workers, chunk_bytes=args.chunk_bytes, shard_size=args.shard_size)
@@ -0,0 +1,179 @@
+import glob
+import hashlib
+import io
+import json
+import os
+
+import polars as pl
+
+import run_store
+
+
+#############################################
+#             Results Cache                 #
+#############################################
+
+# `plot_results` needs the runs of a results file as two tables: one row of settings per run, and one row of metrics per eval point of a run.
+# Getting them from an old CSV file means parsing every curve out of its stringified list, and from a run store reading hundreds of small
+# Parquet files, so the parsed tables are cached on disk next to the results (in `<file>.plot_cache/`), together with a manifest of what
+# they were parsed from. While a sweep is running, the results only ever grow: `log_results` appends rows to a CSV file, and `train`
+# & `run_job` add (or replace) files in a run store. So the cache is updated incrementally, by parsing only what's new since the manifest:
+#   CSV file:   the bytes after the ones parsed before, if those are unchanged (same header, same bytes right before the end of them)
+#   run store:  the files that are new or changed (by size & mtime), while the rows of removed or changed files are dropped
+# Anything else (e.g. a CSV file that was overwritten) means parsing everything again.
+
+CACHE_VERSION  = 1
+CACHE_SUFFIX   = '.plot_cache'
+MANIFEST_FILE  = 'manifest.json'
+RUNS_FILE      = 'runs.parquet'
+METRICS_FILE   = 'metrics.parquet'
+TAIL_BYTES     = 4096 # how much of the already parsed CSV to compare, to tell appends from rewrites
+
+
+def cache_directory(file: str) -> str:
+    return os.path.normpath(file) + CACHE_SUFFIX
+
+
+def _write_atomic(df: pl.DataFrame, path: str) -> None:
+    tmp_path = path + '.tmp'
+    df.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _tail_hash(file: str, end: int) -> str:
+    with open(file, 'rb') as f:
+        f.seek(max(0, end - TAIL_BYTES))
+        return hashlib.sha1(f.read(end - max(0, end - TAIL_BYTES))).hexdigest()
+
+
+def _concat(frames: list[pl.DataFrame]) -> pl.DataFrame:
+    # The parts can differ in schema (e.g. a column that is null in some of them), so they're combined into common supertypes
+    frames = [frame for frame in frames if frame.width > 0]
+    return pl.concat(frames, how='diagonal_relaxed') if frames else pl.DataFrame()
+
+
+def parse_csv(data: bytes, first_row: int = 0) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # The runs & metrics tables of the rows of an old CSV results file (one row per run, with the curves as stringified lists).
+    # Runs are identified by their row in the file, counting from `first_row`; only finished runs are kept.
+    runs = pl.read_csv(io.BytesIO(data)).with_row_index('run_id', offset=first_row)
+    runs = runs.filter(pl.col('last_val_loss').ge(0))
+    # Curves are the string columns that have values, all of them lists (other string columns can be empty, e.g. 'full_evaluation_file')
+    curve_columns = [
+        column for column, dtype in runs.schema.items()
+        if dtype == pl.String and runs[column].null_count() < len(runs) and runs[column].drop_nulls().str.starts_with('[').all()
+    ]
+    metrics = runs.select(
+        'run_id',
+        *[
+            pl.col(column).str.strip_chars('[]').str.split(',').list.eval(pl.element().str.strip_chars(' ').cast(pl.Float64, strict=False))
+            for column in curve_columns
+        ],
+    ).explode(*curve_columns).with_columns(eval_idx=pl.int_range(pl.len()).over('run_id'))
+    return runs.drop(curve_columns), metrics
+
+
+class ResultsCache:
+    """ On-disk cache of the parsed runs & metrics tables of a results file (a run store or an old CSV file), updated incrementally."""
+    def __init__(self, file: str):
+        self.file      = file
+        self.directory = cache_directory(file)
+
+    def read_manifest(self) -> dict | None:
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        return manifest if manifest.get('version') == CACHE_VERSION else None
+
+    def load(self) -> tuple[pl.DataFrame, pl.DataFrame]:
+        # The runs & metrics tables, with a 'run_id' column in both, and 'eval_idx' in the metrics
+        manifest = self.read_manifest()
+        if manifest is not None:
+            runs, metrics = pl.read_parquet(os.path.join(self.directory, RUNS_FILE)), pl.read_parquet(os.path.join(self.directory, METRICS_FILE))
+        else:
+            runs, metrics = pl.DataFrame(), pl.DataFrame()
+
+        if run_store.is_run_store(self.file):
+            updated = self._update_run_store(manifest, runs, metrics)
+        else:
+            updated = self._update_csv(manifest, runs, metrics)
+        if updated is None:
+            return runs.drop('part', strict=False), metrics.drop('part', strict=False)
+
+        manifest, runs, metrics = updated
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(runs, os.path.join(self.directory, RUNS_FILE))
+        _write_atomic(metrics, os.path.join(self.directory, METRICS_FILE))
+        # The manifest goes last: if we crash before it, the next load just redoes this update
+        tmp_path = os.path.join(self.directory, MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, **manifest}, f)
+        os.replace(tmp_path, os.path.join(self.directory, MANIFEST_FILE))
+        return runs.drop('part', strict=False), metrics.drop('part', strict=False)
+
+    def _update_csv(self, manifest: dict | None, runs: pl.DataFrame, metrics: pl.DataFrame) -> tuple[dict, pl.DataFrame, pl.DataFrame] | None:
+        # Returns None if the cache is up to date
+        stat = os.stat(self.file)
+        if manifest is not None and manifest.get('format') == 'csv' and (manifest['size'], manifest['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return None
+
+        with open(self.file, 'rb') as f:
+            header = f.readline()
+        is_append = (
+            manifest is not None and manifest.get('format') == 'csv'
+            and manifest['header'] == header.decode() and manifest['offset'] <= stat.st_size
+            and manifest['tail_hash'] == _tail_hash(self.file, manifest['offset'])
+        )
+        if not is_append:
+            manifest, runs, metrics = {'offset': 0, 'num_rows': 0}, pl.DataFrame(), pl.DataFrame()
+
+        # Only up to the last complete line, a row might be in the middle of being appended
+        with open(self.file, 'rb') as f:
+            f.seek(manifest['offset'])
+            data = f.read(stat.st_size - manifest['offset'])
+        data   = data[:data.rfind(b'\n') + 1]
+        offset = manifest['offset'] + len(data)
+        if manifest['offset'] == 0:
+            data = data[len(header):]
+
+        num_rows = manifest['num_rows']
+        if data:
+            new_runs, new_metrics = parse_csv(header + data, first_row=num_rows)
+            runs, metrics = _concat([runs, new_runs]), _concat([metrics, new_metrics])
+            num_rows += data.count(b'\n')
+
+        manifest = {
+            'format': 'csv', 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'header': header.decode(),
+            'offset': offset, 'num_rows': num_rows, 'tail_hash': _tail_hash(self.file, offset),
+        }
+        return manifest, runs, metrics
+
+    def _update_run_store(self, manifest: dict | None, runs: pl.DataFrame, metrics: pl.DataFrame) -> tuple[dict, pl.DataFrame, pl.DataFrame] | None:
+        # Returns None if the cache is up to date. Every cached row remembers the file ('part') it came from.
+        files = {}
+        for pattern in (os.path.join(run_store.RUNS_DIR, '*.parquet'), os.path.join(run_store.METRICS_DIR, '*', '*.parquet')):
+            for path in glob.glob(os.path.join(self.file, pattern)):
+                stat = os.stat(path)
+                files[os.path.relpath(path, self.file)] = [stat.st_size, stat.st_mtime_ns]
+
+        cached = manifest['files'] if manifest is not None and manifest.get('format') == 'run_store' else {}
+        if cached == files:
+            return None
+        unchanged = [part for part, stamp in files.items() if cached.get(part) == stamp]
+        new_parts = sorted(part for part in files if cached.get(part) != files[part])
+
+        frames = {run_store.RUNS_DIR: [], run_store.METRICS_DIR: []}
+        for part in new_parts:
+            frames[part.split(os.sep)[0]].append(pl.read_parquet(os.path.join(self.file, part)).with_columns(part=pl.lit(part)))
+
+        if len(unchanged) > 0 and runs.width > 0:
+            # The metrics can still be empty (and without columns), if the runs had no eval points yet
+            runs, metrics = (
+                table.filter(pl.col('part').is_in(pl.Series(unchanged).implode())) if table.width > 0 else table for table in (runs, metrics)
+            )
+        else:
+            runs, metrics = pl.DataFrame(), pl.DataFrame()
+        runs    = _concat([runs, *frames[run_store.RUNS_DIR]])
+        metrics = _concat([metrics, *frames[run_store.METRICS_DIR]])
+        return {'format': 'run_store', 'files': files}, runs, metrics
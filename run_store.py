@@ -0,0 +1,118 @@
+import glob
+import os
+import re
+import shutil
+
+import numpy as np
+import polars as pl
+
+
+#############################################
+#               Run Store                   #
+#############################################
+
+# The results of training runs live in a directory with two tables, both as Parquet files that are only ever added (or replaced whole):
+#   runs/<run id>.parquet                      one row of metadata per run: its settings, and how it ended (rewritten when it does)
+#   metrics/<run id>/<first eval idx>.parquet  one row per eval point of the run, with all the per-eval metrics of `train` as columns
+# The metrics of a run are written in parts while it trains, so that partial runs are readable (and resumed runs overwrite what they redo).
+# Reading goes through polars lazy scans: filters on the runs table select the run ids, and those are pushed down into the metrics scan,
+# so only the metrics of the selected runs (and only the selected columns) are ever read.
+
+RUNS_DIR    = 'runs'
+METRICS_DIR = 'metrics'
+
+
+def is_run_store(path: str) -> bool:
+    return os.path.isdir(os.path.join(path, RUNS_DIR))
+
+
+def _write_atomic(df: pl.DataFrame, path: str) -> None:
+    # Write-then-rename, so that a crash never leaves a half-written part behind
+    tmp_path = path + '.tmp'
+    df.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class RunStore:
+    """ Append-only store of training runs: a table of run metadata, and a long table of their per-eval metrics."""
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, RUNS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(directory, METRICS_DIR), exist_ok=True)
+
+    def clear(self) -> None:
+        # Removes all runs (only the store's own tables, nothing else that might be in the directory)
+        for name in (RUNS_DIR, METRICS_DIR):
+            shutil.rmtree(os.path.join(self.directory, name))
+            os.makedirs(os.path.join(self.directory, name))
+
+    def run_ids(self, run_name: str) -> list[str]:
+        # The ids of the runs of `run_name` in the store, oldest first: the name itself, then "<run_name>-2", "<run_name>-3", ...
+        pattern = re.compile(re.escape(run_name) + r'(-(\d+))?')
+        ids = [os.path.basename(path)[:-len('.parquet')] for path in glob.glob(os.path.join(self.directory, RUNS_DIR, '*.parquet'))]
+        ids = [(int(match.group(2) or 1), run_id) for run_id in ids if (match := pattern.fullmatch(run_id))]
+        return [run_id for _, run_id in sorted(ids)]
+
+    def new_run_id(self, run_name: str, resume: bool = False) -> str:
+        # The id to store a run of `run_name` under. Run names only hold the run's settings, so a rerun (e.g. with --append) gets
+        # a numbered id of its own, instead of overwriting the earlier run. Resuming (from a checkpoint) continues the latest run of the name instead.
+        run_ids = self.run_ids(run_name)
+        if not run_ids:
+            return run_name
+        if resume:
+            return run_ids[-1]
+        return f"{run_name}-{len(run_ids) + 1}"
+
+    def write_run(self, run_id: str, info: dict) -> None:
+        # Adds the metadata of a run, or replaces it if the run is already in the store
+        _write_atomic(pl.DataFrame([{'run_id': run_id, **info}]), os.path.join(self.directory, RUNS_DIR, f"{run_id}.parquet"))
+
+    def append_metrics(self, run_id: str, first_eval: int, metrics: dict[str, list]) -> None:
+        # Adds the eval points `first_eval`, `first_eval + 1`, ... of a run, from the lists of their values per metric.
+        # All values are stored as float64 (exact for ints below 2**53), so that the parts of all runs have the same schema.
+        num_evals = len(next(iter(metrics.values())))
+        if num_evals == 0:
+            return
+        directory = os.path.join(self.directory, METRICS_DIR, run_id)
+        os.makedirs(directory, exist_ok=True)
+        df = pl.DataFrame({
+            'run_id': [run_id] * num_evals,
+            'eval_idx': range(first_eval, first_eval + num_evals),
+            **{name: pl.Series(name, values, dtype=pl.Float64, strict=False) for name, values in metrics.items()},
+        })
+        _write_atomic(df, os.path.join(directory, f"{first_eval:06d}.parquet"))
+
+    def truncate_metrics(self, run_id: str, num_evals: int) -> None:
+        # Drops the parts from eval point `num_evals` on, e.g. the ones that a run resumed from an earlier checkpoint is going to redo
+        for path in glob.glob(os.path.join(self.directory, METRICS_DIR, run_id, '*.parquet')):
+            if int(os.path.basename(path).split('.')[0]) >= num_evals:
+                os.remove(path)
+
+    def scan_runs(self) -> pl.LazyFrame:
+        # The runs' files can differ in schema (e.g. a column that is null in some runs), so they're combined into common supertypes
+        paths = sorted(glob.glob(os.path.join(self.directory, RUNS_DIR, '*.parquet')))
+        if not paths:
+            return pl.LazyFrame({'run_id': []}, schema={'run_id': pl.String})
+        return pl.concat([pl.scan_parquet(path) for path in paths], how='diagonal_relaxed')
+
+    def scan_metrics(self) -> pl.LazyFrame:
+        # Runs only get metrics parts from their first eval on, so a store can have runs but no parts yet
+        if not glob.glob(os.path.join(self.directory, METRICS_DIR, '*', '*.parquet')):
+            return pl.LazyFrame({'run_id': [], 'eval_idx': []}, schema={'run_id': pl.String, 'eval_idx': pl.Int64})
+        return pl.scan_parquet(os.path.join(self.directory, METRICS_DIR, '*', '*.parquet'))
+
+    def load_curves(self, filters: pl.Expr, columns: list[str]) -> dict[str, list[np.ndarray]]:
+        # The metrics `columns` over the eval points of every run that matches `filters` (an expression over the runs table), in `run_num` order
+        runs = self.scan_runs().filter(filters).sort('run_num', 'run_id').select('run_id').collect()['run_id']
+        if len(runs) == 0:
+            return {column: [] for column in columns}
+        metrics = (
+            self.scan_metrics()
+            .filter(pl.col('run_id').is_in(runs.implode()))
+            .select('run_id', 'eval_idx', *columns)
+            .sort('run_id', 'eval_idx')
+            .collect()
+            .partition_by('run_id', as_dict=True)
+        )
+        curves = [metrics[(run_id,)] for run_id in runs if (run_id,) in metrics]
+        return {column: [curve[column].to_numpy() for curve in curves] for column in columns}
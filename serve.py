@@ -0,0 +1,469 @@
+import argparse
+import concurrent.futures
+import functools
+import json
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TextIO
+
+import numpy as np
+import rich.console
+import torch
+
+import main
+
+
+# Everything that isn't a response goes to stderr, so that stdout stays a clean stream of JSON lines in stdio mode
+print = rich.console.Console(stderr=True).print
+
+
+#############################################
+#             Inference Server              #
+#############################################
+
+# Serves a network saved with `main.save_net` (e.g. via `python main.py --save_dir ...`), over HTTP or as JSON lines on stdin/stdout.
+#
+# All the decoding happens in a single engine thread, which runs a set of batches round-robin, one decoding step (a token, or an
+# acting span in plan-act mode) at a time. New requests are grouped by decoding settings, sorted by prompt length and split into
+# batches of similar lengths, then prefilled. A freshly prefilled batch joins a running one (of the same settings) if it is at most
+# as long, and not too much shorter than it, as the KV caches can be merged by right-aligning the shorter sequences (see `KVCache.extend`).
+# Requests leave their batch as soon as they hit a stop token or their token budget, and are answered right away.
+#
+# Requests look like {"tokens": [...] or "prompt": "...", "max_new_tokens": 64, "mode": "causal" or "plan_act", "temperature": 1.,
+# "top_k": null, "top_p": null, "stop_tokens": [...], "planning_length": ..., "acting_length": ..., "planning_top_k": ..., "seed": null, "id": ...}.
+# Only the prompt is required. A request with a seed samples from its own generator, so it gets the same tokens as `main.generate` on its
+# own (with a generator seeded the same), whichever batch it ends up in.
+# Text prompts are tokenized with tiktoken's gpt2 encoding, like the training data, and the response has the text as well.
+
+MAX_BATCH_SIZE  = 32
+LENGTH_BUCKET   = 64 # Max difference in (padded) prompt length between the sequences of a batch
+DEFAULT_SETTINGS = {
+    'max_new_tokens': 64, 'mode': 'causal', 'temperature': 1., 'top_k': None, 'top_p': None, 'stop_tokens': [],
+    'planning_length': 16, 'acting_length': 4, 'planning_top_k': 5, 'seed': None,
+}
+
+
+@functools.cache
+def get_tokenizer():
+    import tiktoken # only needed for text prompts
+    return tiktoken.get_encoding('gpt2')
+
+
+class GenerationRequest:
+    """ A single generation request, and its progress & timings while it's being served."""
+    def __init__(self, payload: dict, defaults: dict = DEFAULT_SETTINGS):
+        unknown = set(payload) - set(defaults) - {'tokens', 'prompt', 'id'}
+        if unknown:
+            raise ValueError(f"unknown request fields: {sorted(unknown)}")
+        settings = {**defaults, **payload}
+
+        self.id         = payload.get('id')
+        self.is_text    = 'prompt' in payload
+        self.tokens     = get_tokenizer().encode_ordinary(payload['prompt']) if self.is_text else list(payload.get('tokens', []))
+        self.mode       = settings['mode']
+        self.max_new_tokens = int(settings['max_new_tokens'])
+        self.stop_tokens    = set(settings['stop_tokens'])
+        self.sampling_settings = (float(settings['temperature']), settings['top_k'], settings['top_p'])
+        self.decoder_settings  = (int(settings['planning_length']), int(settings['acting_length']), int(settings['planning_top_k'])) if self.mode == 'plan_act' else ()
+        self.generator = torch.Generator(main.hyp['misc']['device']).manual_seed(int(settings['seed'])) if settings['seed'] is not None else None
+
+        if self.mode not in ('causal', 'plan_act'):
+            raise ValueError(f"unknown mode {self.mode!r}, has to be 'causal' or 'plan_act'")
+        if not self.tokens or not all(isinstance(token, int) and 0 <= token < main.hyp['misc']['num_tokens'] for token in self.tokens):
+            raise ValueError(f"the prompt has to be a non-empty list of token ids in [0, {main.hyp['misc']['num_tokens']})")
+        if self.max_new_tokens < 1:
+            raise ValueError("max_new_tokens has to be at least 1")
+        if self.mode == 'plan_act' and not 0 < self.decoder_settings[1] < self.decoder_settings[0]:
+            raise ValueError("acting_length has to be positive and shorter than planning_length")
+        lookahead = self.decoder_settings[0] if self.mode == 'plan_act' else 0
+        if 1 + len(self.tokens) + self.max_new_tokens - 1 + lookahead > main.hyp['misc']['sequence_length']['max']:
+            raise ValueError(f"prompt + max_new_tokens (+ planning_length) exceed the max sequence length of {main.hyp['misc']['sequence_length']['max']}")
+
+        self.generated   = []
+        self.stop_reason = None
+        self.future      = concurrent.futures.Future()
+        self.arrival_time = time.perf_counter()
+        self.start_time = self.first_token_time = self.finish_time = None
+
+    @property
+    def batch_key(self) -> tuple:
+        # Requests can only share a batch if they decode the same way
+        return (self.mode, *self.decoder_settings)
+
+    def add_tokens(self, tokens: list[int]) -> bool:
+        # Returns whether the request is finished. Stop tokens end the generation, and aren't part of the output.
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        for token in tokens:
+            if token in self.stop_tokens:
+                self.stop_reason = 'stop_token'
+                break
+            self.generated.append(token)
+            if len(self.generated) >= self.max_new_tokens:
+                self.stop_reason = 'max_new_tokens'
+                break
+        return self.stop_reason is not None
+
+    def response(self) -> dict:
+        response = {
+            'id': self.id, 'tokens': self.generated, 'stop_reason': self.stop_reason,
+            'queue_ms': 1e3 * (self.start_time - self.arrival_time),
+            'time_to_first_token_ms': 1e3 * (self.first_token_time - self.arrival_time),
+            'latency_ms': 1e3 * (self.finish_time - self.arrival_time),
+        }
+        if self.is_text:
+            tokenizer = get_tokenizer()
+            response['text'] = tokenizer.decode([token for token in self.generated if token < tokenizer.n_vocab])
+        return response
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    return {'mean': float(np.mean(values)), **{f"p{q}": float(np.percentile(values, q)) for q in (50, 90, 99)}}
+
+
+class ServerStats:
+    """ Throughput & latency bookkeeping over all finished requests, to size deployments with."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first_arrival_time = None
+        self.num_requests = self.num_generated_tokens = self.num_steps = self.num_step_sequences = 0
+        self.latencies, self.times_to_first_token, self.queue_times = [], [], []
+
+    def record_step(self, batchsize: int) -> None:
+        with self.lock:
+            self.num_steps          += 1
+            self.num_step_sequences += batchsize
+
+    def record_request(self, request: GenerationRequest) -> None:
+        with self.lock:
+            self.first_arrival_time = min(self.first_arrival_time or request.arrival_time, request.arrival_time)
+            self.num_requests         += 1
+            self.num_generated_tokens += len(request.generated)
+            self.latencies.append(1e3 * (request.finish_time - request.arrival_time))
+            self.times_to_first_token.append(1e3 * (request.first_token_time - request.arrival_time))
+            self.queue_times.append(1e3 * (request.start_time - request.arrival_time))
+
+    def summary(self) -> dict:
+        with self.lock:
+            elapsed = time.perf_counter() - self.first_arrival_time if self.first_arrival_time is not None else 0.
+            return {
+                'requests': self.num_requests,
+                'generated_tokens': self.num_generated_tokens,
+                'tokens_per_sec': self.num_generated_tokens / max(elapsed, 1e-9),
+                'requests_per_sec': self.num_requests / max(elapsed, 1e-9),
+                'mean_batchsize': self.num_step_sequences / max(self.num_steps, 1),
+                'latency_ms': percentiles(self.latencies),
+                'time_to_first_token_ms': percentiles(self.times_to_first_token),
+                'queue_ms': percentiles(self.queue_times),
+            }
+
+
+class RunningBatch:
+    """ A decoder and the requests of its rows, in the same order."""
+    def __init__(self, net: main.SpeedyLangNet, requests: list[GenerationRequest]):
+        self.requests = requests
+        self.key      = requests[0].batch_key
+        prompts       = [request.tokens for request in requests]
+        if requests[0].mode == 'plan_act':
+            self.decoder = main.PlanActDecoder(net, prompts, *requests[0].decoder_settings)
+        else:
+            self.decoder = main.CausalDecoder(net, prompts)
+
+    def can_join(self, other: 'RunningBatch', max_batch_size: int, length_bucket: int) -> bool:
+        return (
+            other.key == self.key
+            and len(self.requests) + len(other.requests) <= max_batch_size
+            and 0 <= self.decoder.length - other.decoder.length <= length_bucket
+            and all(self.decoder.fits(request.max_new_tokens) for request in other.requests)
+        )
+
+    def join(self, other: 'RunningBatch') -> None:
+        self.decoder.extend(other.decoder)
+        self.requests += other.requests
+
+    def sample(self, logits: torch.Tensor) -> torch.Tensor:
+        # Every request has its own sampling settings, so sample each group of rows with the same settings together.
+        # Seeded requests sample on their own, from their own generator.
+        tokens = torch.empty(logits.shape[:-1], dtype=torch.long, device=logits.device)
+        rows_by_settings = {}
+        for row, request in enumerate(self.requests):
+            if request.generator is not None:
+                temperature, top_k, top_p = request.sampling_settings
+                tokens[row] = main.sample_from_logits(logits[row:row+1], temperature=temperature, top_k=top_k, top_p=top_p, generator=request.generator)[0]
+            else:
+                rows_by_settings.setdefault(request.sampling_settings, []).append(row)
+        for (temperature, top_k, top_p), rows in rows_by_settings.items():
+            rows = torch.tensor(rows, device=logits.device)
+            tokens[rows] = main.sample_from_logits(logits[rows], temperature=temperature, top_k=top_k, top_p=top_p)
+        return tokens
+
+
+class InferenceEngine:
+    """ Owns the network and runs all the decoding, in its own thread. `submit` can be called from any thread."""
+    def __init__(self, net: main.SpeedyLangNet, max_batch_size: int = MAX_BATCH_SIZE, length_bucket: int = LENGTH_BUCKET):
+        self.net            = net.eval()
+        self.max_batch_size = max_batch_size
+        self.length_bucket  = length_bucket
+        self.pending        = queue.Queue()
+        self.batches        = []
+        self.stats          = ServerStats()
+        self.thread         = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: GenerationRequest) -> concurrent.futures.Future:
+        self.pending.put(request)
+        return request.future
+
+    def run(self) -> None:
+        while True:
+            # Block while idle, otherwise just pick up whatever arrived since the last step
+            new_requests = [] if self.batches else [self.pending.get()]
+            while not self.pending.empty():
+                new_requests.append(self.pending.get_nowait())
+            if new_requests:
+                self.admit(new_requests)
+
+            for batch in list(self.batches):
+                try:
+                    self.step(batch)
+                except Exception as error: # e.g. an OOM. Fail the batch's requests instead of the whole server.
+                    for request in batch.requests:
+                        request.future.set_exception(error)
+                    batch.requests = []
+                if not batch.requests:
+                    self.batches.remove(batch)
+
+    def admit(self, requests: list[GenerationRequest]) -> None:
+        # Groups by decoding settings, then sorts by length so that the batches have as little padding as possible
+        requests = sorted(requests, key=lambda request: (request.batch_key, len(request.tokens)))
+        groups = []
+        for request in requests:
+            group = groups[-1] if groups else None
+            if (
+                    group is None or group[0].batch_key != request.batch_key or len(group) >= self.max_batch_size
+                    or len(request.tokens) - len(group[0].tokens) > self.length_bucket
+            ):
+                groups.append([])
+            groups[-1].append(request)
+
+        for group in groups:
+            start_time = time.perf_counter()
+            for request in group:
+                request.start_time = start_time
+            try:
+                new_batch = RunningBatch(self.net, group)
+            except Exception as error:
+                for request in group:
+                    request.future.set_exception(error)
+                continue
+
+            running_batch = next((batch for batch in self.batches if batch.can_join(new_batch, self.max_batch_size, self.length_bucket)), None)
+            if running_batch is not None:
+                running_batch.join(new_batch)
+            else:
+                self.batches.append(new_batch)
+
+    def step(self, batch: RunningBatch) -> None:
+        tokens = batch.decoder.propose(batch.sample)
+        self.stats.record_step(len(batch.requests))
+
+        keep = []
+        for row, (request, request_tokens) in enumerate(zip(batch.requests, tokens.tolist())):
+            if request.add_tokens(request_tokens):
+                request.finish_time = time.perf_counter()
+                self.stats.record_request(request)
+                request.future.set_result(request.response())
+            else:
+                keep.append(row)
+
+        if len(keep) < len(batch.requests):
+            batch.requests = [batch.requests[row] for row in keep]
+            if not keep:
+                return
+            keep = torch.tensor(keep, device=tokens.device)
+            batch.decoder.select(keep)
+            tokens = tokens[keep]
+        batch.decoder.commit(tokens)
+
+
+########################################
+#             Entry Points             #
+########################################
+
+def serve_http(engine: InferenceEngine, host: str, port: int) -> None:
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == '/stats':
+                self.send_json(200, engine.stats.summary())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path != '/generate':
+                return self.send_json(404, {'error': f"unknown path {self.path}"})
+            try:
+                request = GenerationRequest(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+            except (ValueError, TypeError) as error:
+                return self.send_json(400, {'error': str(error)})
+            try:
+                self.send_json(200, engine.submit(request).result())
+            except Exception as error:
+                self.send_json(500, {'error': repr(error)})
+
+        def log_message(self, *args) -> None:
+            pass # one line per request is too much for load tests, see /stats instead
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"| serving on http://{host}:{port} (POST /generate, GET /stats, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(engine.stats.summary())
+
+
+def serve_stdio(engine: InferenceEngine, output: TextIO = sys.stdout) -> None:
+    # One JSON request per line on stdin, one JSON response per line on `output` (stdout), in order of completion (match them by "id").
+    # A {"command": "stats"} line answers with the current stats. At the end of stdin, waits for all pending requests, and logs the
+    # final stats as one JSON line to stderr.
+    write_lock = threading.Lock()
+
+    def write(payload: dict) -> None:
+        with write_lock:
+            output.write(json.dumps(payload) + '\n')
+            output.flush()
+
+    def on_done(request_id, future: concurrent.futures.Future) -> None:
+        write(future.result() if future.exception() is None else {'id': request_id, 'error': repr(future.exception())})
+
+    futures = []
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+            if payload.get('command') == 'stats':
+                write(engine.stats.summary())
+                continue
+            request = GenerationRequest(payload)
+        except (ValueError, TypeError, AttributeError) as error:
+            write({'id': payload.get('id') if isinstance(payload, dict) else None, 'error': str(error)})
+            continue
+        futures.append(engine.submit(request))
+        futures[-1].add_done_callback(functools.partial(on_done, request.id))
+
+    concurrent.futures.wait(futures)
+    sys.stderr.write(json.dumps(engine.stats.summary()) + '\n')
+
+
+def run_client(url: str, num_requests: int, concurrency: int, prompt_length: int, max_new_tokens: int, mode: str, seed: int = 0) -> dict:
+    # Load generator for a running HTTP server: random token prompts, `concurrency` requests in flight at any time.
+    # Prints the client-side latencies, and the server's stats.
+    rng = random.Random(seed)
+    payloads = [
+        {'id': i, 'tokens': [rng.randrange(50257) for _ in range(rng.randint(max(1, prompt_length//2), prompt_length))], 'max_new_tokens': max_new_tokens, 'mode': mode}
+        for i in range(num_requests)
+    ]
+
+    def post(payload: dict) -> float:
+        start = time.perf_counter()
+        request = urllib.request.Request(url.rstrip('/') + '/generate', data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            json.loads(response.read())
+        return 1e3 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(post, payloads))
+    elapsed = time.perf_counter() - start
+
+    with urllib.request.urlopen(url.rstrip('/') + '/stats') as response:
+        server_stats = json.loads(response.read())
+    client_stats = {'requests_per_sec': num_requests / elapsed, 'latency_ms': percentiles(latencies)}
+    print({'client': client_stats, 'server': server_stats})
+    return client_stats
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve a trained network, or load-test a running server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("http", "stdio"):
+        subparser = subparsers.add_parser(command, help=f"Serve over {'HTTP' if command == 'http' else 'JSON lines on stdin/stdout'}.")
+        subparser.add_argument(
+            "--checkpoint",
+            type=str, required=True,
+            help="Network saved with `main.save_net`, e.g. by `python main.py --save_dir ...`. TYPE: str"
+        )
+        subparser.add_argument(
+            "--device",
+            type=str, default=main.hyp['misc']['device'],
+            help=f"Device to serve on. TYPE: str; DEFAULT: '{main.hyp['misc']['device']}' (cuda if available, else cpu)"
+        )
+        subparser.add_argument(
+            "--dtype",
+            type=str, choices=["bfloat16", "float16", "float32"], default="bfloat16",
+            help="Dtype of the network weights and activations. TYPE: str; DEFAULT: 'bfloat16'"
+        )
+        subparser.add_argument(
+            "--max_batch_size",
+            type=int, default=MAX_BATCH_SIZE,
+            help=f"Max number of sequences decoded together. TYPE: int; DEFAULT: {MAX_BATCH_SIZE}"
+        )
+        subparser.add_argument(
+            "--length_bucket",
+            type=int, default=LENGTH_BUCKET,
+            help=f"Max difference in prompt length between the sequences of a batch (more: larger batches, but more padding). TYPE: int; DEFAULT: {LENGTH_BUCKET}"
+        )
+        if command == "http":
+            subparser.add_argument("--host", type=str, default="127.0.0.1", help="TYPE: str; DEFAULT: '127.0.0.1'")
+            subparser.add_argument("--port", type=int, default=8000, help="TYPE: int; DEFAULT: 8000")
+
+    client = subparsers.add_parser("client", help="Load-test a running HTTP server with random prompts.")
+    client.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="TYPE: str; DEFAULT: 'http://127.0.0.1:8000'")
+    client.add_argument("--num_requests", type=int, default=64, help="TYPE: int; DEFAULT: 64")
+    client.add_argument("--concurrency", type=int, default=8, help="Requests in flight at any time. TYPE: int; DEFAULT: 8")
+    client.add_argument("--prompt_length", type=int, default=64, help="Prompts are between half this and this long. TYPE: int; DEFAULT: 64")
+    client.add_argument("--max_new_tokens", type=int, default=32, help="TYPE: int; DEFAULT: 32")
+    client.add_argument("--mode", type=str, choices=["causal", "plan_act"], default="causal", help="TYPE: str; DEFAULT: 'causal'")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.command == "client":
+        run_client(args.url, args.num_requests, args.concurrency, args.prompt_length, args.max_new_tokens, args.mode)
+        sys.exit(0)
+    if args.command == "stdio":
+        # stdout only carries the responses: anything else that gets printed (here, in main.py or in a library) goes to stderr
+        responses, sys.stdout = sys.stdout, sys.stderr
+
+    main.hyp['misc']['device'] = args.device
+    main.hyp['misc']['dtype'] = getattr(torch, args.dtype)
+    main.ctx.reset()
+    net, settings = main.load_net(args.checkpoint)
+    print(f"| loaded {args.checkpoint}: {settings}, {main.format_num_params(sum(p.numel() for p in net.parameters()))} params")
+
+    engine = InferenceEngine(net, max_batch_size=args.max_batch_size, length_bucket=args.length_bucket)
+    if args.command == "http":
+        serve_http(engine, args.host, args.port)
+    else:
+        serve_stdio(engine, responses)
@@ -0,0 +1,199 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+#############################################
+#            Token Shard Format             #
+#############################################
+
+# A tokenized corpus lives in a directory: one `index.json` plus a handful of flat `.bin` shards per split.
+# Each shard is a fixed 1 KiB header (256 int32s: magic, version, num_tokens, rest reserved) followed by the raw uint16 tokens.
+# The gpt2 vocab (50257) comfortably fits into uint16, which halves the disk/page-cache footprint compared to the old int32 `data.pt`.
+#
+# Nothing gets read eagerly: shards are `numpy.memmap`ed, and only the windows that `get_batch` samples ever get touched,
+# so start-up is effectively instantaneous and the corpus can be (much) larger than host RAM.
+#
+# Optionally, a split also records where its documents start: a flat int64 file of token offsets into the split's stream,
+# registered under 'documents' in the index (together with the shards that contain them, so that it's resumable the same way).
+
+SHARD_MAGIC      = 20240520
+SHARD_VERSION    = 1
+HEADER_INTS      = 256
+HEADER_BYTES     = HEADER_INTS * np.dtype(np.int32).itemsize
+TOKEN_DTYPE      = np.uint16
+INDEX_FILENAME   = 'index.json'
+SHARD_SIZE       = 100_000_000 # tokens per shard; ~200 MB on disk
+
+
+def shard_filename(split: str, shard_idx: int) -> str:
+    return f"{split}_{shard_idx:06d}.bin"
+
+
+def is_shard_directory(directory: str) -> bool:
+    return os.path.isfile(os.path.join(directory, INDEX_FILENAME))
+
+
+def read_index(directory: str) -> dict:
+    if not is_shard_directory(directory):
+        return {'version': SHARD_VERSION, 'dtype': np.dtype(TOKEN_DTYPE).name, 'splits': {}}
+    with open(os.path.join(directory, INDEX_FILENAME)) as f:
+        return json.load(f)
+
+
+def write_index(directory: str, index: dict) -> None:
+    # Write-then-rename, so that a crash never leaves a half-written index behind
+    tmp_path = os.path.join(directory, INDEX_FILENAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, INDEX_FILENAME))
+
+
+def write_shard(directory: str, split: str, shard_idx: int, tokens: np.ndarray) -> str:
+    tokens = np.asarray(tokens)
+    assert tokens.ndim == 1, "Shards hold a flat token stream"
+    assert tokens.size == 0 or (tokens.min() >= 0 and tokens.max() < 2**16), "Token ids have to fit into uint16"
+
+    header = np.zeros(HEADER_INTS, dtype=np.int32)
+    header[0], header[1], header[2] = SHARD_MAGIC, SHARD_VERSION, len(tokens)
+
+    filename = shard_filename(split, shard_idx)
+    tmp_path = os.path.join(directory, filename + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(tokens.astype(TOKEN_DTYPE, copy=False).tobytes())
+    os.replace(tmp_path, os.path.join(directory, filename))
+    return filename
+
+
+def documents_filename(split: str) -> str:
+    return f"{split}_documents.bin"
+
+
+def write_documents(directory: str, split: str, document_starts: np.ndarray) -> str:
+    filename = documents_filename(split)
+    tmp_path = os.path.join(directory, filename + '.tmp')
+    np.asarray(document_starts, dtype=np.int64).tofile(tmp_path)
+    os.replace(tmp_path, os.path.join(directory, filename))
+    return filename
+
+
+def read_documents(directory: str, split_index: dict) -> np.ndarray | None:
+    # Token offsets of the documents of a split, or None if they weren't recorded (e.g. for converted `data.pt` files)
+    if 'documents' not in split_index:
+        return None
+    documents = split_index['documents']
+    return np.fromfile(os.path.join(directory, documents['file']), dtype=np.int64, count=documents['num_documents'])
+
+
+def read_shard(path: str) -> np.memmap:
+    header = np.fromfile(path, dtype=np.int32, count=HEADER_INTS)
+    assert header[0] == SHARD_MAGIC, f"{path} is not a token shard (bad magic number)"
+    assert header[1] == SHARD_VERSION, f"{path} has unsupported shard version {header[1]}"
+    return np.memmap(path, dtype=TOKEN_DTYPE, mode='r', offset=HEADER_BYTES, shape=(int(header[2]),))
+
+
+class ShardWriter:
+    """ Incrementally writes a token stream of one split into shards of (at most) `shard_size` tokens, and registers them in the index."""
+    def __init__(self, directory: str, split: str, shard_size: int | None = SHARD_SIZE, resume: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory  = directory
+        self.split      = split
+        self.shard_size = shard_size # None: never split automatically, the caller decides when to `flush`
+        self.buffer     = []
+        self.buffered   = 0
+        self.documents  = None # Document starts (in tokens, from the start of the split), only if `write` was ever given any
+
+        # Start a fresh split, overwriting whatever might have been registered under that name before (unless we're resuming it)
+        index = read_index(directory)
+        if not (resume and split in index['splits']):
+            index['splits'][split] = {'shards': [], 'num_tokens': 0}
+            write_index(directory, index)
+        self.split_index = index['splits'][split]
+        if self.split_index.get('documents'):
+            self.documents = list(read_documents(directory, self.split_index))
+
+    def write(self, tokens: list[int] | np.ndarray, document_starts: list[int] | np.ndarray | None = None) -> None:
+        # `document_starts`: offsets of the documents that start within `tokens`, relative to them
+        tokens = np.asarray(tokens)
+        assert tokens.size == 0 or (tokens.min() >= 0 and tokens.max() < 2**16), "Token ids have to fit into uint16"
+        tokens = tokens.astype(TOKEN_DTYPE, copy=False)
+        if document_starts is not None:
+            offset = self.split_index['num_tokens'] + self.buffered
+            self.documents = (self.documents or []) + [offset + int(start) for start in document_starts]
+        self.buffer.append(tokens)
+        self.buffered += len(tokens)
+        while self.shard_size is not None and self.buffered >= self.shard_size:
+            flat = np.concatenate(self.buffer)
+            self.flush(flat[:self.shard_size])
+            self.buffer, self.buffered = [flat[self.shard_size:]], len(flat) - self.shard_size
+
+    def flush(self, tokens: np.ndarray | None = None, metadata: dict | None = None) -> None:
+        # `metadata` is merged into this split's index entry in the same (atomic) index update that registers the shard,
+        # which lets writers record e.g. how far into their source they got alongside the tokens that came out of it.
+        if tokens is None:
+            tokens = np.concatenate(self.buffer) if self.buffer else np.empty(0, dtype=TOKEN_DTYPE)
+            self.buffer, self.buffered = [], 0
+
+        index = read_index(self.directory)
+        split_index = index['splits'][self.split]
+        if len(tokens) > 0:
+            filename = write_shard(self.directory, self.split, len(split_index['shards']), tokens)
+            split_index['shards'].append({'file': filename, 'num_tokens': int(len(tokens))})
+            split_index['num_tokens'] += int(len(tokens))
+        elif not metadata:
+            return
+        if self.documents is not None:
+            # Only the documents that start within the tokens written so far, the rest are still buffered
+            committed = [start for start in self.documents if start < split_index['num_tokens']]
+            split_index['documents'] = {'file': write_documents(self.directory, self.split, committed), 'num_documents': len(committed)}
+        split_index.update(metadata or {})
+        write_index(self.directory, index)
+        self.split_index = split_index
+
+    def close(self, metadata: dict | None = None) -> None:
+        self.flush(metadata=metadata)
+
+
+class TokenShards:
+    """ Read-only, memory-mapped view over all shards of one split, which behaves like the flat 1d token tensors that used to live in `data.pt`."""
+    def __init__(self, directory: str, split: str):
+        split_index = read_index(directory)['splits'][split]
+        self.shards  = [read_shard(os.path.join(directory, shard['file'])) for shard in split_index['shards']]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.document_starts = read_documents(directory, split_index)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, item: slice) -> torch.Tensor:
+        # Only contiguous slices here, gathers go through `take`
+        start, stop, step = item.indices(len(self))
+        assert step == 1, "Only contiguous slices are supported"
+        return self.take(torch.arange(start, stop))
+
+    def take(self, indices: torch.Tensor) -> torch.Tensor:
+        # Same semantics as `torch.Tensor.take`: index into the flattened token stream, return the result in the shape & on the device of `indices`
+        flat_indexes = indices.flatten().cpu().numpy()
+        out          = np.empty(flat_indexes.shape, dtype=np.int64)
+        shard_ids    = np.searchsorted(self.offsets, flat_indexes, side='right') - 1
+
+        for shard_id in np.unique(shard_ids):
+            selected = shard_ids == shard_id
+            out[selected] = self.shards[shard_id][flat_indexes[selected] - self.offsets[shard_id]]
+
+        return torch.from_numpy(out).view(indices.shape).to(indices.device)
+
+
+def load_token_shards(directory: str) -> dict[str, TokenShards]:
+    return {split: TokenShards(directory, split) for split in read_index(directory)['splits']}
+
+
+def convert_tensors_to_shards(data: dict[str, torch.Tensor], directory: str, shard_size: int = SHARD_SIZE) -> None:
+    # Migrates an old monolithic `data.pt` dict ({'train': tensor, 'eval': tensor}) to the shard format
+    for split, tokens in data.items():
+        writer = ShardWriter(directory, split, shard_size)
+        writer.write(tokens.cpu().numpy())
+        writer.close()